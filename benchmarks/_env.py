@@ -0,0 +1,13 @@
+"""ベンチマーク共通の実行環境の準備
+
+main を import する前に import すると、キャッシュ・設定などの実行時ファイルの保存先
+(DATA_DIR) をリポジトリの data/ ではなく一時ディレクトリにする。
+
+    import _env  # noqa: F401
+    import main
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="aivis-bench-"))
@@ -0,0 +1,91 @@
+"""1発話あたりの CPU 時間の比較 (MP3 + ffmpeg / WAV + プロセス内変換)
+
+同じ長さの音声について、受信済みの音声データから再生 (GuildAudioSource.read で
+全フレームを読み出す) までにかかる CPU 時間を測ります。ffmpeg の子プロセスの
+CPU 時間も含みます。サーバー音量は既定の 75% です。ffmpeg が必要です。
+
+    python benchmarks/bench_audio_path.py
+"""
+
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import generate_audio  # noqa: E402
+
+ROUNDS = 20
+AUDIO_SECONDS = 4.0
+SERVER_VOLUME = 0.75
+
+
+def cpu_seconds() -> float:
+    usage = [
+        resource.getrusage(who)
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def play(clip: main.PCMClip):
+    """再生スレッドと同じように、クリップの最後までフレームを読み出す"""
+    source = main.GuildAudioSource(types.SimpleNamespace(server_volume=SERVER_VOLUME))
+    source.enqueue(clip)
+    while not clip.finished:
+        source.read()
+
+
+async def ffmpeg_path(audio_data: bytes) -> main.PCMClip:
+    clip = main.PCMClip(1.0)
+    clip.feed(await main.decode_to_pcm(audio_data))
+    clip.finish()
+    return clip
+
+
+async def wav_path(audio_data: bytes) -> main.PCMClip:
+    clip = main.PCMClip(1.0, SERVER_VOLUME)
+    clip.feed(main.convert_wav(audio_data, SERVER_VOLUME))
+    clip.finish()
+    return clip
+
+
+async def measure(name: str, prepare, audio_data: bytes):
+    cpu_samples, wall_samples = [], []
+    for _ in range(ROUNDS):
+        cpu_started, wall_started = cpu_seconds(), time.perf_counter()
+        play(await prepare(audio_data))
+        cpu_samples.append(cpu_seconds() - cpu_started)
+        wall_samples.append(time.perf_counter() - wall_started)
+    print(
+        f"{name:>14}: CPU {statistics.mean(cpu_samples) * 1000:6.2f} ms/clip,"
+        f" wall median {statistics.median(wall_samples) * 1000:6.2f} ms"
+    )
+
+
+async def run():
+    mp3 = generate_audio(AUDIO_SECONDS, "mp3")
+    wav = generate_audio(AUDIO_SECONDS, "wav")
+    print(
+        f"{AUDIO_SECONDS:.0f} s clip (44.1 kHz mono), mp3 {len(mp3)} bytes,"
+        f" wav {len(wav)} bytes, {ROUNDS} rounds"
+    )
+    main.AIVIS_OUTPUT_FORMAT = "mp3"
+    await measure("mp3 + ffmpeg", ffmpeg_path, mp3)
+    main.AIVIS_OUTPUT_FORMAT = "wav"
+    numpy = main.np
+    if numpy is not None:
+        await measure("wav + numpy", wav_path, wav)
+    main.np = None
+    await measure("wav + audioop", wav_path, wav)
+    main.np = numpy
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
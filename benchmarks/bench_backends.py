@@ -0,0 +1,100 @@
+"""合成の実行先 (クラウド / ローカル) の振り分けと切り替えの確認
+
+応答の遅いクラウド API の代替サーバーと、速いローカル合成サーバーの代替を起動し、
+短いメッセージについて prepare_clip が再生できるクリップを返すまでの時間を比べます。
+ローカルが遅くなった場合 (制限時間を超えてクラウドでも合成する) と、
+ローカルが落ちている場合 (すぐにクラウドへ切り替える) も測ります。ffmpeg が必要です。
+
+    python benchmarks/bench_backends.py
+"""
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import MockAivisServer, MockEngineServer, generate_audio  # noqa: E402
+
+ROUNDS = 20
+CLOUD_LATENCY = 0.3
+LOCAL_LATENCY = 0.05
+LOCAL_BUDGET = 0.5
+
+
+def configure(local_url: str = None):
+    main.local_backend = None
+    if local_url:
+        main.local_backend = main.LocalEngineBackend(
+            local_url, {"*": "888753760"}, LOCAL_BUDGET, 2
+        )
+    main.speech_backends = [main.cloud_backend] + (
+        [main.local_backend] if main.local_backend else []
+    )
+
+
+async def measure(name: str, offset: int, *servers):
+    before = [server.requests for server in servers]
+    samples = []
+    for index in range(ROUNDS):
+        started = time.perf_counter()
+        clip = await main.prepare_clip(
+            "bench", f"こんにちは {offset + index}", "model", 1.0, 1.0
+        )
+        samples.append(time.perf_counter() - started)
+        assert clip is not None
+        if clip.producer:
+            await clip.producer
+    counts = ", ".join(
+        f"{type(server).__name__} {server.requests - count}"
+        for server, count in zip(servers, before)
+    )
+    print(
+        f"{name:>14}: time-to-clip median {statistics.median(samples) * 1000:5.0f} ms,"
+        f" max {max(samples) * 1000:5.0f} ms | requests: {counts}"
+    )
+
+
+async def run():
+    main.logger.setLevel(logging.CRITICAL)
+    main.speech_cache.disk_dir = None
+    cloud = MockAivisServer(generate_audio(1.0, "mp3"), latency=CLOUD_LATENCY)
+    local = MockEngineServer(generate_audio(1.0, "wav"), latency=LOCAL_LATENCY)
+    main.endpoint_pool = main.create_endpoint_pool([[await cloud.start()]])
+    local_url = await local.start()
+    main.bot.http_session = aiohttp.ClientSession()
+    try:
+        print(
+            f"cloud latency {CLOUD_LATENCY * 1000:.0f} ms,"
+            f" local latency {LOCAL_LATENCY * 1000:.0f} ms,"
+            f" local budget {LOCAL_BUDGET * 1000:.0f} ms, {ROUNDS} short messages"
+        )
+        configure()
+        await measure("cloud only", 0, cloud, local)
+        configure(local_url)
+        await measure("local + cloud", ROUNDS, cloud, local)
+
+        # ローカルが遅くなった場合
+        local.latency = 2.0
+        configure(local_url)
+        await measure("local slow", ROUNDS * 2, cloud, local)
+
+        # ローカルが落ちている場合
+        local.latency = LOCAL_LATENCY
+        await local.stop()
+        configure(local_url)
+        await measure("local down", ROUNDS * 3, cloud, local)
+    finally:
+        await main.bot.http_session.close()
+        await cloud.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
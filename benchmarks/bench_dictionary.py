@@ -0,0 +1,134 @@
+"""辞書置換のマイクロベンチマーク
+
+従来の str.replace ループと DictionaryMatcher を、辞書サイズ 10 / 1k / 10k で比較します。
+あわせて、10k 語の辞書を作り直す間のイベントループの最大停止時間と、
+作り直しの間も前のマッチャーで置換を続けられることを確認します。
+
+    python benchmarks/bench_dictionary.py
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main as bot_main  # noqa: E402
+from main import DictionaryMatcher  # noqa: E402
+
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+ASCII = "abcdefghijklmnopqrstuvwxyz"
+SIZES = (10, 1_000, 10_000)
+MESSAGES = 200
+
+
+def random_word(rng: random.Random) -> str:
+    alphabet = KATAKANA if rng.random() < 0.5 else ASCII
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 8)))
+
+
+def build_dictionary(rng: random.Random, size: int) -> dict:
+    dictionary = {}
+    while len(dictionary) < size:
+        dictionary[random_word(rng)] = random_word(rng)
+    return dictionary
+
+
+def build_messages(rng: random.Random, dictionary: dict) -> list:
+    words = list(dictionary)
+    messages = []
+    for _ in range(MESSAGES):
+        parts = []
+        for _ in range(rng.randint(5, 20)):
+            parts.append(rng.choice(words) if rng.random() < 0.3 else random_word(rng))
+        messages.append(" ".join(parts))
+    return messages
+
+
+def replace_loop(text: str, dictionary: dict) -> str:
+    for word, reading in dictionary.items():
+        text = text.replace(word, reading)
+    return text
+
+
+def measure(func, messages: list) -> float:
+    started = time.perf_counter()
+    for text in messages:
+        func(text)
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main():
+    rng = random.Random(0)
+    print(
+        f"{'entries':>8} | {'loop us/msg':>12} | {'matcher us/msg':>15} |"
+        f" {'speedup':>8} | {'build ms':>9}"
+    )
+    for size in SIZES:
+        dictionary = build_dictionary(rng, size)
+        messages = build_messages(rng, dictionary)
+
+        started = time.perf_counter()
+        matcher = DictionaryMatcher(dictionary)
+        build_ms = (time.perf_counter() - started) * 1e3
+
+        loop_us = measure(lambda text: replace_loop(text, dictionary), messages)
+        matcher_us = measure(matcher.apply, messages)
+        print(
+            f"{size:>8} | {loop_us:>12.1f} | {matcher_us:>15.1f} |"
+            f" {loop_us / matcher_us:>7.1f}x | {build_ms:>9.1f}"
+        )
+
+
+async def measure_rebuild_stall(dictionary: dict, messages: list):
+    """辞書の変更後の作り直し中に、イベントループが止まった最大時間 (ms)"""
+    guild_id = "bench"
+    bot_main.dictionaries[guild_id] = dict(dictionary)
+    old = await bot_main.get_dictionary_matcher(guild_id)
+
+    stall = 0.0
+    served_old = 0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal stall, served_old
+        last = time.perf_counter()
+        index = 0
+        while not done.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last)
+            last = now
+            matcher = await bot_main.get_dictionary_matcher(guild_id)
+            matcher.apply(messages[index % len(messages)])
+            index += 1
+            served_old += matcher is old
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.05)
+    bot_main.dictionaries[guild_id]["bench-added"] = "ついか"
+    started = time.perf_counter()
+    bot_main.invalidate_dictionary_matcher(guild_id)
+    await bot_main.dictionary_builds[guild_id]
+    rebuild_ms = (time.perf_counter() - started) * 1e3
+    await asyncio.sleep(0.05)
+    done.set()
+    await task
+
+    new = await bot_main.get_dictionary_matcher(guild_id)
+    assert new is not old and new.apply("bench-added") == "ついか"
+    assert served_old > 0, "作り直しの間に前のマッチャーが使われていない"
+    print(
+        f"rebuild {len(dictionary)} entries: {rebuild_ms:.1f} ms off-loop,"
+        f" max loop stall {stall * 1e3:.1f} ms, {served_old} messages on old matcher"
+    )
+
+
+if __name__ == "__main__":
+    main()
+    rng = random.Random(1)
+    dictionary = build_dictionary(rng, SIZES[-1])
+    asyncio.run(measure_rebuild_stall(dictionary, build_messages(rng, dictionary)))
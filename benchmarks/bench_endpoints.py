@@ -0,0 +1,111 @@
+"""複数の接続先への振り分けとヘルスチェックの確認
+
+応答時間の異なる代替サーバー (速い / 普通 / 遅い) と、常に 500 を返すサーバーを
+起動し、同じリクエストを EndpointPool の選び方 (コスト最小 + 受動的なヘルスチェック)
+とランダムな振り分けで送ったときの、サーバーごとの件数と所要時間の分位点を比べます。
+最後に速いサーバーを途中で遅くし、外されて他に振り分けが移ることを確認します。
+
+    python benchmarks/bench_endpoints.py
+"""
+
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import MockAivisServer, generate_mp3  # noqa: E402
+
+REQUESTS = 300
+CONCURRENCY = 16
+SERVERS = (
+    ("fast", {"latency": 0.05}),
+    ("normal", {"latency": 0.15}),
+    ("slow", {"latency": 0.6}),
+    ("broken", {"latency": 0.05, "error_rate": 1.0}),
+)
+
+
+async def send(count: int, offset: int) -> list:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(index: int) -> float:
+        async with semaphore:
+            started = time.perf_counter()
+            data = await main.request_speech(f"text {offset + index}", "model", 1.0)
+            return time.perf_counter() - started if data else float("inf")
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+def report(name: str, servers: dict, latencies: list, before: dict):
+    ok = sorted(x for x in latencies if x != float("inf"))
+    counts = ", ".join(
+        f"{label} {server.requests - before[label]}"
+        for label, server in servers.items()
+    )
+    p95 = ok[int(len(ok) * 0.95)] if ok else 0.0
+    print(
+        f"{name:>16}: p50 {statistics.median(ok) * 1000:5.0f} ms,"
+        f" p95 {p95 * 1000:5.0f} ms, failed {len(latencies) - len(ok)}"
+        f" | requests: {counts}"
+    )
+
+
+def configure_pool(urls: list):
+    main.endpoint_pool = main.create_endpoint_pool([[url] for url in urls])
+    main.api_circuit = main.CircuitBreaker(1000, 1)
+    main.api_latency = main.LatencyTracker()
+
+
+async def run():
+    main.logger.setLevel(logging.CRITICAL)
+    main.AIVIS_HEDGE = False
+    main.speech_cache.disk_dir = None
+    main.synthesis_scheduler = main.SynthesisScheduler(1000, 1000, 64, {})
+    audio = generate_mp3(0.5)
+    servers = {label: MockAivisServer(audio, **options) for label, options in SERVERS}
+    urls = [await server.start() for server in servers.values()]
+    main.bot.http_session = aiohttp.ClientSession()
+    offset = 0
+    try:
+        print(f"{REQUESTS} requests, {CONCURRENCY} concurrent, no hedging")
+
+        configure_pool(urls)
+        pool = main.endpoint_pool
+        pool.select = lambda: random.choice(pool.endpoints)
+        before = {label: server.requests for label, server in servers.items()}
+        report("random", servers, await send(REQUESTS, offset), before)
+        offset += REQUESTS
+
+        configure_pool(urls)
+        before = {label: server.requests for label, server in servers.items()}
+        report("pool", servers, await send(REQUESTS, offset), before)
+        offset += REQUESTS
+
+        # 速いサーバーが途中で遅くなった場合
+        servers["fast"].latency = 1.0
+        ejections = main.metrics._counters["endpoint_ejections_total"]
+        ejections.clear()
+        before = {label: server.requests for label, server in servers.items()}
+        report("pool, fast->slow", servers, await send(REQUESTS, offset), before)
+        print(
+            "ejections: "
+            + ", ".join(f"{name} {int(count)}" for name, count in ejections.items())
+        )
+    finally:
+        await main.bot.http_session.close()
+        for server in servers.values():
+            await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,121 @@
+"""ログ出力が on_message の処理速度に与える影響の比較
+
+偽のメッセージを on_message に流し続け、1秒あたりの処理件数を次の条件で比較します。
+出力先は、書き込みのたびに少し待たされる (端末やパイプが詰まった状態を模した) ストリームです。
+
+- off: LOG_LEVEL=INFO (メッセージごとの DEBUG ログは整形もされない)
+- sync: DEBUG ログを呼び出し元のスレッドでそのまま書き込む (従来の print 相当)
+- queued: DEBUG ログをキューに積み、専用スレッドで書き込む
+- queued+sampled: さらに sample=True のログを間引く (既定の設定)
+
+    python benchmarks/bench_logging.py
+"""
+
+import asyncio
+import atexit
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+
+MESSAGES = 20_000
+GUILDS = 20
+SINK_WRITE_DELAY = 0.0002  # 1回の書き込みで待たされる秒数
+
+
+class SlowStream:
+    """書き込みのたびに少し待たされる出力先"""
+
+    def write(self, text: str):
+        time.sleep(SINK_WRITE_DELAY)
+
+    def flush(self):
+        pass
+
+
+class FakeVoiceClient:
+    latency = 0.0
+
+    def is_connected(self) -> bool:
+        return True
+
+
+class FakeObject:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def make_message(index: int) -> FakeObject:
+    guild_id = index % GUILDS
+    content = f"テストメッセージ {index} https://example.com/{index}"
+    return FakeObject(
+        author=FakeObject(bot=False, id=1000 + index % 50),
+        guild=FakeObject(id=guild_id),
+        channel=FakeObject(id=guild_id),
+        content=content,
+        clean_content=content,
+        attachments=[],
+    )
+
+
+def configure(mode: str) -> logging.handlers.QueueListener:
+    sys.stdout = SlowStream()
+    main.LOG_LEVEL = "INFO" if mode == "off" else "DEBUG"
+    main.LOG_SAMPLE_BURST = 5 if mode == "queued+sampled" else MESSAGES
+    listener = main.setup_logging()
+    # 条件ごとにここで止めるので、終了時に止め直さない
+    atexit.unregister(listener.stop)
+    if mode == "sync":
+        # キューを通さず、呼び出し元で書き込む
+        listener.stop()
+        root = logging.getLogger()
+        root.handlers[:] = listener.handlers
+        for handler in root.handlers:
+            handler.addFilter(main.LogSampler(10, MESSAGES))
+        listener = None
+    return listener
+
+
+async def measure(mode: str) -> float:
+    listener = configure(mode)
+    main.guild_sessions.clear()
+    for guild_id in range(GUILDS):
+        session = main.GuildSession(asyncio.get_running_loop(), str(guild_id))
+        # 再生タスクを起動させず、キューに積むところまでを測る
+        session.closed = True
+        session.voice_client = FakeVoiceClient()
+        session.text_channel_id = guild_id
+        main.guild_sessions[str(guild_id)] = session
+    messages = [make_message(i) for i in range(MESSAGES)]
+
+    started = time.perf_counter()
+    for message in messages:
+        await main.on_message(message)
+    elapsed = time.perf_counter() - started
+
+    for session in main.guild_sessions.values():
+        session.discard_burst()
+    if listener:
+        listener.stop()
+    sys.stdout = sys.__stdout__
+    return MESSAGES / elapsed
+
+
+async def run():
+    main.COALESCE_LINGER = 0
+    main.DEFAULT_QUEUE_MAX_ITEMS = MESSAGES
+    main.DEFAULT_QUEUE_MAX_CHARS = MESSAGES * 100
+    main.DEFAULT_QUEUE_MAX_SECONDS = MESSAGES * 100
+    print(f"{MESSAGES} messages, sink write delay {SINK_WRITE_DELAY * 1e6:.0f} us")
+    for mode in ("off", "sync", "queued", "queued+sampled"):
+        rate = await measure(mode)
+        print(f"{mode:>15}: {rate:>9,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,112 @@
+"""再生待ちキューの順番の比較 (到着順 / 通知優先 + 発言者ごとの公平な順番)
+
+1人が長文を20件連投した直後に、他の人が短いメッセージを送り、入退室の通知も入る
+場面を、推定再生時間 (SpeechItem.estimated_seconds) で再生したとして模擬し、
+発言者ごとの待ち時間 (受け取ってから再生が始まるまで) を比べます。
+
+    python benchmarks/bench_queue.py
+"""
+
+import os
+import statistics
+import sys
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+
+LIMITS = main.QueueLimits(1000, 100000, 100000, "summarize")
+LONG_TEXT = "長文のテストです。" * 15  # 135 文字
+SHORT_TEXT = "了解です、ありがとうございます"
+
+
+def scenario() -> list:
+    items = [
+        main.SpeechItem(LONG_TEXT, "model", 1.0, 1.0, created_at=0.1 * i, user_id="A")
+        for i in range(20)
+    ]
+    for index, user_id in enumerate("BCDBCDBCD"):
+        items.append(
+            main.SpeechItem(
+                SHORT_TEXT, "model", 1.0, 1.0, created_at=3.0 + index, user_id=user_id
+            )
+        )
+    for index, at in enumerate((2.5, 6.5, 30.0)):
+        items.append(
+            main.SpeechItem(
+                f"メンバー{index}さんが入室しました",
+                main.DEFAULT_MODEL_UUID,
+                1.0,
+                1.0,
+                kind="notice",
+                created_at=at,
+                user_id=f"N{index}",
+            )
+        )
+    return sorted(items, key=lambda item: item.created_at)
+
+
+class FifoQueue:
+    """以前の到着順のキュー"""
+
+    def __init__(self):
+        self._items = deque()
+
+    def put(self, item, limits):
+        self._items.append(item)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def get_nowait(self):
+        return self._items.popleft()
+
+
+def simulate(speech_queue) -> dict:
+    arrivals = scenario()
+    now = 0.0
+    speech_queue.clock = lambda: now
+    waits = {}
+    index = 0
+    while index < len(arrivals) or not speech_queue.empty():
+        if speech_queue.empty():
+            now = max(now, arrivals[index].created_at)
+        while index < len(arrivals) and arrivals[index].created_at <= now:
+            speech_queue.put(arrivals[index], LIMITS)
+            index += 1
+        if speech_queue.empty():
+            continue
+        item = speech_queue.get_nowait()
+        key = "notice" if item.kind == "notice" else item.user_id
+        waits.setdefault(key, []).append(now - item.created_at)
+        now += item.estimated_seconds
+    return waits
+
+
+def report(name: str, waits: dict):
+    print(f"{name}:")
+    for key in ("A", "B", "C", "D", "notice"):
+        samples = waits.get(key, [])
+        if not samples:
+            print(f"  {key:>6}: none played")
+            continue
+        print(
+            f"  {key:>6}: played {len(samples):2d}, wait median"
+            f" {statistics.median(samples):6.1f} s, max {max(samples):6.1f} s"
+        )
+
+
+def run():
+    print(
+        f"user A: 20 x {len(LONG_TEXT)} chars, users B/C/D: 3 x {len(SHORT_TEXT)}"
+        f" chars each, 3 notices, quantum {main.QUEUE_FAIR_QUANTUM} chars,"
+        f" notice max age {main.NOTICE_MAX_AGE:.0f} s"
+    )
+    report("fifo", simulate(FifoQueue()))
+    report("fair", simulate(main.SpeechQueue()))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,122 @@
+"""障害を起こす代替サーバーに対する request_speech / stream_speech の挙動の確認
+
+次の条件で、成功率・所要時間の分位点・実際に送ったリクエスト数を比較します。
+
+- 応答の一部が極端に遅い: ヘッジあり / なし
+- 一時的なエラー (500 / 429 / 途中切断): 再送あり / なし
+- 障害中 (すべて 500): サーキットブレーカーで即失敗になること
+- 応答がすべて遅く、実行枠の待ちも発生する: AIVIS_DEADLINE を超えずに失敗すること
+  (一括受信とストリーミング受信の両方)
+
+    python benchmarks/bench_resilience.py
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import MockAivisServer  # noqa: E402
+
+REQUESTS = 100
+CONCURRENCY = 10
+AUDIO = b"\xff\xfb" + b"\x00" * 16_000  # 中身はデコードしないので形式は問わない
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def receive(text: str, streaming: bool):
+    """1件合成する。失敗したら None"""
+    if not streaming:
+        return await main.request_speech(text, "model", 1.0, "g")
+    try:
+        chunks = [chunk async for chunk in main.stream_speech(text, "model", 1.0, "g")]
+    except Exception:
+        return None
+    return b"".join(chunks) or None
+
+
+async def run_scenario(name: str, server_options: dict, **settings):
+    main.AIVIS_HEDGE = settings.get("hedge", True)
+    main.AIVIS_MAX_RETRIES = settings.get("retries", 2)
+    main.AIVIS_REQUEST_TIMEOUT = settings.get("timeout", 10.0)
+    main.AIVIS_DEADLINE = settings.get("deadline", 30.0)
+    main.synthesis_scheduler = main.SynthesisScheduler(
+        1000, 1000, settings.get("concurrency", 64), {}
+    )
+    main.api_latency = main.LatencyTracker()
+    main.api_circuit = main.CircuitBreaker(
+        main.AIVIS_CIRCUIT_THRESHOLD, main.AIVIS_CIRCUIT_RESET
+    )
+    server = MockAivisServer(AUDIO, latency=0.05, **server_options)
+    main.endpoint_pool = main.create_endpoint_pool([[await server.start()]])
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+    successes = 0
+
+    async def one(index: int):
+        nonlocal successes
+        async with semaphore:
+            started = time.perf_counter()
+            data = await receive(f"{name} {index}", settings.get("streaming", False))
+            latencies.append(time.perf_counter() - started)
+            successes += data is not None
+
+    await asyncio.gather(*(one(i) for i in range(REQUESTS)))
+    await server.stop()
+    print(
+        f"{name:<36} success {successes:>3}/{REQUESTS}"
+        f"  p50 {percentile(latencies, 0.5) * 1000:>6.0f} ms"
+        f"  p95 {percentile(latencies, 0.95) * 1000:>6.0f} ms"
+        f"  p99 {percentile(latencies, 0.99) * 1000:>6.0f} ms"
+        f"  api requests {server.requests:>3}"
+        f"  circuit rejected {main.api_circuit.rejected:>3}"
+    )
+    return latencies
+
+
+async def run():
+    # 失敗時のエラーログは結果の表が読みにくくなるので出さない
+    main.logger.setLevel(logging.CRITICAL)
+    main.bot.http_session = aiohttp.ClientSession()
+    try:
+        slow = {"slow_rate": 0.1, "slow_delay": 2.0}
+        await run_scenario("slow tail, no hedge", slow, hedge=False)
+        await run_scenario("slow tail, hedge", slow, hedge=True)
+
+        flaky = {"error_rate": 0.15, "rate_limit_rate": 0.05, "drop_rate": 0.05}
+        await run_scenario("transient errors, no retry", flaky, retries=0)
+        await run_scenario("transient errors, retry", flaky, retries=2)
+
+        await run_scenario("outage", {"error_rate": 1.0}, hedge=False)
+
+        deadline = 1.0
+        for streaming in (False, True):
+            latencies = await run_scenario(
+                "deadline 1s, hung + queued" + (", stream" if streaming else ""),
+                {"slow_rate": 1.0, "slow_delay": 5.0},
+                hedge=False,
+                timeout=15.0,
+                deadline=deadline,
+                concurrency=2,
+                streaming=streaming,
+            )
+            # イベントループの遅れなどの分だけ余裕を持たせる
+            assert max(latencies) < deadline + 0.2, max(latencies)
+    finally:
+        await main.bot.http_session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
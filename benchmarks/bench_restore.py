@@ -0,0 +1,124 @@
+"""再起動後のセッション復元 (VCへの再接続) にかかる時間の確認
+
+保存したセッションのファイルから、偽のギルドのVCへ再接続します。接続1回に
+数百ミリ秒かかるとして、同時接続数とジッターを変えたときの、全ギルドの復元に
+かかる時間・ギルドごとの再接続までの時間・同時に接続していた数の最大値を比べます。
+
+    python benchmarks/bench_restore.py
+"""
+
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+
+GUILDS = 200
+CONNECT_SECONDS = (0.3, 0.6)
+MODES = (
+    ("sequential", 1, 0.0),
+    ("bounded", 5, 1.0),
+    ("bounded", 20, 1.0),
+)
+
+
+class FakeObject:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeVoiceClient:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def is_connected(self) -> bool:
+        return True
+
+
+class ConnectStats:
+    def __init__(self):
+        self.in_flight = 0
+        self.peak = 0
+        self.started = time.perf_counter()
+        self.connected = []
+
+
+def fake_guild(guild_id: int, stats: ConnectStats) -> FakeObject:
+    async def connect(timeout: float):
+        stats.in_flight += 1
+        stats.peak = max(stats.peak, stats.in_flight)
+        await asyncio.sleep(random.uniform(*CONNECT_SECONDS))
+        stats.in_flight -= 1
+        stats.connected.append(time.perf_counter() - stats.started)
+        return FakeVoiceClient(channel)
+
+    async def edit(**kwargs):
+        pass
+
+    human = FakeObject(bot=False)
+    channel = FakeObject(id=guild_id * 10, name="vc", members=[human], connect=connect)
+    return FakeObject(
+        id=guild_id,
+        voice_client=None,
+        me=FakeObject(edit=edit),
+        get_channel=lambda channel_id: channel,
+    )
+
+
+def snapshot() -> dict:
+    return {
+        "saved_at": time.time(),
+        "sessions": {
+            str(guild_id): {
+                "voice_channel_id": guild_id * 10,
+                "text_channel_id": guild_id * 100,
+                "is_muted": False,
+                "is_paused": False,
+                "server_volume": 0.75,
+            }
+            for guild_id in range(1, GUILDS + 1)
+        },
+    }
+
+
+async def measure(name: str, concurrency: int, jitter: float):
+    main.guild_sessions.clear()
+    main.SESSION_RESTORE_CONCURRENCY = concurrency
+    main.SESSION_RESTORE_JITTER = jitter
+    stats = ConnectStats()
+    guilds = {guild_id: fake_guild(guild_id, stats) for guild_id in range(GUILDS + 1)}
+    main.bot.get_guild = guilds.get
+    await main.restore_sessions()
+    total = time.perf_counter() - stats.started
+    assert len(main.guild_sessions) == GUILDS
+    print(
+        f"{name:>10} x{concurrency:<2} jitter {jitter:.1f}s: all restored in"
+        f" {total:5.1f} s, per guild median {statistics.median(stats.connected):5.1f} s,"
+        f" peak concurrent connects {stats.peak}"
+    )
+
+
+async def run():
+    main.logger.setLevel(logging.CRITICAL)
+    main.WARMUP_ENABLED = False
+    with tempfile.TemporaryDirectory() as directory:
+        main.SESSIONS_FILE_PREFIX = os.path.join(directory, "sessions")
+        main.write_json(f"{main.SESSIONS_FILE_PREFIX}.json", snapshot())
+        print(
+            f"{GUILDS} guilds, voice connect takes"
+            f" {CONNECT_SECONDS[0] * 1000:.0f}-{CONNECT_SECONDS[1] * 1000:.0f} ms"
+        )
+        for name, concurrency, jitter in MODES:
+            await measure(name, concurrency, jitter)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
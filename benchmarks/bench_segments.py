@@ -0,0 +1,81 @@
+"""長いメッセージを文ごとに分けて合成した場合の、最初の音声が出るまでの時間の比較
+
+合成時間が文章の長さに比例する代替サーバーに対して、同じ長文を
+1回で合成する場合 (SPLIT_MIN_CHARS=0) と文ごとに並行して合成する場合とで、
+prepare_clip が再生できるクリップを返すまでの時間と、最後の音声までの時間を測ります。
+ffmpeg が必要です。
+
+    python benchmarks/bench_segments.py
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import MockAivisServer, generate_mp3  # noqa: E402
+
+ROUNDS = 5
+LATENCY = 0.1
+LATENCY_PER_CHAR = 0.01
+SENTENCES = [
+    "今日は新しい機能のテストをしています。",
+    "長いメッセージを読み上げるときに、最初の音声が出るまでの時間を測ります。",
+    "文ごとに分けて合成すると、最初の文ができた時点で再生を始められます。",
+    "残りの文は再生している間に並行して合成されます。",
+    "最後まで聞いてくれてありがとうございました！",
+]
+
+
+async def measure(index: int) -> tuple:
+    # キャッシュに当たらないよう、回ごとに文章を変える
+    text = "".join(f"{index}、{sentence}" for sentence in SENTENCES)
+    started = time.perf_counter()
+    clip = await main.prepare_clip("bench", text, "model", 1.0, 1.0)
+    first_audio = time.perf_counter() - started
+    assert clip is not None
+    if clip.producer:
+        await clip.producer
+    return first_audio, time.perf_counter() - started
+
+
+async def run():
+    server = MockAivisServer(
+        generate_mp3(1.0), latency=LATENCY, latency_per_char=LATENCY_PER_CHAR
+    )
+    main.endpoint_pool = main.create_endpoint_pool([[await server.start()]])
+    main.speech_cache.disk_dir = None
+    main.bot.http_session = aiohttp.ClientSession()
+    split_min_chars = main.SPLIT_MIN_CHARS or 60
+    text_length = len("".join(SENTENCES))
+    try:
+        print(
+            f"{text_length} chars in {len(SENTENCES)} sentences, API latency"
+            f" {LATENCY * 1000:.0f} ms + {LATENCY_PER_CHAR * 1000:.0f} ms/char"
+        )
+        for offset, (name, split) in enumerate(
+            (("whole", 0), ("split", split_min_chars))
+        ):
+            main.SPLIT_MIN_CHARS = split
+            samples = [await measure(offset * ROUNDS + i) for i in range(ROUNDS)]
+            first = [s[0] for s in samples]
+            last = [s[1] for s in samples]
+            print(
+                f"{name:>6}: time-to-first-audio median"
+                f" {statistics.median(first) * 1000:.0f} ms,"
+                f" all audio ready {statistics.median(last) * 1000:.0f} ms"
+            )
+    finally:
+        await main.bot.http_session.close()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
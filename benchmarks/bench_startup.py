@@ -0,0 +1,113 @@
+"""起動処理の確認 (コマンド定義のハッシュによる同期の省略 / 設定の読み込み)
+
+本物のスラッシュコマンド定義からハッシュを計算し、1回目の起動では同期、
+定義が変わらない2回目の起動では同期を省略することを確認します (tree.sync は
+Discord に送らずに回数だけ数えます)。また、多数のユーザー設定・辞書を入れた
+一時的な SQLite ストアを load_settings() で読み込み、その間のイベントループの
+最大の停止時間を測ります。
+
+    python benchmarks/bench_startup.py
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+
+USERS = 20000
+GUILDS = 2000
+WORDS_PER_GUILD = 50
+
+
+async def check_sync(tree) -> None:
+    calls = []
+
+    async def fake_sync():
+        calls.append(time.perf_counter())
+        return tree.get_commands()
+
+    tree.sync = fake_sync
+    started = time.perf_counter()
+    main.command_tree_fingerprint(tree)
+    print(f"fingerprint: {(time.perf_counter() - started) * 1000:.1f} ms")
+    for boot in (1, 2):
+        synced = await main.sync_command_tree(tree)
+        print(f"boot {boot}: {'synced' if synced else 'sync skipped'}")
+    assert len(calls) == 1
+
+
+async def monitor_stall(stop: asyncio.Event) -> float:
+    """10ms ごとに起き、予定より遅れた時間の最大値を返す"""
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while not stop.is_set():
+        expected = loop.time() + 0.01
+        await asyncio.sleep(0.01)
+        worst = max(worst, loop.time() - expected)
+    return worst
+
+
+async def check_load() -> None:
+    backend = main.SQLiteBackend(main.DB_FILE)
+    backend.open()
+    backend.import_rows(
+        main.NS_USER_SETTINGS,
+        {
+            str(user): {"model_uuid": "model", "speaking_rate": 1.1}
+            for user in range(USERS)
+        },
+    )
+    backend.import_rows(
+        main.NS_DICTIONARIES,
+        {
+            str(guild): {f"word{i}": f"よみ{i}" for i in range(WORDS_PER_GUILD)}
+            for guild in range(GUILDS)
+        },
+    )
+    backend.close()
+
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_stall(stop))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await main.load_settings()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    print(
+        f"load_settings: {USERS} users, {GUILDS * WORDS_PER_GUILD} words"
+        f" in {elapsed * 1000:.0f} ms, worst event loop stall"
+        f" {await monitor * 1000:.1f} ms"
+    )
+    await main.store.close()
+
+
+async def run():
+    main.logger.setLevel(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        main.DATA_DIR = directory
+        main.DB_FILE = os.path.join(directory, "bot.db")
+        main.COMMAND_TREE_FILE = os.path.join(directory, "command_tree.json")
+        main.LEGACY_JSON_FILES = {}
+        main.store = main.SettingsStore(main.SQLiteBackend(main.DB_FILE), 0.2)
+
+        tree = main.bot.tree
+        for group in (
+            main.vc_commands,
+            main.tts_commands,
+            main.dict_commands,
+            main.setting_commands,
+        ):
+            tree.add_command(group)
+        await check_sync(tree)
+        await check_load()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,109 @@
+"""ストリーミング合成と従来の一括受信の、最初の音声が出るまでの時間の比較
+
+ローカルの代替サーバーが MP3 を少しずつ送信する条件で、
+一括受信 (request_speech → decode_to_pcm) とストリーミング (prepare_streaming_clip)
+のそれぞれで最初のPCMが得られるまでの時間を測ります。また、受信中の内容に
+別のギルドが合流してからスキップしても、元のギルドの受信が止まらないことを確認します。
+ffmpeg が必要です。
+
+    python benchmarks/bench_streaming.py
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+from mock_aivis import MockAivisServer, generate_mp3  # noqa: E402
+
+ROUNDS = 5
+AUDIO_SECONDS = 8.0
+CHUNK_SIZE = 4096
+CHUNK_INTERVAL = 0.05
+LATENCY = 0.2
+
+
+async def buffered_first_audio(index: int) -> float:
+    started = time.perf_counter()
+    audio_data = await main.request_speech(f"buffered {index}", "model", 1.0)
+    pcm = await main.decode_to_pcm(audio_data)
+    assert pcm
+    return time.perf_counter() - started
+
+
+async def streaming_first_audio(index: int) -> float:
+    started = time.perf_counter()
+    clip = await main.prepare_streaming_clip(
+        "bench", f"streaming {index}", "model", 1.0, 1.0
+    )
+    elapsed = time.perf_counter() - started
+    assert clip is not None
+    await clip.producer
+    return elapsed
+
+
+async def check_shared_stream():
+    """2つのギルドが同じ受信を共有している場合、最後の待ち手が離れたときだけ中止する"""
+    clip = await main.prepare_streaming_clip("guild-a", "shared", "model", 1.0, 1.0)
+    joined = asyncio.create_task(
+        main.prepare_clip("guild-b", "shared", "model", 1.0, 1.0)
+    )
+    await asyncio.sleep(0.1)
+    # ギルド B のスキップ (合流していた合成タスクの中止)
+    main.discard_prepare(joined)
+    await asyncio.gather(joined, return_exceptions=True)
+    await asyncio.wait((clip.producer,))
+    survived = not clip.producer.cancelled()
+    print(f"guild A stream survives guild B skip: {survived}")
+    assert survived
+
+    clip = await main.prepare_streaming_clip("guild-a", "shared 2", "model", 1.0, 1.0)
+    main.release_clip(clip)
+    await asyncio.wait((clip.producer,))
+    print(
+        f"stream cancelled when its last consumer leaves: {clip.producer.cancelled()}"
+    )
+    assert clip.producer.cancelled()
+    assert not main.speech_cache._waiters
+
+
+async def run():
+    server = MockAivisServer(
+        generate_mp3(AUDIO_SECONDS),
+        latency=LATENCY,
+        chunk_size=CHUNK_SIZE,
+        chunk_interval=CHUNK_INTERVAL,
+    )
+    main.endpoint_pool = main.create_endpoint_pool([[await server.start()]])
+    main.speech_cache.disk_dir = None
+    main.bot.http_session = aiohttp.ClientSession()
+    try:
+        print(
+            f"payload {len(server.audio)} bytes, {CHUNK_SIZE} B every"
+            f" {CHUNK_INTERVAL * 1000:.0f} ms, {LATENCY * 1000:.0f} ms latency"
+        )
+        for name, measure in (
+            ("buffered", buffered_first_audio),
+            ("streaming", streaming_first_audio),
+        ):
+            samples = [await measure(i) for i in range(ROUNDS)]
+            print(
+                f"{name:>10}: time-to-first-audio median"
+                f" {statistics.median(samples) * 1000:.0f} ms"
+                f" (min {min(samples) * 1000:.0f} / max {max(samples) * 1000:.0f})"
+            )
+        await check_shared_stream()
+    finally:
+        await main.bot.http_session.close()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,388 @@
+"""Discord も Aivis API も使わない、エンドツーエンドの負荷試験
+
+偽のギルド・チャンネル・メッセージ・VoiceClient で on_message / on_voice_state_update /
+process_text_for_speech / audio_player_task を実際に動かし、合成は別プロセスで起動した
+代替サーバー (mock_aivis.py) に送ります。ギルド数ごとに次の値を出力します。
+
+- throughput: 1秒あたりに再生が始まった発言数 (入退室の通知を含む)
+- queue latency: メッセージを受け取ってから再生が始まるまでの時間の分位点
+- CPU: Bot プロセスの CPU 使用率と、ffmpeg (子プロセス) の CPU 時間
+- memory: Bot プロセスの最大 RSS
+- event loop lag: イベントループの遅延の p99
+
+    python benchmarks/load_test.py                        # 1 / 100 / 1000 ギルド
+    python benchmarks/load_test.py --guilds 100 --latency 0.5 --error-rate 0.05
+
+ギルド数ごとに別プロセスで実行するため、メモリの値は互いに影響しません。
+ffmpeg が必要です。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import _env  # noqa: E402,F401  (DATA_DIR を一時ディレクトリにする)
+import main  # noqa: E402
+
+FRAME_INTERVAL = 0.02
+WORDS = [
+    "こんにちは",
+    "テスト",
+    "読み上げ",
+    "今日は",
+    "いい天気",
+    "ですね",
+    "了解",
+    "www",
+]
+
+
+class FakeObject:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeAudioDriver(threading.Thread):
+    """全ギルドの音声ソースを 20ms ごとに1フレームずつ読む。
+
+    discord.py は VC ごとに再生スレッドを持つが、1000 ギルド分のスレッドを作ると
+    試験する側の負荷が大きくなるため、1本のスレッドでまとめて読む。
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._players = {}
+        self._lock = threading.Lock()
+        self._running = True
+        self.frames = 0
+
+    def play(self, client, source, after):
+        with self._lock:
+            self._players[client] = (source, after)
+
+    def stop_client(self, client):
+        with self._lock:
+            player = self._players.pop(client, None)
+        if player:
+            player[1](None)
+
+    def is_playing(self, client) -> bool:
+        with self._lock:
+            return client in self._players
+
+    def shutdown(self):
+        self._running = False
+
+    def run(self):
+        next_tick = time.perf_counter()
+        while self._running:
+            with self._lock:
+                players = [
+                    (client, source, after)
+                    for client, (source, after) in self._players.items()
+                    if not client.paused
+                ]
+            for client, source, after in players:
+                if source.read():
+                    self.frames += 1
+                    continue
+                with self._lock:
+                    if self._players.get(client, (None,))[0] is source:
+                        del self._players[client]
+                after(None)
+            next_tick += FRAME_INTERVAL
+            time.sleep(max(0.0, next_tick - time.perf_counter()))
+
+
+class FakeVoiceClient:
+    latency = 0.05
+
+    def __init__(self, driver: FakeAudioDriver, channel: FakeObject):
+        self.driver = driver
+        self.channel = channel
+        self.paused = False
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self.driver.is_playing(self) and not self.paused
+
+    def is_paused(self) -> bool:
+        return self.driver.is_playing(self) and self.paused
+
+    def play(self, source, after=None):
+        self.paused = False
+        self.driver.play(self, source, after or (lambda error: None))
+
+    def stop(self):
+        self.driver.stop_client(self)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args: argparse.Namespace) -> (subprocess.Popen, str):
+    """代替サーバーを別プロセスで起動し、受け付けを始めるまで待つ"""
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH_DIR, "mock_aivis.py"),
+            "--port",
+            str(port),
+            "--seconds",
+            str(args.audio_seconds),
+            "--latency",
+            str(args.latency),
+            "--chunk-interval",
+            str(args.chunk_interval),
+            "--error-rate",
+            str(args.error_rate),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process, f"http://127.0.0.1:{port}/v1/tts/synthesize"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("mock Aivis server did not start")
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def random_text(rng: random.Random, index: int) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 8))]
+    return f"{''.join(words)} {index}"
+
+
+async def send_messages(guild, channel, rate: float, stop: asyncio.Event, counter):
+    rng = random.Random(guild.id)
+    index = 0
+    while not stop.is_set():
+        await asyncio.sleep(rng.expovariate(rate))
+        index += 1
+        content = random_text(rng, index)
+        if rng.random() < 0.05:
+            content += " https://example.com/page"
+        message = FakeObject(
+            author=FakeObject(bot=False, id=rng.randint(1, 20)),
+            guild=guild,
+            channel=channel,
+            content=content,
+            clean_content=content,
+            attachments=[],
+        )
+        await main.on_message(message)
+        counter["messages"] += 1
+
+
+async def send_voice_events(guild, voice_channel, rate: float, stop: asyncio.Event):
+    rng = random.Random(-guild.id)
+    outside = FakeObject(id=-1)
+    while not stop.is_set():
+        await asyncio.sleep(rng.expovariate(rate))
+        member = FakeObject(bot=False, id=rng.randint(1, 20), guild=guild)
+        member.display_name = f"user{member.id}"
+        joined = rng.random() < 0.5
+        before = FakeObject(channel=outside if joined else voice_channel)
+        after = FakeObject(channel=voice_channel if joined else outside)
+        await main.on_voice_state_update(member, before, after)
+
+
+async def run_scenario(args: argparse.Namespace) -> dict:
+    main.logger.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    mock, url = start_mock_server(args)
+    main.endpoint_pool = main.create_endpoint_pool([[url]])
+    main.speech_cache.disk_dir = None
+    main.synthesis_scheduler = main.SynthesisScheduler(
+        args.api_rate, int(args.api_rate), args.api_concurrency, {}
+    )
+
+    # 再生開始までの時間とイベントループの遅延を、メトリクスの記録から受け取る
+    latencies, lags = [], []
+    observe = main.metrics.observe
+
+    def record(name, value, label=""):
+        if name == "end_to_end_seconds":
+            latencies.append(value)
+        elif name == "event_loop_lag_seconds":
+            lags.append(value)
+        observe(name, value, label)
+
+    main.metrics.observe = record
+
+    driver = FakeAudioDriver()
+    driver.start()
+    main.bot.http_session = aiohttp.ClientSession()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    counter = {"messages": 0}
+    tasks = [asyncio.create_task(main.monitor_event_loop_lag())]
+    for guild_index in range(args.guilds):
+        guild = FakeObject(id=guild_index + 1)
+        text_channel = FakeObject(id=100_000 + guild_index)
+        voice_channel = FakeObject(id=200_000 + guild_index)
+        session = main.GuildSession(loop, str(guild.id))
+        session.voice_client = FakeVoiceClient(driver, voice_channel)
+        session.text_channel_id = text_channel.id
+        main.guild_sessions[str(guild.id)] = session
+        tasks.append(
+            asyncio.create_task(
+                send_messages(guild, text_channel, args.rate, stop, counter)
+            )
+        )
+        tasks.append(
+            asyncio.create_task(
+                send_voice_events(guild, voice_channel, args.rate / 10, stop)
+            )
+        )
+
+    cpu_started = time.process_time()
+    children_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    played = len(latencies)
+    failed = main.metrics._counters["failed_items_total"][""]
+    dropped = sum(main.metrics._counters["dropped_items_total"].values())
+
+    for task in tasks:
+        task.cancel()
+    for session in main.guild_sessions.values():
+        session.stop()
+    # 中止した合成やデコードが後片付けを終えるまで待つ
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    if pending:
+        await asyncio.wait(pending, timeout=10)
+    driver.shutdown()
+    await main.bot.http_session.close()
+    mock.terminate()
+    mock.wait()
+
+    return {
+        "guilds": args.guilds,
+        "messages": counter["messages"],
+        "played": played,
+        "throughput": played / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "failed": failed,
+        "dropped": dropped,
+        "api_requests": main.speech_cache.misses,
+        "cpu_percent": cpu / elapsed * 100,
+        "ffmpeg_cpu_seconds": (children.ru_utime + children.ru_stime)
+        - (children_started.ru_utime + children_started.ru_stime),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "loop_lag_p99": percentile(lags, 0.99),
+    }
+
+
+def print_table(results: list):
+    print(
+        f"{'guilds':>6} {'msgs':>6} {'played':>6} {'msg/s':>7}"
+        f" {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'failed':>6} {'dropped':>7}"
+        f" {'cpu %':>6} {'ffmpeg s':>8} {'rss MB':>7} {'lag p99':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['guilds']:>6} {r['messages']:>6} {r['played']:>6}"
+            f" {r['throughput']:>7.1f} {r['latency_p50'] * 1000:>7.0f}"
+            f" {r['latency_p95'] * 1000:>7.0f} {r['latency_p99'] * 1000:>7.0f}"
+            f" {r['failed']:>6.0f} {r['dropped']:>7.0f} {r['cpu_percent']:>6.1f}"
+            f" {r['ffmpeg_cpu_seconds']:>8.1f} {r['max_rss_mb']:>7.0f}"
+            f" {r['loop_lag_p99'] * 1000:>6.0f}ms"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--guilds", default="1,100,1000", help="ギルド数 (カンマ区切りで複数)"
+    )
+    parser.add_argument("--duration", type=float, default=20.0, help="試験する秒数")
+    parser.add_argument(
+        "--rate", type=float, default=0.1, help="ギルドごとの1秒あたりのメッセージ数"
+    )
+    parser.add_argument("--latency", type=float, default=0.2, help="API の応答遅延")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返す割合")
+    parser.add_argument(
+        "--audio-seconds", type=float, default=2.0, help="応答する音声の長さ"
+    )
+    parser.add_argument("--chunk-interval", type=float, default=0.0)
+    parser.add_argument(
+        "--api-rate", type=float, default=1000.0, help="Bot 側の API 呼び出し上限/秒"
+    )
+    parser.add_argument("--api-concurrency", type=int, default=256)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    parser.add_argument("--verbose", action="store_true", help="Bot のログを出力")
+    return parser.parse_args()
+
+
+def main_entry():
+    args = parse_args()
+    counts = [int(count) for count in args.guilds.split(",")]
+    if len(counts) == 1:
+        args.guilds = counts[0]
+        result = asyncio.run(run_scenario(args))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_table([result])
+        return
+
+    # ギルド数ごとに新しいプロセスで測る
+    passthrough = [arg for arg in sys.argv[1:] if not arg.startswith("--guilds")]
+    if "--guilds" in sys.argv:
+        index = sys.argv.index("--guilds")
+        passthrough = sys.argv[1:index] + sys.argv[index + 2 :]
+    results = []
+    for count in counts:
+        output = subprocess.run(
+            [sys.executable, __file__, "--guilds", str(count), "--json"] + passthrough,
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main_entry()
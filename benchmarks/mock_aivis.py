@@ -0,0 +1,237 @@
+"""Aivis API (/v1/tts/synthesize) のローカル代替サーバー
+
+ベンチマークや負荷試験で、本物の API を使わずに合成処理を動かすためのものです。
+応答までの遅延・チャンクの送信間隔に加え、500 / 429 / 極端な遅延 / 途中切断といった
+障害を指定した割合で発生させられます。
+
+    python benchmarks/mock_aivis.py --port 8080 --latency 0.3 --chunk-interval 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+
+from aiohttp import web
+
+FFMPEG_EXECUTABLE = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+
+def generate_audio(seconds: float, audio_format: str = "mp3") -> bytes:
+    """ffmpeg で指定秒数のサイン波の音声 (mp3 / wav) を作る"""
+    result = subprocess.run(
+        [
+            FFMPEG_EXECUTABLE,
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:sample_rate=44100:duration={seconds}",
+            "-f",
+            audio_format,
+            "pipe:1",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return result.stdout
+
+
+def generate_mp3(seconds: float) -> bytes:
+    return generate_audio(seconds, "mp3")
+
+
+class MockAivisServer:
+    def __init__(
+        self,
+        audio: bytes,
+        latency: float = 0.0,
+        chunk_size: int = 4096,
+        chunk_interval: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        slow_rate: float = 0.0,
+        slow_delay: float = 5.0,
+        drop_rate: float = 0.0,
+        wav_audio: bytes = None,
+        latency_per_char: float = 0.0,
+    ):
+        self.audio = audio
+        self.wav_audio = wav_audio  # output_format が wav のリクエストに返す音声
+        self.latency_per_char = latency_per_char  # 文章の長さに比例する合成時間
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.drop_rate = drop_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner: web.AppRunner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """サーバーを起動し、合成エンドポイントの URL を返す"""
+        app = web.Application()
+        app.router.add_post("/v1/tts/synthesize", self.handle_synthesize)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1/tts/synthesize"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle_synthesize(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        payload = await request.json()
+        latency = self.latency + self.latency_per_char * len(payload.get("text", ""))
+        if random.random() < self.slow_rate:
+            latency += self.slow_delay
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text="injected error")
+        if random.random() < self.rate_limit_rate:
+            self.errors += 1
+            return web.Response(
+                status=429,
+                text="injected rate limit",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+        audio, content_type = self.audio, "audio/mpeg"
+        if payload.get("output_format") == "wav" and self.wav_audio:
+            audio, content_type = self.wav_audio, "audio/wav"
+        drop_at = len(audio) // 2 if random.random() < self.drop_rate else None
+        response = web.StreamResponse(headers={"Content-Type": content_type})
+        response.content_length = len(audio)
+        try:
+            await response.prepare(request)
+            for offset in range(0, len(audio), self.chunk_size):
+                if drop_at is not None and offset >= drop_at:
+                    # 本文の途中で接続を切る
+                    self.errors += 1
+                    request.transport.close()
+                    return response
+                await response.write(audio[offset : offset + self.chunk_size])
+                if self.chunk_interval:
+                    await asyncio.sleep(self.chunk_interval)
+        except ConnectionResetError:
+            # クライアント側が中止した (ヘッジの取り消しなど)
+            return response
+        await response.write_eof()
+        return response
+
+
+class MockEngineServer:
+    """AivisSpeech Engine 互換のローカル合成サーバー (/audio_query → /synthesis)"""
+
+    def __init__(
+        self,
+        wav_audio: bytes,
+        latency: float = 0.0,
+        latency_per_char: float = 0.0,
+        error_rate: float = 0.0,
+    ):
+        self.wav_audio = wav_audio
+        self.latency = latency  # /synthesis の合成時間
+        self.latency_per_char = latency_per_char
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner: web.AppRunner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """サーバーを起動し、ベース URL を返す"""
+        app = web.Application()
+        app.router.add_post("/audio_query", self.handle_audio_query)
+        app.router.add_post("/synthesis", self.handle_synthesis)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle_audio_query(self, request: web.Request) -> web.Response:
+        text = request.query.get("text", "")
+        return web.json_response({"kana": text, "speedScale": 1.0})
+
+    async def handle_synthesis(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        query = await request.json()
+        await asyncio.sleep(
+            self.latency + self.latency_per_char * len(query.get("kana", ""))
+        )
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text="injected error")
+        return web.Response(body=self.wav_audio, content_type="audio/wav")
+
+
+async def serve(args: argparse.Namespace):
+    server = MockAivisServer(
+        generate_mp3(args.seconds),
+        latency=args.latency,
+        chunk_size=args.chunk_size,
+        chunk_interval=args.chunk_interval,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+        drop_rate=args.drop_rate,
+        wav_audio=generate_audio(args.seconds, "wav"),
+        latency_per_char=args.latency_per_char,
+    )
+    url = await server.start(args.host, args.port)
+    print(f"Mock Aivis API listening on {url}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--seconds", type=float, default=3.0, help="音声の長さ")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答開始までの秒数")
+    parser.add_argument(
+        "--latency-per-char", type=float, default=0.0, help="1文字あたりの合成時間"
+    )
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument(
+        "--chunk-interval", type=float, default=0.0, help="チャンクごとの送信間隔"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返す割合")
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0.0, help="429を返す割合"
+    )
+    parser.add_argument(
+        "--slow-rate", type=float, default=0.0, help="極端に遅く応答する割合"
+    )
+    parser.add_argument("--slow-delay", type=float, default=5.0)
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.0, help="本文の途中で切断する割合"
+    )
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,154 +2,3720 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import os
+import atexit
 import asyncio
 import aiohttp
-import io
+from aiohttp import web
 import re
 import json
+import time
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import audioop
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from typing import Dict, Optional
+
+try:
+    import redis  # STORE_BACKEND=redis のときだけ必要
+except ImportError:
+    redis = None
+try:
+    import numpy as np  # 無い場合、WAV の変換は audioop で行う
+except ImportError:
+    np = None
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
 
 # --- 定数定義 ---
+def parse_voice_map(value: str) -> Dict[str, str]:
+    """ "キー:値,キー:値" 形式の設定を辞書にする"""
+    return {
+        key.strip(): voice.strip()
+        for key, voice in (
+            entry.split(":", 1) for entry in value.split(",") if ":" in entry
+        )
+    }
+
+
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 AIVIS_API_KEY = os.getenv("AIVIS_API_KEY")
 DEFAULT_MODEL_UUID = os.getenv(
     "AIVIS_MODEL_UUID", "a59cb814-0083-4369-8542-f51a29e72af7"
 )
+AIVIS_API_URL = os.getenv(
+    "AIVIS_API_URL", "https://api.aivis-project.com/v1/tts/synthesize"
+)
+# 合成結果を受信しながら再生を始める (キャッシュに無い場合のみ)
+# 合成APIに要求する音声形式。wav は ffmpeg を使わずにプロセス内で変換する
+AIVIS_OUTPUT_FORMAT = os.getenv("AIVIS_OUTPUT_FORMAT", "mp3").lower()
+if AIVIS_OUTPUT_FORMAT not in ("mp3", "wav"):
+    AIVIS_OUTPUT_FORMAT = "mp3"
+STREAMING_SYNTHESIS = os.getenv("STREAMING_SYNTHESIS", "true").lower() == "true"
+STREAM_CHUNK_SIZE = 4096
+# この文字数以上のメッセージは文ごとに分けて並行して合成し、最初の文から再生する (0 で無効)
+SPLIT_MIN_CHARS = int(os.getenv("SPLIT_MIN_CHARS", "60"))
+SEGMENT_MIN_CHARS = 15  # これより短い文は次の文とまとめて1回で合成する
+SEGMENT_CONCURRENCY = 3  # 1メッセージあたりの同時合成数
+# 文末 (。！？!? と改行。"." は URL や小数と区別するため後ろが空白か末尾のときだけ)
+SENTENCE_PATTERN = re.compile(r".*?(?:[。！？!?]+|\.+(?=\s|$)|\n|$)")
+
+# 辞書・設定・キャッシュなどの実行時ファイルの保存先
+DATA_DIR = os.getenv("DATA_DIR", "data")
+DICT_FILE = f"{DATA_DIR}/dictionaries.json"
+SETTINGS_FILE = f"{DATA_DIR}/user_settings.json"
+GUILD_SETTINGS_FILE = f"{DATA_DIR}/guild_settings.json"
+DB_FILE = f"{DATA_DIR}/bot.db"
+# 最後に Discord に同期したスラッシュコマンド定義のハッシュ
+COMMAND_TREE_FILE = f"{DATA_DIR}/command_tree.json"
+# スラッシュコマンドの同期 ("auto": 定義が変わったときだけ / "always": 毎回)
+COMMAND_SYNC = os.getenv("COMMAND_SYNC", "auto").lower()
+
+# SQLiteストアの名前空間 (旧JSONファイルと1対1に対応)
+NS_DICTIONARIES = "dictionaries"
+NS_USER_SETTINGS = "user_settings"
+NS_GUILD_SETTINGS = "guild_settings"
+LEGACY_JSON_FILES = {
+    NS_DICTIONARIES: DICT_FILE,
+    NS_USER_SETTINGS: SETTINGS_FILE,
+    NS_GUILD_SETTINGS: GUILD_SETTINGS_FILE,
+}
+# 書き込みをまとめるまでの待ち時間 (秒)
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "0.2"))
+
+# シャーディング (SHARD_COUNT=0 なら Discord の推奨数を使う)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+# シャードを分担して動かすワーカープロセス数
+WORKER_PROCESSES = max(1, int(os.getenv("WORKER_PROCESSES", "1")))
+WORKER_RESTART_DELAY = 5.0
+# ワーカープロセスとして起動された場合の番号 (親プロセスが設定する)
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None
+# 設定の保存先 ("sqlite" / "redis")。複数プロセスで同じ保存先を共有する
+STORE_BACKEND = os.getenv("STORE_BACKEND", "sqlite").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# 他のプロセスでの設定変更を確認する間隔 (秒, 0 で確認しない)
+STORE_SYNC_INTERVAL = float(
+    os.getenv("STORE_SYNC_INTERVAL", "1.0" if WORKER_PROCESSES > 1 else "0")
+)
+
+# 読み上げが無い状態 / VCに人がいない状態がこの秒数続いたら自動で退出する (0 で無効)
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+SESSION_EMPTY_TIMEOUT = float(os.getenv("SESSION_EMPTY_TIMEOUT", "60"))
+SESSION_REAP_INTERVAL = 15.0
+
+# 再起動しても読み上げを続けられるよう、接続中のセッションを保存して起動時に再接続する
+SESSION_RESTORE = os.getenv("SESSION_RESTORE", "true").lower() == "true"
+SESSION_RESTORE_QUEUE = os.getenv("SESSION_RESTORE_QUEUE", "true").lower() == "true"
+SESSION_SNAPSHOT_INTERVAL = float(os.getenv("SESSION_SNAPSHOT_INTERVAL", "30"))
+# これより古い保存内容は使わない (長く止まっていた場合に突然参加しないように)
+SESSION_RESTORE_MAX_AGE = float(os.getenv("SESSION_RESTORE_MAX_AGE", "900"))
+# Discord の音声ゲートウェイに接続が集中しないよう、同時接続数を絞り、開始をずらす
+SESSION_RESTORE_CONCURRENCY = int(os.getenv("SESSION_RESTORE_CONCURRENCY", "5"))
+SESSION_RESTORE_JITTER = float(os.getenv("SESSION_RESTORE_JITTER", "1.0"))
+SESSION_RESTORE_TIMEOUT = 20.0
+# ワーカーごとに別のファイルに保存し、起動時はすべてのファイルから自分の担当分を戻す
+SESSIONS_FILE_PREFIX = f"{DATA_DIR}/sessions"
+SESSIONS_FILE = (
+    f"{SESSIONS_FILE_PREFIX}.json"
+    if WORKER_INDEX is None
+    else f"{SESSIONS_FILE_PREFIX}.{WORKER_INDEX}.json"
+)
+
+# 個人設定が無いユーザーの読み上げ速度
+DEFAULT_SPEAKING_RATE = 1.1
+
+# VC参加直後に、入退室の通知と定型文を先に合成しておく
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_MAX_MEMBERS = int(os.getenv("WARMUP_MAX_MEMBERS", "10"))
+WARMUP_CONCURRENCY = 2  # 通常の読み上げの合成を待たせないよう、同時に合成する数を絞る
+WARMUP_PHRASES = ("URL", "添付ファイル")
+
+# 再生中に先読み(合成)しておくキューの件数
+DEFAULT_PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "2"))
+MAX_PREFETCH_COUNT = 5
+
+# 再生するPCMの形式 (discord.py の Opus エンコーダーに合わせた 48kHz/16bit/ステレオ, 20ms)
+PCM_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+PCM_SILENCE = b"\x00" * PCM_FRAME_SIZE
+PCM_SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+PCM_CHANNELS = discord.opus.Encoder.CHANNELS
+# 再生するものが無くなってから、VCの再生を止めるまでの無音時間 (秒)
+AUDIO_IDLE_LINGER = float(os.getenv("AUDIO_IDLE_LINGER", "3.0"))
+FFMPEG_EXECUTABLE = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+# Aivis API の呼び出し制御 (プロセス全体で共有。契約プランの上限に合わせて設定する)
+AIVIS_RATE_LIMIT = float(os.getenv("AIVIS_RATE_LIMIT", "5"))  # 1秒あたりのリクエスト数
+AIVIS_RATE_BURST = int(os.getenv("AIVIS_RATE_BURST", "10"))
+AIVIS_MAX_CONCURRENCY = int(os.getenv("AIVIS_MAX_CONCURRENCY", "8"))
+# 使っていない API への接続を閉じるまでの秒数 (次の合成で接続し直さずに済むように)
+AIVIS_KEEPALIVE_TIMEOUT = float(os.getenv("AIVIS_KEEPALIVE_TIMEOUT", "60"))
+# 1回のリクエストの制限時間 / 再送を含めた全体の制限時間 (秒)
+AIVIS_REQUEST_TIMEOUT = float(os.getenv("AIVIS_REQUEST_TIMEOUT", "15"))
+AIVIS_DEADLINE = float(os.getenv("AIVIS_DEADLINE", "30"))
+# 一時的なエラー (429/5xx/タイムアウト/接続エラー) のときに再送する回数と基準待ち時間
+AIVIS_MAX_RETRIES = int(os.getenv("AIVIS_MAX_RETRIES", "2"))
+AIVIS_RETRY_BASE_DELAY = 0.5
+# 応答が p95 の所要時間を超えたら2本目のリクエストを並行して送る (ヘッジ)
+AIVIS_HEDGE = os.getenv("AIVIS_HEDGE", "true").lower() == "true"
+AIVIS_HEDGE_DEFAULT_DELAY = 1.0  # 所要時間の実績が少ないときのヘッジ開始時間
+# 連続でこの回数失敗したら、一定時間 API を呼ばずに即失敗させる (サーキットブレーカー)
+AIVIS_CIRCUIT_THRESHOLD = int(os.getenv("AIVIS_CIRCUIT_THRESHOLD", "5"))
+AIVIS_CIRCUIT_RESET = float(os.getenv("AIVIS_CIRCUIT_RESET", "30"))
+# 公平キューイングでのギルドごとの重み (例: "123456789:2,987654321:0.5")
+AIVIS_GUILD_WEIGHTS = {
+    guild_id.strip(): float(weight)
+    for guild_id, weight in (
+        entry.split(":", 1)
+        for entry in os.getenv("AIVIS_GUILD_WEIGHTS", "").split(",")
+        if ":" in entry
+    )
+}
+# 複数の接続先・APIキーに振り分ける ("URL|APIキー|重み|同時実行数" をカンマ区切り。
+# APIキー以降は省略可)。未指定なら AIVIS_API_URL と AIVIS_API_KEY だけを使う
+AIVIS_ENDPOINTS = [
+    entry.strip().split("|")
+    for entry in os.getenv("AIVIS_ENDPOINTS", "").split(",")
+    if entry.strip()
+]
+# 接続先を一時的に外す条件 (連続失敗回数 / 他の接続先の中央値の何倍遅いか) と外す秒数
+AIVIS_ENDPOINT_FAILURES = int(os.getenv("AIVIS_ENDPOINT_FAILURES", "3"))
+AIVIS_ENDPOINT_SLOW_FACTOR = float(os.getenv("AIVIS_ENDPOINT_SLOW_FACTOR", "3"))
+AIVIS_ENDPOINT_EJECT = float(os.getenv("AIVIS_ENDPOINT_EJECT", "10"))
+AIVIS_ENDPOINT_MAX_EJECT = 300.0  # 繰り返し外されるたびに延ばす場合の上限
+
+# 任意: 同じLAN上などで動かす AivisSpeech Engine 互換の合成サーバー (未指定なら使わない)
+TTS_LOCAL_URL = os.getenv("TTS_LOCAL_URL", "").rstrip("/")
+# 声の対応 ("モデルUUID:値" をカンマ区切り)。ローカルはスタイルID ("*" で既定)、
+# クラウドは置き換えるモデルUUID (未指定のモデルはそのまま使う)
+TTS_LOCAL_SPEAKERS = parse_voice_map(os.getenv("TTS_LOCAL_SPEAKERS", ""))
+TTS_CLOUD_MODELS = parse_voice_map(os.getenv("TTS_CLOUD_MODELS", ""))
+# この文字数以下の文章と通知はローカルを優先する。同時実行数を超えた分はクラウドに回す
+TTS_LOCAL_MAX_CHARS = int(os.getenv("TTS_LOCAL_MAX_CHARS", "40"))
+TTS_LOCAL_CONCURRENCY = int(os.getenv("TTS_LOCAL_CONCURRENCY", "2"))
+# 合成がこの秒数を超えたら、次の実行先でも並行して合成し、先に終わった方を使う (0 で無効)
+TTS_LOCAL_BUDGET = float(os.getenv("TTS_LOCAL_BUDGET", "1.5"))
+TTS_CLOUD_BUDGET = float(os.getenv("TTS_CLOUD_BUDGET", "5"))
+
+# 連投された短いメッセージを1回の合成にまとめる (待ち時間 0 で無効)
+COALESCE_LINGER = float(os.getenv("COALESCE_LINGER", "0.3"))  # 次の発言を待つ秒数
+COALESCE_MAX_HOLD = 1.0  # まとめ続ける場合でも、最初の発言からこれ以上は待たない
+COALESCE_MAX_CHARS = int(os.getenv("COALESCE_MAX_CHARS", "100"))
+COALESCE_SEPARATOR = "、"
+
+# 再生待ちキューの上限 (サーバーごとに /tts limit で変更可)
+DEFAULT_QUEUE_MAX_ITEMS = int(os.getenv("QUEUE_MAX_ITEMS", "50"))
+DEFAULT_QUEUE_MAX_CHARS = int(os.getenv("QUEUE_MAX_CHARS", "3000"))
+DEFAULT_QUEUE_MAX_SECONDS = int(os.getenv("QUEUE_MAX_SECONDS", "300"))
+DEFAULT_OVERFLOW_POLICY = os.getenv("QUEUE_OVERFLOW_POLICY", "summarize")
+# 同じサーバー内での発言者ごとの公平さ (1巡で1人が読み上げられる文字数の目安、1以上)
+QUEUE_FAIR_QUANTUM = max(1, int(os.getenv("QUEUE_FAIR_QUANTUM", "100")))
+# 入退室の通知は、この秒数以上待たされたら読み上げずに捨てる (0 で無効)
+NOTICE_MAX_AGE = float(os.getenv("NOTICE_MAX_AGE", "20"))
+OVERFLOW_POLICIES = {
+    "drop_oldest": "古いメッセージから削除",
+    "drop_newest": "新しいメッセージを破棄",
+    "summarize": "「他N件のメッセージ」にまとめる",
+}
+# 再生時間の見積もりに使う、速度 1.0 での1秒あたりの文字数
+CHARS_PER_SECOND = 7.0
+
+# ログ (LOG_LEVEL=DEBUG で詳細ログ、LOG_FORMAT=json で1行1JSON)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# sample=True のログ (メッセージごとの詳細ログ) は、この秒数あたりこの件数までに間引く
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", "10"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))
+
+# Prometheus 形式のメトリクスを返す HTTP サーバー (ポート 0 で無効)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# 合成音声キャッシュ (メモリ: LRU / ディスク: DATA_DIR 以下)
+AUDIO_CACHE_DIR = f"{DATA_DIR}/audio_cache"
+AUDIO_CACHE_MEMORY_MB = int(os.getenv("AUDIO_CACHE_MEMORY_MB", "64"))
+AUDIO_CACHE_DISK_MB = int(os.getenv("AUDIO_CACHE_DISK_MB", "512"))
+AUDIO_CACHE_DISK_ENABLED = os.getenv("AUDIO_CACHE_DISK", "true").lower() == "true"
+
+# 絵文字 (変更なし)
+EMOJI_SUCCESS = "✅"
+EMOJI_ERROR = "❌"
+EMOJI_INFO = "ℹ️"
+EMOJI_VC = "🔊"
+EMOJI_TTS = "💬"
+EMOJI_DICT = "📖"
+EMOJI_SETTING = "⚙️"
+EMOJI_HELP = "🤖"
+EMOJI_WAVE = "👋"
+EMOJI_QUEUE = "🎵"
+EMOJI_MUTE = "🔇"
+EMOJI_PAUSE = "⏸️"
+EMOJI_RESUME = "▶️"
+
+
+# --- ログ ---
+logger = logging.getLogger("aivis_tts")
+
+
+class LogSampler(logging.Filter):
+    """sample=True で出力されたログを、同じ文面・ギルドごとに間引く。
+
+    interval 秒あたり burst 件までを通し、間引いた件数は次に通すログに付け足す。
+    """
+
+    def __init__(self, interval: float, burst: int):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (文面, ギルドID) -> [区間の開始時刻, 通した件数, 間引いた件数]
+        self._windows: Dict[Tuple[str, Optional[str]], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False):
+            return True
+        now = record.created
+        key = (record.msg, getattr(record, "guild_id", None))
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if len(self._windows) > 10000:
+                self._windows = {
+                    k: w for k, w in self._windows.items() if now - w[0] < self.interval
+                }
+            suppressed = window[2] if window else 0
+            window = self._windows[key] = [now, 0, suppressed]
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        if window[2]:
+            record.msg = f"{record.msg} (%d similar suppressed)"
+            record.args = (record.args or ()) + (window[2],)
+            window[2] = 0
+        return True
+
+
+class GuildContextFilter(logging.Filter):
+    """discord.py など、guild_id を持たないログにも既定値を入れる"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "guild_id", None) is None:
+            record.guild_id = "GLOBAL"
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "guild_id": record.guild_id,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """レコードを整形せずにキューに積む QueueHandler。
+
+    標準の prepare() は呼び出し側のスレッドで本文と例外を整形し、exc_info を消してしまう。
+    ここでは複製だけを積み、整形 (トレースバックの文字列化を含む) は書き出しスレッドの
+    ハンドラーに任せる。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return logging.makeLogRecord(record.__dict__)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """ログの書き出しを専用スレッドに任せる。
+
+    呼び出し側ではレベル判定と間引きだけを行い、整形前のレコードをキューに積んで戻る。
+    """
+    output = logging.StreamHandler(sys.stdout)
+    output.addFilter(GuildContextFilter())
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s [%(guild_id)s] %(message)s")
+        )
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogSampler(LOG_SAMPLE_INTERVAL, LOG_SAMPLE_BURST))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_event(
+    level: int,
+    guild_id: Optional[str],
+    message: str,
+    *args,
+    sample: bool = False,
+    exc_info: bool = False,
+):
+    """ログを出力する。message は args で遅延整形され、無効なレベルなら何もしない"""
+    if logger.isEnabledFor(level):
+        logger.log(
+            level,
+            message,
+            *args,
+            exc_info=exc_info,
+            extra={"guild_id": guild_id, "sample": sample},
+        )
+
+
+def log_debug(guild_id: Optional[str], message: str, *args, **kwargs):
+    log_event(logging.DEBUG, guild_id, message, *args, **kwargs)
+
+
+def log_info(guild_id: Optional[str], message: str, *args, **kwargs):
+    log_event(logging.INFO, guild_id, message, *args, **kwargs)
+
+
+def log_warning(guild_id: Optional[str], message: str, *args, **kwargs):
+    log_event(logging.WARNING, guild_id, message, *args, **kwargs)
+
+
+def log_error(guild_id: Optional[str], message: str, *args, **kwargs):
+    log_event(logging.ERROR, guild_id, message, *args, **kwargs)
+
+
+# --- データクラス ---
+def _resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SpeechItem(NamedTuple):
+    """再生キューに入る1発話分の情報"""
+
+    text: str
+    model_uuid: str
+    speaking_rate: float
+    volume: float
+    # "message" / "notice" (入退室の通知) / "overflow" (あふれたメッセージの件数通知)
+    kind: str = "message"
+    overflow_count: int = 0
+    # メッセージを受け取った時刻 (time.monotonic()、0 なら計測しない)
+    created_at: float = 0.0
+    # 発言者 (通知の場合は入退室したメンバー)。公平な順番の決定に使う
+    user_id: str = ""
+
+    @property
+    def estimated_seconds(self) -> float:
+        return len(self.text) / (CHARS_PER_SECOND * self.speaking_rate)
+
+    def can_merge(self, other: "SpeechItem") -> bool:
+        return (
+            self.kind == other.kind == "message"
+            and self.user_id == other.user_id
+            and self.model_uuid == other.model_uuid
+            and self.speaking_rate == other.speaking_rate
+            and self.volume == other.volume
+            and len(self.text) + len(COALESCE_SEPARATOR) + len(other.text)
+            <= COALESCE_MAX_CHARS
+        )
+
+    def merge(self, other: "SpeechItem") -> "SpeechItem":
+        return self._replace(text=f"{self.text}{COALESCE_SEPARATOR}{other.text}")
+
+
+class QueueLimits(NamedTuple):
+    max_items: int
+    max_chars: int
+    max_seconds: float
+    overflow_policy: str
+
+
+class SpeechQueue:
+    """再生待ちの発言のキュー。
+
+    入退室の通知を最優先にし、メッセージは発言者ごとの列から Deficit Round Robin で
+    取り出す (1人が長文を連投しても、他の人は1巡待てば読み上げられる)。
+    件数・文字数・推定再生時間の上限を持ち、あふれたときは overflow_policy に従って
+    最も多く溜めている人の古いものを捨てる / 新しいものを捨てる /
+    「他N件のメッセージ」の通知1件にまとめる。
+    """
+
+    def __init__(self):
+        self._notices: Deque[SpeechItem] = deque()
+        # 発言者ごとの列。"他N件" の通知は発言者 "" の列に入る
+        self._users: Dict[str, Deque[SpeechItem]] = {}
+        self._active: Deque[str] = deque()  # 順番待ちの発言者 (巡回順)
+        self._deficit: Dict[str, int] = {}
+        self._not_empty = asyncio.Event()
+        self._size = 0
+        self.total_chars = 0
+        self.total_seconds = 0.0
+        self.clock = time.monotonic
+
+    def qsize(self) -> int:
+        self._expire_notices()
+        return self._size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def has_priority(self) -> bool:
+        """先読み中のアイテムより先に再生すべき通知があるか"""
+        self._expire_notices()
+        return bool(self._notices)
+
+    def items(self) -> list:
+        """再生される順に並べたアイテムの一覧"""
+        self._expire_notices()
+        users = {user_id: deque(items) for user_id, items in self._users.items()}
+        active, deficit = deque(self._active), dict(self._deficit)
+        ordered = list(self._notices)
+        while active:
+            ordered.append(self._pick(users, active, deficit))
+        return ordered
+
+    def _append(self, item: SpeechItem):
+        if item.kind == "notice":
+            self._notices.append(item)
+        else:
+            items = self._users.setdefault(item.user_id, deque())
+            if not items:
+                self._active.append(item.user_id)
+                self._deficit[item.user_id] = 0
+            items.append(item)
+        self._size += 1
+        self.total_chars += len(item.text)
+        self.total_seconds += item.estimated_seconds
+        self._not_empty.set()
+
+    def _remove(self, item: SpeechItem):
+        self._size -= 1
+        self.total_chars -= len(item.text)
+        self.total_seconds -= item.estimated_seconds
+        if not self._size:
+            self._not_empty.clear()
+
+    def _drop_user_head(self, user_id: str, tail: bool = False) -> SpeechItem:
+        items = self._users[user_id]
+        item = items.pop() if tail else items.popleft()
+        if not items:
+            del self._users[user_id]
+            del self._deficit[user_id]
+            self._active.remove(user_id)
+        self._remove(item)
+        return item
+
+    def _expire_notices(self):
+        """古くなった通知を先頭から捨てる"""
+        if not NOTICE_MAX_AGE:
+            return
+        deadline = self.clock() - NOTICE_MAX_AGE
+        expired = 0
+        while self._notices and 0 < self._notices[0].created_at < deadline:
+            self._remove(self._notices.popleft())
+            expired += 1
+        if expired:
+            metrics.inc("dropped_items_total", expired, "stale")
+
+    @staticmethod
+    def _pick(users: dict, active: Deque[str], deficit: Dict[str, int]) -> SpeechItem:
+        """次に読み上げる発言者の先頭のアイテムを取り出す (Deficit Round Robin)"""
+        while True:
+            user_id = active[0]
+            items = users[user_id]
+            if deficit[user_id] >= len(items[0].text):
+                break
+            deficit[user_id] += QUEUE_FAIR_QUANTUM
+            active.rotate(-1)
+        item = items.popleft()
+        deficit[user_id] -= len(item.text)
+        if not items:
+            # 列が空になった人は持ち越し分を失い、次に発言したときは最後尾に並ぶ
+            active.popleft()
+            del users[user_id], deficit[user_id]
+        return item
+
+    def _fits(self, item: SpeechItem, limits: QueueLimits) -> bool:
+        return (
+            self._size + 1 <= limits.max_items
+            and self.total_chars + len(item.text) <= limits.max_chars
+            and self.total_seconds + item.estimated_seconds <= limits.max_seconds
+        )
+
+    def put(self, item: SpeechItem, limits: QueueLimits) -> list:
+        """アイテムを追加し、上限を超えたために捨てたアイテムを返す"""
+        if item.kind == "notice":
+            # 通知は上限の対象外。同じメンバーの古い通知 (参加直後の退出など) は置き換える
+            superseded = [n for n in self._notices if n.user_id == item.user_id]
+            for notice in superseded:
+                self._notices.remove(notice)
+                self._remove(notice)
+            if superseded:
+                metrics.inc("dropped_items_total", len(superseded), "stale")
+            self._append(item)
+            return []
+
+        if self._fits(item, limits):
+            self._append(item)
+            return []
+
+        if limits.overflow_policy == "drop_newest":
+            return [item]
+
+        if limits.overflow_policy == "drop_oldest":
+            dropped = []
+            while self._users and not self._fits(item, limits):
+                # 最も多く溜めている人の古いものから捨てる
+                heaviest = max(
+                    self._users,
+                    key=lambda user_id: sum(len(i.text) for i in self._users[user_id]),
+                )
+                dropped.append(self._drop_user_head(heaviest))
+            if self._fits(item, limits):
+                self._append(item)
+            else:
+                dropped.append(item)  # 単体で上限を超えている
+            return dropped
+
+        # summarize: あふれた分は "他N件" の通知の件数に数える
+        count = 1
+        if "" in self._users and self._users[""][-1].kind == "overflow":
+            count += self._drop_user_head("", tail=True).overflow_count
+        self._append(
+            SpeechItem(
+                f"他{count}件のメッセージ",
+                DEFAULT_MODEL_UUID,
+                1.0,
+                1.0,
+                kind="overflow",
+                overflow_count=count,
+            )
+        )
+        return [item]
+
+    def get_nowait(self) -> SpeechItem:
+        self._expire_notices()
+        if self._notices:
+            item = self._notices.popleft()
+        elif self._active:
+            item = self._pick(self._users, self._active, self._deficit)
+        else:
+            raise asyncio.QueueEmpty
+        self._remove(item)
+        return item
+
+    async def get(self) -> SpeechItem:
+        while self.empty():
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def clear(self) -> int:
+        count = self._size
+        self._notices.clear()
+        self._users.clear()
+        self._active.clear()
+        self._deficit.clear()
+        self._size = 0
+        self.total_chars = 0
+        self.total_seconds = 0.0
+        self._not_empty.clear()
+        return count
+
+
+class PCMClip:
+    """1発話分のデコード済みPCM。再生スレッドとイベントループの両方から参照される"""
+
+    COMPACT_THRESHOLD = 1024 * 1024  # 読み終えた部分がこれを超えたらバッファを詰める
+
+    def __init__(self, user_volume: float, applied_volume: float = 1.0):
+        self.user_volume = user_volume
+        # PCM に変換時点で掛けてある音量 (再生時は目標の音量との差だけを掛ける)
+        self.applied_volume = applied_volume
+        self.started = False
+        self.finished = False
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        # 再生スレッドからの通知をイベントループ側で待つための Future
+        self._loop = asyncio.get_running_loop()
+        self.started_future: asyncio.Future = self._loop.create_future()
+        self.finished_future: asyncio.Future = self._loop.create_future()
+        # ストリーミング中にPCMを書き込み続けているタスクと、そのキャッシュキー
+        self.producer: Optional[asyncio.Task] = None
+        self.cache_key: Optional[str] = None
+        self._buffer = bytearray()
+        self._offset = 0
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def feed(self, data: bytes):
+        with self._lock:
+            self._buffer.extend(data)
+
+    def mark_started(self):
+        """再生開始を通知する (再生スレッドからも呼ばれる)"""
+        self.started_at = time.monotonic()
+        self.started = True
+        self._loop.call_soon_threadsafe(_resolve_future, self.started_future)
+
+    def mark_finished(self):
+        """再生終了 (スキップを含む) を通知する (再生スレッドからも呼ばれる)"""
+        self.finished_at = time.monotonic()
+        self.finished = True
+        self._loop.call_soon_threadsafe(_resolve_future, self.started_future)
+        self._loop.call_soon_threadsafe(_resolve_future, self.finished_future)
+
+    def finish(self):
+        with self._lock:
+            self._complete = True
+
+    def read_frame(self) -> Optional[bytes]:
+        """1フレーム分のPCMを返す。
+
+        データ待ちの場合は None、最後まで読み終えた場合は b"" を返す。
+        """
+        with self._lock:
+            available = len(self._buffer) - self._offset
+            if available >= PCM_FRAME_SIZE:
+                end = self._offset + PCM_FRAME_SIZE
+                frame = bytes(self._buffer[self._offset : end])
+                self._offset = end
+                if self._offset >= self.COMPACT_THRESHOLD:
+                    del self._buffer[: self._offset]
+                    self._offset = 0
+                return frame
+            if not self._complete:
+                return None
+            if available:
+                frame = bytes(self._buffer[self._offset :])
+                self._offset = len(self._buffer)
+                return frame + b"\x00" * (PCM_FRAME_SIZE - len(frame))
+            return b""
+
+
+def parse_wav_header(data: bytes) -> Optional[Tuple[int, int, int]]:
+    """WAV のヘッダーを読み、(サンプリングレート, チャンネル数, PCM の開始位置) を返す。
+
+    ヘッダーの途中までしか無い場合は None を返す。対応していない形式なら ValueError。
+    """
+    if len(data) < 12:
+        return None
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE stream")
+    offset = 12
+    sample_rate = channels = 0
+    while len(data) >= offset + 8:
+        chunk_id = data[offset : offset + 4]
+        chunk_size = int.from_bytes(data[offset + 4 : offset + 8], "little")
+        body = offset + 8
+        if chunk_id == b"data":
+            if not sample_rate:
+                raise ValueError("data chunk before fmt chunk")
+            return sample_rate, channels, body
+        if len(data) < body + chunk_size:
+            return None
+        if chunk_id == b"fmt ":
+            audio_format = int.from_bytes(data[body : body + 2], "little")
+            channels = int.from_bytes(data[body + 2 : body + 4], "little")
+            sample_rate = int.from_bytes(data[body + 4 : body + 8], "little")
+            bits = int.from_bytes(data[body + 14 : body + 16], "little")
+            # 1 = PCM, 0xFFFE = WAVE_FORMAT_EXTENSIBLE
+            if audio_format not in (1, 0xFFFE) or bits != 16:
+                raise ValueError(f"unsupported format {audio_format}/{bits}bit")
+            if channels not in (1, 2) or not sample_rate:
+                raise ValueError(f"unsupported layout {channels}ch/{sample_rate}Hz")
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+class PCMConverter:
+    """16bit PCM の WAV を、受信したチャンクから順に 48kHz/16bit/ステレオへ変換する。
+
+    リサンプリング・ステレオ化・音量の適用を NumPy でまとめて行い、
+    NumPy が無い場合は audioop で同じ処理をする。
+    """
+
+    def __init__(self, volume: float = 1.0):
+        self.volume = volume
+        self.sample_rate = 0
+        self.channels = 0
+        self._header = bytearray()
+        self._remainder = b""  # サンプルの途中で切れた端数
+        # リサンプリングの状態 (チャンクの境目でも連続するように引き継ぐ)
+        self._ratecv_state = None
+        self._position = 0.0
+        self._last = None
+
+    def feed(self, data: bytes) -> bytes:
+        if not self.sample_rate:
+            self._header.extend(data)
+            parsed = parse_wav_header(self._header)
+            if parsed is None:
+                return b""
+            self.sample_rate, self.channels, offset = parsed
+            data = bytes(self._header[offset:])
+            self._header = bytearray()
+        if self._remainder:
+            data = self._remainder + data
+        frame_size = 2 * self.channels
+        usable = len(data) - len(data) % frame_size
+        self._remainder = data[usable:]
+        if not usable:
+            return b""
+        pcm = memoryview(data)[:usable]
+        if np is None:
+            return self._convert_audioop(pcm)
+        return self._convert_numpy(pcm)
+
+    def _convert_numpy(self, pcm: memoryview) -> bytes:
+        samples = np.frombuffer(pcm, dtype="<i2").reshape(-1, self.channels)
+        if (
+            self.sample_rate == PCM_SAMPLE_RATE
+            and self.channels == PCM_CHANNELS
+            and self.volume == 1.0
+        ):
+            return pcm.tobytes()
+        samples = samples.astype(np.float32)
+        if self.sample_rate != PCM_SAMPLE_RATE:
+            samples = self._resample(samples)
+        if self.volume != 1.0:
+            samples *= self.volume
+        np.clip(samples, -32768, 32767, out=samples)
+        # モノラルはブロードキャストで両チャンネルに書き込む
+        output = np.empty((len(samples), PCM_CHANNELS), dtype="<i2")
+        output[:] = samples
+        return output.tobytes()
+
+    def _resample(self, samples):
+        """線形補間で 48kHz にする"""
+        if self._last is not None:
+            samples = np.concatenate((self._last, samples))
+        step = self.sample_rate / PCM_SAMPLE_RATE
+        positions = np.arange(self._position, len(samples) - 1, step)
+        next_position = positions[-1] + step if len(positions) else self._position
+        self._position = next_position - (len(samples) - 1)
+        self._last = samples[-1:]
+        index = positions.astype(np.intp)
+        weight = (positions - index).astype(np.float32)[:, None]
+        resampled = samples[index]
+        resampled += (samples[index + 1] - resampled) * weight
+        return resampled
+
+    def _convert_audioop(self, pcm: memoryview) -> bytes:
+        data = pcm.tobytes()
+        if self.sample_rate != PCM_SAMPLE_RATE:
+            data, self._ratecv_state = audioop.ratecv(
+                data,
+                2,
+                self.channels,
+                self.sample_rate,
+                PCM_SAMPLE_RATE,
+                self._ratecv_state,
+            )
+        if self.volume != 1.0:
+            data = audioop.mul(data, 2, self.volume)
+        if self.channels == 1:
+            data = audioop.tostereo(data, 2, 1, 1)
+        return data
+
+
+class GuildAudioSource(discord.AudioSource):
+    """ギルドごとに1つ作られ、クリップを次々に読み出し続ける音声ソース。
+
+    発話ごとに再生を止めないため、クリップの切り替えで無音の隙間ができない。
+    再生するものが無い状態が AUDIO_IDLE_LINGER 秒続いたときだけ再生を終了する。
+    """
+
+    def __init__(self, session: "GuildSession"):
+        self.session = session
+        self.current: Optional[PCMClip] = None
+        self._clips: Deque[PCMClip] = deque()
+        self._lock = threading.Lock()
+        self._idle_frames = 0
+        self._max_idle_frames = int(AUDIO_IDLE_LINGER / 0.02)
+        self._playback_generation = 0
+        self.stopped = True  # VoiceClient.play() し直す必要があるか
+
+    def enqueue(self, clip: PCMClip) -> bool:
+        """クリップを追加する。再生を開始し直す必要があれば True を返す"""
+        with self._lock:
+            self._clips.append(clip)
+            return self.stopped
+
+    def begin_playback(self) -> int:
+        with self._lock:
+            self._playback_generation += 1
+            self._idle_frames = 0
+            self.stopped = False
+            return self._playback_generation
+
+    def playback_ended(self, generation: int) -> bool:
+        """再生スレッドの終了通知。古い再生の通知なら False を返す"""
+        with self._lock:
+            if generation != self._playback_generation:
+                return False
+            self.stopped = True
+            return True
+
+    def skip(self) -> list:
+        """再生中と再生待ちのクリップをすべて破棄し、破棄したクリップを返す"""
+        with self._lock:
+            clips = list(self._clips)
+            if self.current:
+                clips.append(self.current)
+            self._clips.clear()
+            self.current = None
+        for clip in clips:
+            clip.mark_finished()
+        return clips
+
+    def has_audio(self) -> bool:
+        with self._lock:
+            return self.current is not None or bool(self._clips)
+
+    def read(self) -> bytes:
+        while True:
+            with self._lock:
+                if self.current is None and self._clips:
+                    self.current = self._clips.popleft()
+                    self.current.mark_started()
+                clip = self.current
+                if clip is None:
+                    self._idle_frames += 1
+                    if self._idle_frames > self._max_idle_frames:
+                        self.stopped = True
+                        return b""
+                    return PCM_SILENCE
+                self._idle_frames = 0
+
+            frame = clip.read_frame()
+            if frame is None:
+                # ストリーミング中でデータが届いていない
+                return PCM_SILENCE
+            if not frame:
+                with self._lock:
+                    if self.current is clip:
+                        self.current = None
+                clip.mark_finished()
+                continue
+
+            # サーバー音量と個人音量 (各 0～200%) の積。溢れたサンプルは audioop.mul が丸める
+            volume = self.session.server_volume * clip.user_volume
+            if volume != clip.applied_volume:
+                frame = audioop.mul(frame, 2, volume / clip.applied_volume)
+            return frame
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        # 再生の再開時に同じインスタンスを使い回すため、ここでは何もしない
+        pass
+
+
+class GuildSession:
+    def __init__(self, bot_loop: asyncio.AbstractEventLoop, guild_id: str):
+        self.voice_client: Optional[discord.VoiceClient] = None
+        self.text_channel_id: Optional[int] = None
+        self.queue = SpeechQueue()
+        self.is_muted: bool = False
+        self.is_paused: bool = False
+        self.server_volume: float = 0.75
+        # キューから取り出して合成を開始済みのアイテム (再生順)
+        self.prefetched: Deque[Tuple[SpeechItem, asyncio.Task]] = deque()
+        self.audio_source = GuildAudioSource(self)
+        # キューへの追加を再生タスクに知らせる
+        self.queue_event = asyncio.Event()
+        # キューに入れる前に、続けて届く発言とまとめるために保留しているアイテム
+        self.burst: Optional[SpeechItem] = None
+        self.coalesced_count = 0
+        # 上限を超えて捨てた発言の統計
+        self.dropped_count = 0
+        self.dropped_chars = 0
+        self._burst_started = 0.0
+        self._burst_timer: Optional[asyncio.TimerHandle] = None
+        # スキップ・退出のたびに進む世代番号と、再生タスクが完了を待っている合成タスク
+        self.generation = 0
+        self.current_prepare: Optional[asyncio.Task] = None
+        self.warmup_task: Optional[asyncio.Task] = None
+        # 再生タスクは最初の発言で起動し、キューが空になると終了する
+        self.player_task: Optional[asyncio.Task] = None
+        self.closed = False
+        # 自動退出の判定に使う、最後に発言が追加された時刻と、VCが無人になった時刻
+        self.last_activity = bot_loop.time()
+        self.empty_since: Optional[float] = None
+        self.guild_id = guild_id
+        self._loop = bot_loop
+
+    def stop(self):
+        log_debug(self.guild_id, "GuildSession.stop() called.")
+        self.closed = True
+        if self.warmup_task and not self.warmup_task.done():
+            self.warmup_task.cancel()
+        if self.player_task and not self.player_task.done():
+            self.player_task.cancel()
+            log_debug(self.guild_id, "Player task cancelled.")
+        self.cancel_pending()
+        self.voice_client = None
+
+    def has_pending(self) -> bool:
+        return (
+            self.audio_source.has_audio()
+            or not self.queue.empty()
+            or bool(self.prefetched)
+            or self.current_prepare is not None
+            or self.burst is not None
+        )
+
+    def cancel_pending(self):
+        """保留・再生待ち・再生中の発言をすべて破棄し、実行中の合成とデコードを中止する"""
+        self.generation += 1
+        discarded = len(self.prefetched) + (1 if self.burst else 0)
+        self.discard_burst()
+        discarded += self.queue.clear()
+        self.clear_prefetched()
+        if self.current_prepare:
+            self.current_prepare.cancel()
+            discarded += 1
+        discarded += self.drop_audio()
+        if discarded:
+            metrics.inc("dropped_items_total", discarded, "skip")
+
+    def drop_audio(self) -> int:
+        clips = self.audio_source.skip()
+        for clip in clips:
+            release_clip(clip)
+        return len(clips)
+
+    def enqueue(self, item: SpeechItem):
+        dropped = self.queue.put(item, get_queue_limits(self.guild_id))
+        if dropped:
+            self.dropped_count += len(dropped)
+            self.dropped_chars += sum(len(d.text) for d in dropped)
+            metrics.inc("dropped_items_total", len(dropped), "overflow")
+            log_info(self.guild_id, "Queue full, dropped %d item(s).", len(dropped))
+        self.last_activity = self._loop.time()
+        self.queue_event.set()
+        self.ensure_player()
+
+    def ensure_player(self):
+        """再生タスクが動いていなければ起動する"""
+        if self.closed or (self.player_task and not self.player_task.done()):
+            return
+        log_debug(self.guild_id, "Starting player task.", sample=True)
+        self.player_task = self._loop.create_task(audio_player_task(self.guild_id))
+
+    def add_speech(self, item: SpeechItem):
+        """発言をキューに追加する。
+
+        短い発言は COALESCE_LINGER 秒だけ保留し、その間に届いた同じ声・速度・音量の
+        発言と1つにまとめてから追加する。通知は保留せずにすぐ追加する。
+        """
+        if item.kind == "notice":
+            self.enqueue(item)
+            return
+        if self.burst and self.burst.can_merge(item):
+            self.burst = self.burst.merge(item)
+            self.coalesced_count += 1
+            held = self._loop.time() - self._burst_started
+            self._arm_burst_timer(min(COALESCE_LINGER, COALESCE_MAX_HOLD - held))
+            return
+        self.flush_burst()
+        if COALESCE_LINGER <= 0 or len(item.text) >= COALESCE_MAX_CHARS:
+            self.enqueue(item)
+            return
+        self.burst = item
+        self._burst_started = self._loop.time()
+        self._arm_burst_timer(COALESCE_LINGER)
+
+    def _arm_burst_timer(self, delay: float):
+        if self._burst_timer:
+            self._burst_timer.cancel()
+        self._burst_timer = self._loop.call_later(max(delay, 0), self.flush_burst)
+
+    def flush_burst(self):
+        """保留中の発言をキューに追加する"""
+        if self._burst_timer:
+            self._burst_timer.cancel()
+            self._burst_timer = None
+        if self.burst:
+            item, self.burst = self.burst, None
+            self.enqueue(item)
+
+    def discard_burst(self):
+        if self._burst_timer:
+            self._burst_timer.cancel()
+            self._burst_timer = None
+        self.burst = None
+
+    def play_clip(self, clip: PCMClip):
+        """クリップを音声ソースに追加し、必要ならVCでの再生を開始する"""
+        clip.finished_future.add_done_callback(lambda _: record_playback(clip))
+        if self.audio_source.enqueue(clip):
+            self.start_playback()
+
+    def start_playback(self):
+        if not self.voice_client:
+            return
+        # 前回の再生スレッドは既に終了処理に入っているので、止めてから再開する
+        self.voice_client.stop()
+        source = self.audio_source
+        generation = source.begin_playback()
+
+        def after(error: Optional[Exception]):
+            # 再生スレッドから呼ばれるため、処理はイベントループに渡す
+            self._loop.call_soon_threadsafe(self._on_playback_ended, generation, error)
+
+        try:
+            self.voice_client.play(source, after=after)
+        except Exception:
+            # 再生されないクリップをソースに残さず、キャッシュの待機者の登録も解除する
+            source.playback_ended(generation)
+            self.drop_audio()
+            raise
+        if self.is_paused:
+            # 一時停止中に届いたクリップは、再開されるまで流さない
+            self.voice_client.pause()
+
+    def pause(self):
+        self.is_paused = True
+        if self.voice_client and self.voice_client.is_playing():
+            self.voice_client.pause()
+
+    def resume(self):
+        self.is_paused = False
+        if self.voice_client and self.voice_client.is_paused():
+            self.voice_client.resume()
+
+    def _on_playback_ended(self, generation: int, error: Optional[Exception]):
+        if not self.audio_source.playback_ended(generation):
+            return
+        if error:
+            log_warning(self.guild_id, "Playback stopped with error: %s", error)
+        if not self.audio_source.has_audio():
+            return
+        # 切断などで再生が途中で終わった場合、残りのクリップを再生し直すか破棄する
+        if self.voice_client and self.voice_client.is_connected():
+            log_debug(self.guild_id, "Playback ended with clips left, restarting.")
+            try:
+                self.start_playback()
+                return
+            except discord.ClientException as e:
+                log_warning(self.guild_id, "Failed to restart playback: %s", e)
+        self.drop_audio()
+
+    def clear_prefetched(self):
+        """先読み中の合成タスクをすべて破棄する"""
+        while self.prefetched:
+            _, task = self.prefetched.popleft()
+            discard_prepare(task)
+
+
+class SpeechCache:
+    """(text, model_uuid, speaking_rate) をキーにした合成音声キャッシュ。
+
+    メモリ上のLRUと任意のディスク層の2段構成で、同じキーへの同時リクエストは
+    1回のAPI呼び出しにまとめる (single-flight)。
+    """
+
+    DISK_PRUNE_INTERVAL = 100  # この回数書き込むごとにディスク層の容量を確認する
+
+    def __init__(
+        self, memory_max_bytes: int, disk_dir: Optional[str], disk_max_bytes: int
+    ):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # 実行中の取得処理ごとの待ち手の数
+        self._waiters: Dict[str, int] = {}
+        self._background_writes: set = set()
+        self._disk_writes = 0
+        # 統計
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.saved_chars = 0
+        self.fetch_seconds_total = 0.0
+
+    @staticmethod
+    def make_key(text: str, model_uuid: str, speaking_rate: float) -> str:
+        raw = json.dumps(
+            [text, model_uuid, round(float(speaking_rate), 3), AIVIS_OUTPUT_FORMAT],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.deduplicated + self.misses
+        if not lookups:
+            return 0.0
+        return (lookups - self.misses) / lookups
+
+    @property
+    def average_fetch_seconds(self) -> float:
+        return self.fetch_seconds_total / self.misses if self.misses else 0.0
+
+    async def get_or_fetch(
+        self,
+        text: str,
+        model_uuid: str,
+        speaking_rate: float,
+        fetch: Callable[[], Awaitable[Optional[bytes]]],
+    ) -> Optional[bytes]:
+        key = self.make_key(text, model_uuid, speaking_rate)
+
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            self.saved_chars += len(text)
+            return data
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.deduplicated += 1
+            self.saved_chars += len(text)
+        else:
+            task = asyncio.create_task(self._load(key, text, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 他のギルドが同じ結果を待っている可能性があるため、共有タスクは守る
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                # 取得処理の側が中止された場合は、合成失敗として扱う
+                return None
+            if self._waiters[key] == 1:
+                # 最後の待ち手がいなくなったら、リクエストごと中止する
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    async def lookup(
+        self, text: str, model_uuid: str, speaking_rate: float
+    ) -> Optional[bytes]:
+        """API を呼ばずに取得できる場合だけ結果を返す (メモリ → ディスクの順)"""
+        key = self.make_key(text, model_uuid, speaking_rate)
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+        else:
+            data = await self._read_disk(key)
+            if data is None:
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, data)
+        self.saved_chars += len(text)
+        return data
+
+    def is_fetching(self, text: str, model_uuid: str, speaking_rate: float) -> bool:
+        return self.make_key(text, model_uuid, speaking_rate) in self._inflight
+
+    def track_fetch(self, key: str, task: asyncio.Task):
+        """キャッシュの外で実行中の取得処理を、同じキーの要求の合流先として登録する。
+
+        呼び出し側も待ち手の1人として数えるため、使い終わったら release_waiter() を呼ぶ。
+        """
+        self._inflight[key] = task
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+    def release_waiter(self, key: str) -> bool:
+        """track_fetch で数えた待ち手を外す。最後の待ち手だったら True"""
+        remaining = self._waiters.get(key, 0) - 1
+        if remaining > 0:
+            self._waiters[key] = remaining
+            return False
+        self._waiters.pop(key, None)
+        return True
+
+    def put(
+        self,
+        text: str,
+        model_uuid: str,
+        speaking_rate: float,
+        data: bytes,
+        fetch_seconds: float,
+    ):
+        """キャッシュを経由せずに取得した結果を登録する"""
+        key = self.make_key(text, model_uuid, speaking_rate)
+        self.misses += 1
+        self.fetch_seconds_total += fetch_seconds
+        self._put_memory(key, data)
+        self._schedule_disk_write(key, data)
+
+    async def _load(
+        self, key: str, text: str, fetch: Callable[[], Awaitable[Optional[bytes]]]
+    ) -> Optional[bytes]:
+        data = await self._read_disk(key)
+        if data is not None:
+            self.disk_hits += 1
+            self.saved_chars += len(text)
+            self._put_memory(key, data)
+            return data
+
+        self.misses += 1
+        started = time.perf_counter()
+        data = await fetch()
+        self.fetch_seconds_total += time.perf_counter() - started
+        if data:
+            self._put_memory(key, data)
+            self._schedule_disk_write(key, data)
+        return data
+
+    def _schedule_disk_write(self, key: str, data: bytes):
+        write_task = asyncio.create_task(self._write_disk(key, data))
+        self._background_writes.add(write_task)
+        write_task.add_done_callback(self._background_writes.discard)
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        # MP3 と WAV が混ざるため拡張子で形式を示さない (読み出し時に audio_format で判定)。
+        # 以前の .mp3 のファイルは読まれなくなり、容量超過時に古い順に削除される
+        return os.path.join(self.disk_dir, key[:2], f"{key}.audio")
+
+    async def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read_disk_sync, key)
+
+    def _read_disk_sync(self, key: str) -> Optional[bytes]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 最終利用時刻を更新 (容量超過時の削除順に使う)
+            return data
+        except OSError:
+            return None
+
+    async def _write_disk(self, key: str, data: bytes):
+        if not self.disk_dir:
+            return
+        self._disk_writes += 1
+        prune = self._disk_writes % self.DISK_PRUNE_INTERVAL == 0
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write_disk_sync, key, data, prune)
+        except OSError as e:
+            log_warning(None, "Failed to write audio cache file: %s", e)
+
+    def _write_disk_sync(self, key: str, data: bytes, prune: bool):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # 複数プロセスが同時に書いても壊れない
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if prune:
+            self._prune_disk_sync()
+
+    def _prune_disk_sync(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class DictionaryMatcher:
+    """ギルド辞書の単語を1回の走査で最長一致置換するマッチャー。
+
+    単語をトライ木にまとめて1つの正規表現にコンパイルするため、置換結果が
+    別の単語に再度置換されることはなく、登録順にも依存しない。
+    """
+
+    def __init__(self, dictionary: Dict[str, str]):
+        self.readings = {word: reading for word, reading in dictionary.items() if word}
+        self.pattern = self._compile(list(self.readings))
+
+    @classmethod
+    def _compile(cls, words: list) -> Optional["re.Pattern"]:
+        if not words:
+            return None
+        try:
+            return re.compile(cls._build_trie_pattern(words))
+        except (RecursionError, re.error):
+            # 入れ子が深すぎる辞書は、長い単語を先に並べた単純な選択にフォールバック
+            words = sorted(words, key=len, reverse=True)
+            return re.compile("|".join(re.escape(word) for word in words))
+
+    @staticmethod
+    def _build_trie_pattern(words: list) -> str:
+        trie: dict = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[None] = True  # 単語の終端
+
+        # 深い単語でも再帰しないよう、帰りがけ順でノードごとのパターンを組み立てる
+        patterns: Dict[int, str] = {}
+        stack = [(trie, False)]
+        while stack:
+            node, visited = stack.pop()
+            children = [
+                (char, child) for char, child in node.items() if char is not None
+            ]
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for _, child in children)
+                continue
+            alternatives = [
+                re.escape(char) + patterns.pop(id(child))
+                for char, child in sorted(children, key=lambda c: c[0])
+            ]
+            if not alternatives:
+                pattern = ""
+            elif len(alternatives) == 1:
+                pattern = alternatives[0]
+            else:
+                pattern = "(?:" + "|".join(alternatives) + ")"
+            if None in node and pattern:
+                # 欲張りな省略可能グループにすることで、より長い単語を優先する
+                pattern = f"(?:{pattern})?"
+            patterns[id(node)] = pattern
+        return patterns[id(trie)]
+
+    def apply(self, text: str) -> str:
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(lambda m: self.readings[m.group(0)], text)
+
+
+class SQLiteBackend:
+    """SettingsStore の保存先 (SQLite, WALモード)。
+
+    同じファイルを複数のワーカープロセスで共有できる。変更があった (namespace, owner)
+    は changes テーブルにも記録し、他のプロセスはそれを定期的に読んで反映する。
+    """
+
+    CHANGE_RETENTION = 600  # changes テーブルに残しておく秒数
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        if self._conn is not None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # 他のプロセスが書き込み中でも、しばらく待ってから書き込む
+        self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, owner, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " namespace TEXT NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " origin TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load(self, namespace: str) -> Dict[str, Dict]:
+        data: Dict[str, Dict] = {}
+        rows = self._conn.execute(
+            "SELECT owner, key, value FROM kv WHERE namespace = ?", (namespace,)
+        )
+        for owner, key, value in rows:
+            data.setdefault(owner, {})[key] = json.loads(value)
+        return data
+
+    def load_owner(self, namespace: str, owner: str) -> Dict:
+        rows = self._conn.execute(
+            "SELECT key, value FROM kv WHERE namespace = ? AND owner = ?",
+            (namespace, owner),
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    def import_rows(self, namespace: str, data: Dict[str, Dict]) -> int:
+        rows = [
+            (namespace, owner, key, json.dumps(value, ensure_ascii=False))
+            for owner, entries in data.items()
+            for key, value in entries.items()
+        ]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO kv (namespace, owner, key, value)"
+                " VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def write(self, batch: list, origin: str):
+        now = time.time()
+        with self._conn:
+            for (namespace, owner, key), value in batch:
+                if key is None:
+                    self._conn.execute(
+                        "DELETE FROM kv WHERE namespace = ? AND owner = ?",
+                        (namespace, owner),
+                    )
+                elif value is None:
+                    self._conn.execute(
+                        "DELETE FROM kv WHERE namespace = ? AND owner = ? AND key = ?",
+                        (namespace, owner, key),
+                    )
+                else:
+                    self._conn.execute(
+                        "INSERT INTO kv (namespace, owner, key, value)"
+                        " VALUES (?, ?, ?, ?)"
+                        " ON CONFLICT (namespace, owner, key)"
+                        " DO UPDATE SET value = excluded.value",
+                        (namespace, owner, key, json.dumps(value, ensure_ascii=False)),
+                    )
+            self._conn.executemany(
+                "INSERT INTO changes (namespace, owner, origin, created)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (namespace, owner, origin, now)
+                    for namespace, owner in dict.fromkeys(k[:2] for k, _ in batch)
+                ],
+            )
+            self._conn.execute(
+                "DELETE FROM changes WHERE created < ?", (now - self.CHANGE_RETENTION,)
+            )
+
+    def latest_change(self) -> int:
+        row = self._conn.execute("SELECT MAX(id) FROM changes").fetchone()
+        return row[0] or 0
+
+    def changes_since(self, cursor: int, origin: str) -> Tuple[int, list]:
+        """cursor より後に他のプロセスが変更した (namespace, owner) を返す"""
+        changed = []
+        rows = self._conn.execute(
+            "SELECT id, namespace, owner, origin FROM changes WHERE id > ? ORDER BY id",
+            (cursor,),
+        )
+        for change_id, namespace, owner, change_origin in rows:
+            cursor = change_id
+            if change_origin != origin:
+                changed.append((namespace, owner))
+        return cursor, changed
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class RedisBackend:
+    """SettingsStore の保存先 (Redis 互換サーバー)。
+
+    owner ごとに1つのハッシュに保存し、変更の通知は Redis Stream に流す。
+    redis パッケージが必要。
+    """
+
+    CHANGE_STREAM_MAXLEN = 10000
+
+    def __init__(self, url: str, prefix: str = "aivis"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+
+    def _owners_key(self, namespace: str) -> str:
+        return f"{self.prefix}:{namespace}"
+
+    def _owner_key(self, namespace: str, owner: str) -> str:
+        return f"{self.prefix}:{namespace}:{owner}"
+
+    @property
+    def _stream_key(self) -> str:
+        return f"{self.prefix}:changes"
+
+    def open(self):
+        if self._client is not None:
+            return
+        if redis is None:
+            raise RuntimeError(
+                "STORE_BACKEND=redis を使うには redis パッケージが必要です"
+                " (pip install redis)"
+            )
+        self._client = redis.Redis.from_url(self.url, decode_responses=True)
+        self._client.ping()
+
+    def load(self, namespace: str) -> Dict[str, Dict]:
+        owners = sorted(self._client.smembers(self._owners_key(namespace)))
+        pipe = self._client.pipeline(transaction=False)
+        for owner in owners:
+            pipe.hgetall(self._owner_key(namespace, owner))
+        data: Dict[str, Dict] = {}
+        for owner, entries in zip(owners, pipe.execute()):
+            if entries:
+                data[owner] = {k: json.loads(v) for k, v in entries.items()}
+        return data
+
+    def load_owner(self, namespace: str, owner: str) -> Dict:
+        entries = self._client.hgetall(self._owner_key(namespace, owner))
+        return {key: json.loads(value) for key, value in entries.items()}
+
+    def import_rows(self, namespace: str, data: Dict[str, Dict]) -> int:
+        pipe = self._client.pipeline(transaction=True)
+        count = 0
+        for owner, entries in data.items():
+            pipe.sadd(self._owners_key(namespace), owner)
+            for key, value in entries.items():
+                pipe.hsetnx(
+                    self._owner_key(namespace, owner),
+                    key,
+                    json.dumps(value, ensure_ascii=False),
+                )
+                count += 1
+        pipe.execute()
+        return count
+
+    def write(self, batch: list, origin: str):
+        pipe = self._client.pipeline(transaction=True)
+        for (namespace, owner, key), value in batch:
+            owner_key = self._owner_key(namespace, owner)
+            if key is None:
+                pipe.delete(owner_key)
+                pipe.srem(self._owners_key(namespace), owner)
+            elif value is None:
+                pipe.hdel(owner_key, key)
+            else:
+                pipe.hset(owner_key, key, json.dumps(value, ensure_ascii=False))
+                pipe.sadd(self._owners_key(namespace), owner)
+        for namespace, owner in dict.fromkeys(k[:2] for k, _ in batch):
+            pipe.xadd(
+                self._stream_key,
+                {"namespace": namespace, "owner": owner, "origin": origin},
+                maxlen=self.CHANGE_STREAM_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+
+    def latest_change(self) -> str:
+        entries = self._client.xrevrange(self._stream_key, count=1)
+        return entries[0][0] if entries else "0-0"
+
+    def changes_since(self, cursor: str, origin: str) -> Tuple[str, list]:
+        changed = []
+        for _, entries in self._client.xread({self._stream_key: cursor}) or []:
+            for entry_id, fields in entries:
+                cursor = entry_id
+                if fields.get("origin") != origin:
+                    changed.append((fields["namespace"], fields["owner"]))
+        return cursor, changed
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class SettingsStore:
+    """辞書・ユーザー設定・ギルド設定のストア。
+
+    データは (namespace, owner, key) -> value の形で1件ずつ保存先 (SQLiteBackend /
+    RedisBackend) に保存する。変更はキー単位でためておき、専用スレッドで1回の書き込みに
+    まとめるため、コマンドの応答時間は全体のデータ量に左右されない。
+    sync_interval が正なら、他のプロセスでの変更をその間隔で確認して watch() の
+    コールバックに渡す。
+    """
+
+    FLUSH_MAX_BACKOFF = 30.0  # 書き込みに失敗し続けたときの再試行間隔の上限
+
+    def __init__(self, backend, flush_interval: float, sync_interval: float = 0.0):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        # 自分の変更を通知から除くための、プロセスごとの識別子
+        self.origin = f"{os.getpid()}-{os.urandom(4).hex()}"
+        # 書き込みは常にこの1スレッドで行う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self._opened = False
+        self._cursor = None
+        # (namespace, owner, key) -> 値 (None は削除、key が None なら owner ごと削除)
+        self._pending: "OrderedDict[Tuple[str, str, Optional[str]], object]" = (
+            OrderedDict()
+        )
+        self._flush_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        await self._run(self._open_sync)
+
+    def _open_sync(self):
+        if self._opened:
+            return
+        self.backend.open()
+        # 読み込みより前の変更は、読み込んだデータに含まれている
+        self._cursor = self.backend.latest_change()
+        self._opened = True
+
+    async def load(self, namespace: str) -> Dict[str, Dict]:
+        return await self._run(self.backend.load, namespace)
+
+    async def migrate_json(self, namespace: str, filepath: str):
+        """旧形式のJSONファイルがあれば取り込み、.migrated に改名する"""
+        migrated = await self._run(self._migrate_json_sync, namespace, filepath)
+        if migrated:
+            log_info(None, "Migrated %d entries from %s.", migrated, filepath)
+
+    def _migrate_json_sync(self, namespace: str, filepath: str) -> int:
+        if not os.path.exists(filepath):
+            return 0
+        migrated = self.backend.import_rows(namespace, load_data(filepath))
+        os.replace(filepath, f"{filepath}.migrated")
+        return migrated
+
+    def set(self, namespace: str, owner: str, key: str, value):
+        self._pending[(namespace, owner, key)] = value
+        self._schedule_flush()
+
+    def delete(self, namespace: str, owner: str, key: Optional[str] = None):
+        if key is None:
+            # owner ごと削除する場合、それ以前の個別の変更は不要になる
+            for pending_key in [
+                k for k in self._pending if k[:2] == (namespace, owner)
+            ]:
+                del self._pending[pending_key]
+        self._pending[(namespace, owner, key)] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 書き込み中に行われた変更や失敗した変更は、このタスクが続けて書き込む
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            if await self.flush():
+                delay = self.flush_interval
+            else:
+                delay = min(max(delay * 2, 1.0), self.FLUSH_MAX_BACKOFF)
+            if not self._pending:
+                return
+
+    async def flush(self) -> bool:
+        """ためている変更を書き込む。失敗したら変更を戻して False を返す"""
+        if not self._pending:
+            return True
+        batch = list(self._pending.items())
+        self._pending.clear()
+        try:
+            await self._run(self.backend.write, batch, self.origin)
+            return True
+        except Exception as e:
+            log_error(None, "Failed to write settings store: %s", e)
+            # 失敗した変更を、その後に行われた変更より前に戻しておく
+            newer = self._pending
+            self._pending = OrderedDict(batch)
+            for op_key, value in newer.items():
+                self._pending.pop(op_key, None)
+                self._pending[op_key] = value
+            return False
+
+    def watch(self, callback: Callable[[str, str, Dict], None]):
+        """他のプロセスでの変更を callback(namespace, owner, data) で受け取る"""
+        if self.sync_interval <= 0:
+            return
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch(callback))
+
+    async def _watch(self, callback: Callable[[str, str, Dict], None]):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                changes = await self._run(self._poll_sync)
+            except Exception as e:
+                log_warning(None, "Failed to read settings store changes: %s", e)
+                continue
+            for namespace, owner, data in changes:
+                callback(
+                    namespace, owner, self._overlay_pending(namespace, owner, data)
+                )
+
+    def _poll_sync(self) -> list:
+        self._cursor, changed = self.backend.changes_since(self._cursor, self.origin)
+        return [
+            (namespace, owner, self.backend.load_owner(namespace, owner))
+            for namespace, owner in dict.fromkeys(changed)
+        ]
+
+    def _overlay_pending(self, namespace: str, owner: str, data: Dict) -> Dict:
+        """まだ書き込んでいない自分の変更を、読み込んだデータに重ねる"""
+        for (op_namespace, op_owner, key), value in self._pending.items():
+            if (op_namespace, op_owner) != (namespace, owner):
+                continue
+            if key is None:
+                data = {}
+            elif value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    async def close(self):
+        for task in (self._flush_task, self._watch_task):
+            if task and not task.done():
+                task.cancel()
+        await self.flush()
+        if self._opened:
+            await self._run(self.backend.close)
+            self._opened = False
+        self._executor.shutdown(wait=False)
+
+
+class GuildWaitStats:
+    """ギルドごとの API 呼び出し待ち時間の統計"""
+
+    def __init__(self):
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.requests if self.requests else 0.0
+
+
+class SynthesisScheduler:
+    """プロセス全体で Aivis API の呼び出しを制御するスケジューラー。
+
+    トークンバケットで秒間リクエスト数を、同時実行数の上限で負荷を抑える。
+    空きを待つリクエストは、ギルドごとの重み付き公平キューイング (開始時刻順の
+    仮想時間) で順番を決めるため、1つのギルドが枠を使い切ることはない。
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        max_concurrency: int,
+        weights: Dict[str, float],
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.weights = weights
+        self.in_flight = 0
+        self.stats: Dict[str, GuildWaitStats] = {}
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._virtual_time = 0.0
+        self._finish_tags: Dict[str, float] = {}
+        # (仮想開始時刻, 通し番号, ギルドID, 許可を待つ Future)
+        self._heap: list = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, future in self._heap if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, guild_id: Optional[str]):
+        """API を1回呼び出す間、実行枠を確保する"""
+        await self.acquire(guild_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, guild_id: Optional[str]):
+        guild_key = guild_id or "GLOBAL"
+        started = time.monotonic()
+        weight = self.weights.get(guild_key, 1.0)
+        start_tag = max(self._virtual_time, self._finish_tags.get(guild_key, 0.0))
+        self._finish_tags[guild_key] = start_tag + 1.0 / weight
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (start_tag, next(self._sequence), guild_key, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 許可された直後に中止された場合は枠を返す
+                self.release()
+            else:
+                future.cancel()
+                self._dispatch()
+            raise
+        self.stats.setdefault(guild_key, GuildWaitStats()).record(
+            time.monotonic() - started
+        )
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def pause_for(self, seconds: float):
+        """429 の Retry-After を受けて、指定秒数は新しい呼び出しを止める"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        log_warning(None, "Aivis API rate limited, pausing for %.1fs.", seconds)
+
+    def _refill(self, now: float):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._tokens = min(
+            float(self.burst), self._tokens + elapsed * max(self.rate, 0)
+        )
+
+    def _dispatch(self):
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._heap:
+            start_tag, _, _, future = self._heap[0]
+            if future.done():
+                heapq.heappop(self._heap)
+                continue
+            if self.in_flight >= self.max_concurrency:
+                return  # release() で再開する
+            if now < self._paused_until:
+                self._schedule_wakeup(self._paused_until - now)
+                return
+            if self.rate > 0 and self._tokens < 1.0:
+                self._schedule_wakeup((1.0 - self._tokens) / self.rate)
+                return
+            heapq.heappop(self._heap)
+            self._tokens -= 1.0
+            self.in_flight += 1
+            self._virtual_time = max(self._virtual_time, start_tag)
+            future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float):
+        loop = asyncio.get_running_loop()
+        self._wakeup = loop.call_later(delay, self._dispatch)
+
+
+class AivisAPIError(Exception):
+    """Aivis API が 200 以外を返したときの例外"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status} - {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in (408, 429) or self.status >= 500
+
+
+class LatencyTracker:
+    """直近の成功したリクエストの所要時間から分位点を求める"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self._samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Histogram:
+    """Prometheus 形式のヒストグラム。ラベル値ごとに各バケットの件数と合計を持つ"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts: Dict[str, list] = {}
+        self.sums: Dict[str, float] = {}
+
+    def observe(self, value: float, label: str = ""):
+        counts = self.counts.get(label)
+        if counts is None:
+            counts = self.counts[label] = [0] * (len(self.buckets) + 1)
+            self.sums[label] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+
+class Metrics:
+    """Prometheus のテキスト形式で出力できる、最小限のカウンターとヒストグラム。
+
+    記録は辞書の加算だけで済ませ、整形は /metrics が読まれたときにまとめて行う。
+    ゲージなど、その時点の値で決まるものは読まれたときに collector から集める。
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        # 名前 -> (種類, 説明, ラベル名)
+        self._definitions: Dict[str, Tuple[str, str, Optional[str]]] = {}
+        self._counters: Dict[str, Dict[str, float]] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+    def counter(self, name: str, help_text: str, label: Optional[str] = None):
+        self._definitions[name] = ("counter", help_text, label)
+        # ラベルの無いカウンターは、まだ一度も増えていなくても 0 を出力する
+        self._counters[name] = {} if label else {"": 0.0}
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: Tuple[float, ...],
+        label: Optional[str] = None,
+    ):
+        self._definitions[name] = ("histogram", help_text, label)
+        self._histograms[name] = Histogram(buckets)
+
+    def collector(
+        self,
+        name: str,
+        help_text: str,
+        collect: Callable[[], Dict[str, float]],
+        label: Optional[str] = None,
+        kind: str = "gauge",
+    ):
+        """読まれたときに collect() の {ラベル値: 値} を出力する"""
+        self._definitions[name] = (kind, help_text, label)
+        self._collectors[name] = collect
+
+    def inc(self, name: str, value: float = 1.0, label: str = ""):
+        values = self._counters[name]
+        values[label] = values.get(label, 0.0) + value
+
+    def observe(self, name: str, value: float, label: str = ""):
+        self._histograms[name].observe(value, label)
+
+    @staticmethod
+    def _labels(label_name: Optional[str], value: str, extra: str = "") -> str:
+        parts = []
+        if label_name:
+            escaped = (
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n")
+            )
+            parts.append(f'{label_name}="{escaped}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, label) in self._definitions.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if name in self._histograms:
+                histogram = self._histograms[name]
+                for value, counts in list(histogram.counts.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (None,), counts):
+                        cumulative += count
+                        le = "+Inf" if bound is None else repr(float(bound))
+                        labels = self._labels(label, value, f'le="{le}"')
+                        lines.append(f"{full_name}_bucket{labels} {cumulative}")
+                    labels = self._labels(label, value)
+                    lines.append(f"{full_name}_sum{labels} {histogram.sums[value]}")
+                    lines.append(f"{full_name}_count{labels} {cumulative}")
+                continue
+            if name in self._counters:
+                values = self._counters[name]
+            else:
+                values = self._collectors[name]()
+            for value, number in list(values.items()):
+                lines.append(f"{full_name}{self._labels(label, value)} {number}")
+        return "\n".join(lines) + "\n"
+
+
+class CircuitBreaker:
+    """API の障害中はリクエストを送らずに即失敗させる。
+
+    連続失敗が閾値に達すると open になり、reset_timeout 秒後に1件だけ試す
+    (half-open)。その結果で closed に戻るか、再び open になる。
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self._probing = False
+        # 試行中のリクエストが中止されて結果が届かない場合に備え、時間で打ち切る
+        if (
+            self._probing
+            and time.monotonic() - self._probe_started < self.reset_timeout
+        ):
+            self.rejected += 1
+            return False
+        self._probing = True
+        self._probe_started = time.monotonic()
+        return True
+
+    def record_success(self):
+        if self.state != "closed":
+            log_info(None, "Aivis API circuit closed.")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                log_warning(None, "Aivis API circuit opened.")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class AivisEndpoint:
+    """合成APIの接続先 (URL と APIキーの組) 1つ分の状態"""
+
+    LATENCY_ALPHA = 0.3  # 応答時間の指数移動平均の重み
+    MIN_SAMPLES = 5  # 遅さを判定するのに必要な応答数
+
+    def __init__(
+        self, name: str, url: str, api_key: str, weight: float, max_concurrency: int
+    ):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.weight = weight
+        self.max_concurrency = max_concurrency  # 0 なら上限なし
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0  # 連続失敗回数
+        self.ejections = 0  # 連続で外された回数
+        self.latency: Optional[float] = None
+        self.samples = 0
+        self.ejected_until = 0.0
+        self.started: list = []  # 処理中のリクエストの開始時刻
+
+    def has_capacity(self) -> bool:
+        return not self.max_concurrency or self.in_flight < self.max_concurrency
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def cost(self, default_latency: float, now: float) -> float:
+        """小さいほど優先する (応答時間 × 処理中のリクエスト数 / 重み)。
+
+        急に遅くなった場合にすぐ避けられるよう、応答を待っている最も古いリクエストの
+        経過時間が平均より長ければ、そちらを応答時間とみなす。
+        """
+        latency = self.latency or default_latency
+        if self.started:
+            latency = max(latency, now - self.started[0])
+        return latency * (self.in_flight + 1) / self.weight
+
+
+class EndpointPool:
+    """複数の接続先にリクエストを振り分ける。
+
+    空きのある接続先のうち、応答時間の移動平均と処理中のリクエスト数から求めた
+    コストが最も小さいものを選ぶ。連続で失敗した接続先や、他の接続先 (の中央値) より
+    極端に遅い接続先は一定時間外し、時間が経ったら戻して測り直す (受動的なヘルスチェック)。
+    すべて外れている場合は、外れているものも使う。
+    """
+
+    def __init__(
+        self,
+        endpoints: list,
+        failure_threshold: int,
+        slow_factor: float,
+        eject_seconds: float,
+    ):
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.slow_factor = slow_factor
+        self.eject_seconds = eject_seconds
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @asynccontextmanager
+    async def lease(self):
+        """リクエスト1回分の接続先を確保する。一時的なエラーは失敗として数える"""
+        endpoint = await self.acquire()
+        started = endpoint.started[-1]
+        try:
+            yield endpoint
+        except Exception as e:
+            # 429 は混雑しているだけなので pause() で扱う
+            if is_retryable_error(e) and getattr(e, "status", None) != 429:
+                self.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.started.remove(started)
+            self.release(endpoint)
+
+    async def acquire(self) -> AivisEndpoint:
+        while True:
+            endpoint = self.select()
+            if endpoint:
+                endpoint.in_flight += 1
+                endpoint.requests += 1
+                endpoint.started.append(time.monotonic())
+                return endpoint
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._wake()  # 受け取った空きを次の待ちに回す
+                raise
+
+    def release(self, endpoint: AivisEndpoint):
+        endpoint.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+
+    def select(self) -> Optional[AivisEndpoint]:
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if not e.is_ejected(now)]
+        candidates = [e for e in healthy or self.endpoints if e.has_capacity()]
+        if not candidates:
+            return None
+        known = [e.latency for e in self.endpoints if e.latency is not None]
+        # 実績の無い接続先は最速と同じとみなし、試しに使われるようにする
+        default_latency = min(known) if known else AIVIS_HEDGE_DEFAULT_DELAY
+        return min(
+            candidates, key=lambda e: (e.cost(default_latency, now), random.random())
+        )
+
+    def record_success(self, endpoint: AivisEndpoint, seconds: float):
+        """応答を受け取り始めるまでの時間を記録し、遅すぎる接続先を外す"""
+        if endpoint.latency is None:
+            endpoint.latency = seconds
+        else:
+            alpha = endpoint.LATENCY_ALPHA
+            endpoint.latency += alpha * (seconds - endpoint.latency)
+        endpoint.samples += 1
+        endpoint.failures = 0
+        now = time.monotonic()
+        others = [
+            e.latency
+            for e in self.endpoints
+            if e is not endpoint
+            and e.samples >= e.MIN_SAMPLES
+            and not e.is_ejected(now)
+        ]
+        if (
+            others
+            and endpoint.samples >= endpoint.MIN_SAMPLES
+            and endpoint.latency > self.slow_factor * statistics.median(others)
+        ):
+            self.eject(endpoint, f"slow ({endpoint.latency:.2f}s)")
+        elif endpoint.samples >= endpoint.MIN_SAMPLES:
+            endpoint.ejections = 0
+
+    def record_failure(self, endpoint: AivisEndpoint, error: BaseException):
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            self.eject(endpoint, f"{endpoint.failures} failures, last: {error!r}")
+
+    def eject(self, endpoint: AivisEndpoint, reason: str):
+        if len(self.endpoints) < 2:
+            return  # 1つだけの場合はサーキットブレーカーに任せる
+        endpoint.ejections += 1
+        duration = min(
+            self.eject_seconds * endpoint.ejections, AIVIS_ENDPOINT_MAX_EJECT
+        )
+        endpoint.ejected_until = time.monotonic() + duration
+        # 戻したときに古い実績で再び外されないよう、測り直す
+        endpoint.failures = 0
+        endpoint.latency = None
+        endpoint.samples = 0
+        metrics.inc("endpoint_ejections_total", 1, endpoint.name)
+        log_warning(
+            None,
+            "Ejected Aivis endpoint %s for %.0fs: %s",
+            endpoint.name,
+            duration,
+            reason,
+        )
+
+    def pause(self, endpoint: AivisEndpoint, seconds: float):
+        """429 を返した接続先を Retry-After の間使わない。すべて止まったら全体を止める"""
+        now = time.monotonic()
+        endpoint.ejected_until = max(endpoint.ejected_until, now + seconds)
+        if all(e.is_ejected(now) for e in self.endpoints):
+            synthesis_scheduler.pause_for(
+                min(e.ejected_until for e in self.endpoints) - now
+            )
+        else:
+            log_info(None, "Aivis endpoint %s rate limited.", endpoint.name)
+
+
+def create_endpoint_pool(entries: list) -> EndpointPool:
+    """ "URL|APIキー|重み|同時実行数" を分割したリストから接続先を作る"""
+    endpoints = []
+    for index, fields in enumerate(entries):
+        fields = list(fields) + [""] * (4 - len(fields))
+        url, api_key, weight, concurrency = (field.strip() for field in fields[:4])
+        endpoints.append(
+            AivisEndpoint(
+                f"{index}:{urlparse(url).netloc}",
+                url,
+                api_key or AIVIS_API_KEY,
+                float(weight or 1.0),
+                # 同時実行数は全ワーカーの合計なので、プロセスごとに等分する
+                max(1, int(concurrency) // WORKER_PROCESSES) if concurrency else 0,
+            )
+        )
+    return EndpointPool(
+        endpoints,
+        AIVIS_ENDPOINT_FAILURES,
+        AIVIS_ENDPOINT_SLOW_FACTOR,
+        AIVIS_ENDPOINT_EJECT,
+    )
+
+
+class SpeechBackend(ABC):
+    """音声合成の実行先。synthesize() は音声データ (MP3 / WAV) を返し、失敗したら None"""
+
+    name = ""
+    streaming = False  # stream_speech で受信しながら再生できるか
+
+    def __init__(self, voices: Dict[str, str], budget: float):
+        self.voices = voices
+        # この秒数を超えたら次の実行先でも合成を始める (0 なら待ち続ける)
+        self.budget = budget
+
+    @abstractmethod
+    def voice_for(self, model_uuid: str) -> Optional[str]:
+        """モデルUUIDに対応するこの実行先での声。対応が無ければ None"""
+
+    def has_capacity(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def synthesize(
+        self, text: str, model_uuid: str, speaking_rate: float, guild_id: Optional[str]
+    ) -> Optional[bytes]:
+        """合成した音声データを返す。失敗したら None"""
+
+
+class CloudBackend(SpeechBackend):
+    """Aivis Cloud API (接続先の振り分け・再送・ヘッジは request_speech が行う)"""
+
+    name = "cloud"
+    streaming = True
+
+    def voice_for(self, model_uuid: str) -> Optional[str]:
+        return self.voices.get(model_uuid, model_uuid)
+
+    async def synthesize(
+        self, text: str, model_uuid: str, speaking_rate: float, guild_id: Optional[str]
+    ) -> Optional[bytes]:
+        return await request_speech(
+            text, self.voice_for(model_uuid), speaking_rate, guild_id
+        )
+
+
+class LocalEngineBackend(SpeechBackend):
+    """AivisSpeech Engine 互換のサーバー (/audio_query → /synthesis で WAV を返す)"""
+
+    name = "local"
+
+    def __init__(
+        self, url: str, voices: Dict[str, str], budget: float, max_concurrency: int
+    ):
+        super().__init__(voices, budget)
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        # モジュールの読み込み時にはまだイベントループが無いため、初回の合成時に作る
+        self._limit: Optional[asyncio.Semaphore] = None
+
+    def voice_for(self, model_uuid: str) -> Optional[str]:
+        return self.voices.get(model_uuid, self.voices.get("*"))
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.max_concurrency
+
+    async def synthesize(
+        self, text: str, model_uuid: str, speaking_rate: float, guild_id: Optional[str]
+    ) -> Optional[bytes]:
+        voice = self.voice_for(model_uuid)
+        timeout = aiohttp.ClientTimeout(total=AIVIS_REQUEST_TIMEOUT)
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight += 1
+        try:
+            async with self._limit:
+                started = time.monotonic()
+                async with bot.http_session.post(
+                    f"{self.url}/audio_query",
+                    params={"text": text, "speaker": voice},
+                    timeout=timeout,
+                ) as response:
+                    if response.status != 200:
+                        raise AivisAPIError(response.status, await response.text())
+                    query = await response.json()
+                query["speedScale"] = speaking_rate
+                async with bot.http_session.post(
+                    f"{self.url}/synthesis",
+                    params={"speaker": voice},
+                    json=query,
+                    timeout=timeout,
+                ) as response:
+                    if response.status != 200:
+                        raise AivisAPIError(response.status, await response.text())
+                    data = await response.read()
+            metrics.observe("synthesis_seconds", time.monotonic() - started, model_uuid)
+            return data
+        except Exception as e:
+            log_warning(guild_id, "Local TTS engine error: %r", e, sample=True)
+            return None
+        finally:
+            self.in_flight -= 1
+
+
+def route_backends(text: str, model_uuid: str, kind: str) -> list:
+    """合成を試す実行先を優先順に返す。
+
+    短い文章と通知はローカルを先にし、それ以外とローカルが埋まっている場合は
+    クラウドを先にする。声の対応が無い実行先は使わない。
+    """
+    usable = [b for b in speech_backends if b.voice_for(model_uuid) is not None]
+    if (
+        local_backend in usable
+        and (kind != "message" or len(text) <= TTS_LOCAL_MAX_CHARS)
+        and local_backend.has_capacity()
+    ):
+        usable.remove(local_backend)
+        usable.insert(0, local_backend)
+    return usable
+
+
+async def synthesize_with_backends(
+    backends: list,
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str],
+) -> Optional[bytes]:
+    """実行先を順に試す。
+
+    失敗したら次へ進み、制限時間 (budget) を超えたら次の実行先でも並行して合成し、
+    先に成功した方を使う。
+    """
+    remaining = list(backends)
+    running: Dict[asyncio.Task, SpeechBackend] = {}
+
+    def start_next() -> Optional[SpeechBackend]:
+        if not remaining:
+            return None
+        backend = remaining.pop(0)
+        metrics.inc("backend_requests_total", 1, backend.name)
+        task = asyncio.create_task(
+            backend.synthesize(text, model_uuid, speaking_rate, guild_id)
+        )
+        running[task] = backend
+        return backend
+
+    current = start_next()
+    try:
+        while running:
+            budget = current.budget if remaining and current.budget else None
+            done, _ = await asyncio.wait(
+                running, timeout=budget, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                log_info(
+                    guild_id,
+                    "TTS backend %s exceeded %.1fs, also trying %s.",
+                    current.name,
+                    budget,
+                    remaining[0].name,
+                )
+                metrics.inc("backend_fallbacks_total", 1, current.name)
+                current = start_next()
+                continue
+            for task in done:
+                backend = running.pop(task)
+                if task.result():
+                    return task.result()
+                if remaining:
+                    log_info(
+                        guild_id, "TTS backend %s failed, falling back.", backend.name
+                    )
+                    metrics.inc("backend_fallbacks_total", 1, backend.name)
+                    current = start_next()
+        return None
+    finally:
+        for task in running:
+            task.cancel()
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    if isinstance(error, AivisAPIError):
+        return error.retryable
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError))
+
+
+def retry_delay(error: BaseException, attempt: int) -> float:
+    """再送までの待ち時間 (指数バックオフ + フルジッター)"""
+    if isinstance(error, AivisAPIError) and error.status == 429:
+        # 待ち時間はスケジューラーの一時停止で守られる
+        return 0.0
+    return random.uniform(0, AIVIS_RETRY_BASE_DELAY * (2**attempt))
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Retry-After ヘッダー (秒数または HTTP 日付) を秒数に変換する"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+# --- グローバル変数 --- (変更なし)
+guild_sessions: Dict[str, GuildSession] = {}
+dictionaries: Dict[str, Dict[str, str]] = {}
+user_settings: Dict[str, Dict] = {}
+guild_settings: Dict[str, Dict] = {}
+dictionary_matchers: Dict[str, DictionaryMatcher] = {}
+# 辞書が変更されるたびに進む版番号と、実行中のマッチャーの構築
+dictionary_versions: Dict[str, int] = {}
+dictionary_builds: Dict[str, asyncio.Task] = {}
+store = SettingsStore(
+    RedisBackend(REDIS_URL) if STORE_BACKEND == "redis" else SQLiteBackend(DB_FILE),
+    STORE_FLUSH_INTERVAL,
+    STORE_SYNC_INTERVAL,
+)
+# API の上限は全ワーカーの合計なので、プロセスごとに等分する
+synthesis_scheduler = SynthesisScheduler(
+    AIVIS_RATE_LIMIT / WORKER_PROCESSES,
+    max(1, AIVIS_RATE_BURST // WORKER_PROCESSES),
+    max(1, AIVIS_MAX_CONCURRENCY // WORKER_PROCESSES),
+    AIVIS_GUILD_WEIGHTS,
+)
+api_latency = LatencyTracker()
+endpoint_pool = create_endpoint_pool(AIVIS_ENDPOINTS or [[AIVIS_API_URL]])
+cloud_backend = CloudBackend(TTS_CLOUD_MODELS, TTS_CLOUD_BUDGET)
+local_backend: Optional[LocalEngineBackend] = None
+if TTS_LOCAL_URL:
+    local_backend = LocalEngineBackend(
+        TTS_LOCAL_URL, TTS_LOCAL_SPEAKERS, TTS_LOCAL_BUDGET, TTS_LOCAL_CONCURRENCY
+    )
+speech_backends = [cloud_backend] + ([local_backend] if local_backend else [])
+api_circuit = CircuitBreaker(AIVIS_CIRCUIT_THRESHOLD, AIVIS_CIRCUIT_RESET)
+speech_cache = SpeechCache(
+    AUDIO_CACHE_MEMORY_MB * 1024 * 1024,
+    AUDIO_CACHE_DIR if AUDIO_CACHE_DISK_ENABLED else None,
+    AUDIO_CACHE_DISK_MB * 1024 * 1024,
+)
+metrics = Metrics("aivis_tts")
+metrics.counter("messages_total", "Messages added to the speech queue.")
+metrics.counter(
+    "dropped_items_total", "Speech items discarded before playback.", "reason"
+)
+metrics.counter("failed_items_total", "Speech items that failed to synthesize.")
+metrics.counter("received_bytes_total", "Audio bytes received from the Aivis API.")
+metrics.counter(
+    "endpoint_ejections_total", "Aivis endpoints taken out of rotation.", "endpoint"
+)
+metrics.collector(
+    "startup_phase_seconds",
+    "Time spent in each startup phase.",
+    lambda: dict(startup_phases),
+    "phase",
+)
+metrics.counter(
+    "sessions_restored_total",
+    "Saved sessions processed at startup by result.",
+    "result",
+)
+metrics.counter(
+    "backend_requests_total", "Synthesis attempts per TTS backend.", "backend"
+)
+metrics.counter(
+    "backend_fallbacks_total",
+    "Times a TTS backend failed or ran over its budget.",
+    "backend",
+)
+metrics.counter("idle_disconnects_total", "Sessions closed automatically.", "reason")
+metrics.histogram(
+    "synthesis_seconds",
+    "Speech synthesis time including retries (cloud and local engine).",
+    METRICS_LATENCY_BUCKETS,
+    "model_uuid",
+)
+metrics.histogram(
+    "ffmpeg_spawn_seconds", "Time to start an ffmpeg decoder.", METRICS_LAG_BUCKETS
+)
+metrics.histogram(
+    "ffmpeg_decode_seconds", "Time spent decoding one clip.", METRICS_LATENCY_BUCKETS
+)
+metrics.histogram(
+    "pcm_convert_seconds",
+    "Time spent converting one WAV clip in-process.",
+    METRICS_LAG_BUCKETS,
+)
+metrics.histogram(
+    "playback_seconds", "Playback duration of one clip.", METRICS_LATENCY_BUCKETS
+)
+metrics.histogram(
+    "end_to_end_seconds",
+    "Time from receiving a message to the start of its audio.",
+    METRICS_LATENCY_BUCKETS,
+)
+metrics.histogram(
+    "event_loop_lag_seconds", "Event loop scheduling delay.", METRICS_LAG_BUCKETS
+)
+metrics.collector(
+    "queue_depth",
+    "Speech items waiting per guild, including prefetched ones.",
+    lambda: {
+        guild_id: session.queue.qsize() + len(session.prefetched)
+        for guild_id, session in guild_sessions.items()
+    },
+    "guild_id",
+)
+metrics.collector(
+    "active_sessions",
+    "Guilds with an active voice session.",
+    lambda: {"": len(guild_sessions)},
+)
+metrics.collector(
+    "active_players",
+    "Guilds with a running player task.",
+    lambda: {
+        "": sum(
+            1
+            for session in guild_sessions.values()
+            if session.player_task and not session.player_task.done()
+        )
+    },
+)
+metrics.collector(
+    "endpoint_in_flight",
+    "Aivis requests in flight per endpoint.",
+    lambda: {e.name: e.in_flight for e in endpoint_pool.endpoints},
+)
+metrics.collector(
+    "endpoint_latency_seconds",
+    "Moving average of the response time per endpoint.",
+    lambda: {
+        e.name: e.latency for e in endpoint_pool.endpoints if e.latency is not None
+    },
+)
+metrics.collector(
+    "api_in_flight",
+    "Aivis requests in flight.",
+    lambda: {"": synthesis_scheduler.in_flight},
+)
+metrics.collector(
+    "api_waiting",
+    "Aivis requests waiting for a slot.",
+    lambda: {"": synthesis_scheduler.waiting},
+)
+metrics.collector(
+    "cache_lookups_total",
+    "Speech cache lookups by result.",
+    lambda: {
+        "memory_hit": speech_cache.memory_hits,
+        "disk_hit": speech_cache.disk_hits,
+        "deduplicated": speech_cache.deduplicated,
+        "miss": speech_cache.misses,
+    },
+    "result",
+    kind="counter",
+)
+
+
+# --- ヘルパー関数 --- (変更なし)
+def load_data(filepath: str) -> dict:
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+async def get_dictionary_matcher(guild_id: str) -> DictionaryMatcher:
+    """ギルド辞書のマッチャーを返す。
+
+    作り直している間は前のマッチャーを使い続け、まだ1つも無いときだけ完成を待つ。
+    """
+    matcher = dictionary_matchers.get(guild_id)
+    if matcher is not None:
+        return matcher
+    return await build_dictionary_matcher(guild_id)
+
+
+def build_dictionary_matcher(guild_id: str) -> asyncio.Task:
+    """マッチャーの構築を開始する (実行中ならそのタスクを返す)"""
+    task = dictionary_builds.get(guild_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_build_dictionary_matcher(guild_id))
+        dictionary_builds[guild_id] = task
+
+        def forget(_):
+            if dictionary_builds.get(guild_id) is task:
+                del dictionary_builds[guild_id]
+
+        task.add_done_callback(forget)
+    return task
+
+
+async def _build_dictionary_matcher(guild_id: str) -> DictionaryMatcher:
+    # 大きな辞書の正規表現の構築は数百ミリ秒かかるため、イベントループの外で行う
+    loop = asyncio.get_running_loop()
+    while True:
+        version = dictionary_versions.get(guild_id, 0)
+        words = dict(dictionaries.get(guild_id, {}))
+        matcher = await loop.run_in_executor(None, DictionaryMatcher, words)
+        if dictionary_versions.get(guild_id, 0) == version:
+            dictionary_matchers[guild_id] = matcher
+            return matcher
+        # 構築中にさらに変更されたので、最新の辞書で作り直す
+
+
+def invalidate_dictionary_matcher(guild_id: str):
+    """辞書の変更後に呼ぶ。使用中のマッチャーはすぐに作り直しを始める"""
+    dictionary_versions[guild_id] = dictionary_versions.get(guild_id, 0) + 1
+    if guild_id in dictionary_matchers or guild_id in guild_sessions:
+        build_dictionary_matcher(guild_id)
+
+
+def drop_dictionary_matcher(guild_id: str):
+    """使われなくなったギルドのマッチャーを捨てる"""
+    dictionary_versions[guild_id] = dictionary_versions.get(guild_id, 0) + 1
+    dictionary_matchers.pop(guild_id, None)
+
+
+def apply_store_change(namespace: str, owner: str, data: Dict):
+    """他のプロセスでの設定変更を、メモリ上のデータに反映する"""
+    target = {
+        NS_DICTIONARIES: dictionaries,
+        NS_USER_SETTINGS: user_settings,
+        NS_GUILD_SETTINGS: guild_settings,
+    }.get(namespace)
+    if target is None:
+        return
+    if data:
+        target[owner] = data
+    else:
+        target.pop(owner, None)
+    if namespace == NS_DICTIONARIES:
+        invalidate_dictionary_matcher(owner)
+    log_debug(None, "Reloaded %s/%s changed by another process.", namespace, owner)
+
+
+def worker_shard_ids(index: int, workers: int, shard_count: int) -> list:
+    """ワーカー index が担当する、連続したシャード番号の範囲"""
+    start = shard_count * index // workers
+    end = shard_count * (index + 1) // workers
+    return list(range(start, end))
+
+
+def get_prefetch_count(guild_id: str) -> int:
+    return guild_settings.get(guild_id, {}).get(
+        "prefetch_count", DEFAULT_PREFETCH_COUNT
+    )
+
+
+def get_queue_limits(guild_id: str) -> QueueLimits:
+    settings = guild_settings.get(guild_id, {})
+    return QueueLimits(
+        settings.get("queue_max_items", DEFAULT_QUEUE_MAX_ITEMS),
+        settings.get("queue_max_chars", DEFAULT_QUEUE_MAX_CHARS),
+        settings.get("queue_max_seconds", DEFAULT_QUEUE_MAX_SECONDS),
+        settings.get("overflow_policy", DEFAULT_OVERFLOW_POLICY),
+    )
+
+
+def record_playback(clip: PCMClip):
+    if clip.started:
+        metrics.observe("playback_seconds", clip.finished_at - clip.started_at)
+
+
+def create_embed(
+    title: str, description: str, color: discord.Color = discord.Color.blue()
+) -> discord.Embed:
+    return discord.Embed(title=title, description=description, color=color)
+
+
+# --- メトリクス ---
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=metrics.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # ワーカープロセスごとに別のポートで待ち受ける
+    port = METRICS_PORT + (WORKER_INDEX or 0)
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    log_info(None, "Metrics endpoint listening on %s:%d.", METRICS_HOST, port)
+    return runner
+
+
+async def monitor_event_loop_lag():
+    """一定間隔で眠り、予定より遅れて起きた時間をイベントループの遅延として記録する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_INTERVAL
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        metrics.observe("event_loop_lag_seconds", max(0.0, loop.time() - expected))
+
+
+# --- 起動処理 ---
+PROCESS_STARTED = time.monotonic()
+# 段階名 -> 所要時間 (秒)
+startup_phases: Dict[str, float] = {}
+
+
+@contextmanager
+def startup_phase(name: str):
+    """起動の段階ごとの所要時間を記録する"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_phases[name] = time.monotonic() - started
+        log_info(None, "Startup phase '%s' took %.2fs.", name, startup_phases[name])
+
+
+async def load_settings():
+    """辞書・個人設定・サーバー設定を読み込む (Gateway に接続する前に1回だけ)"""
+    global dictionaries, user_settings, guild_settings
+    if WORKER_INDEX is None:
+        await migrate_legacy_data()
+    else:
+        # 旧データの取り込みはワーカーを起動する前に親プロセスで済ませている
+        await store.open()
+    # 読み込みはストアの専用スレッドで行うため、イベントループは止まらない
+    dictionaries = await store.load(NS_DICTIONARIES)
+    user_settings = await store.load(NS_USER_SETTINGS)
+    guild_settings = await store.load(NS_GUILD_SETTINGS)
+    store.watch(apply_store_change)
+    log_info(
+        None,
+        "Loaded settings: %d dictionaries, %d users, %d guilds.",
+        len(dictionaries),
+        len(user_settings),
+        len(guild_settings),
+    )
+
+
+def command_tree_fingerprint(tree: app_commands.CommandTree) -> str:
+    """Discord に登録されるコマンド定義のハッシュ"""
+    payload = [command.to_dict(tree) for command in tree.get_commands()]
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+async def sync_command_tree(tree: app_commands.CommandTree) -> bool:
+    """コマンド定義が前回の同期から変わったときだけ同期する。同期したら True"""
+    # 別の Bot のトークンで同じデータディレクトリを使った場合も同期し直す
+    fingerprint = f"{tree.client.application_id}:{command_tree_fingerprint(tree)}"
+    loop = asyncio.get_running_loop()
+    synced = await loop.run_in_executor(None, load_data, COMMAND_TREE_FILE)
+    if COMMAND_SYNC != "always" and synced.get("fingerprint") == fingerprint:
+        log_info(None, "Command tree unchanged, skipping sync.")
+        return False
+    commands_synced = await tree.sync()
+    await loop.run_in_executor(
+        None,
+        write_json,
+        COMMAND_TREE_FILE,
+        {"fingerprint": fingerprint, "synced_at": time.time()},
+    )
+    log_info(None, "Synced %d application command(s).", len(commands_synced))
+    return True
+
+
+# --- Botクラスの拡張 --- (変更なし)
+class AivisBot(commands.AutoShardedBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self.metrics_runner: Optional[web.AppRunner] = None
+        self.lag_monitor: Optional[asyncio.Task] = None
+        self.session_reaper: Optional[asyncio.Task] = None
+        self.session_persister: Optional[asyncio.Task] = None
+        # setup_hook が終わった時刻 (Gateway への接続時間の計測に使う)
+        self.setup_finished = 0.0
+        # 復元が終わる前に終了した場合は、前回の保存内容を上書きしない
+        self.sessions_restored = False
+
+    async def setup_hook(self):
+        # ここまでがモジュールの読み込みと Discord へのログイン
+        startup_phases["login"] = time.monotonic() - PROCESS_STARTED
+        with startup_phase("settings"):
+            await load_settings()
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(keepalive_timeout=AIVIS_KEEPALIVE_TIMEOUT)
+        )
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server()
+            self.lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+        if SESSION_IDLE_TIMEOUT or SESSION_EMPTY_TIMEOUT:
+            self.session_reaper = asyncio.create_task(reap_idle_sessions())
+        try:
+            # デプロイ時などの SIGTERM でも close() を通し、セッションを保存する
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: asyncio.create_task(self.close())
+            )
+        except NotImplementedError:
+            pass  # Windows
+        self.tree.add_command(vc_commands)
+        self.tree.add_command(tts_commands)
+        self.tree.add_command(dict_commands)
+        self.tree.add_command(setting_commands)
+        # コマンドは全シャード共通なので、同期は1プロセスだけで行う
+        if not WORKER_INDEX:
+            with startup_phase("commands"):
+                await sync_command_tree(self.tree)
+        self.setup_finished = time.monotonic()
+
+    async def close(self):
+        if self.lag_monitor:
+            self.lag_monitor.cancel()
+        if self.session_reaper:
+            self.session_reaper.cancel()
+        if self.session_persister:
+            self.session_persister.cancel()
+        if self.sessions_restored:
+            try:
+                await save_sessions()
+            except Exception as e:
+                log_warning(None, "Failed to save sessions: %s", e)
+            self.sessions_restored = False  # close() が複数回呼ばれても1回だけ保存する
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await store.close()
+        if self.http_session:
+            await self.http_session.close()
+        await super().close()
+
+
+# --- Botの初期化 --- (変更なし)
+intents = discord.Intents.default()
+intents.message_content = True
+intents.voice_states = True
+shard_options = {}
+if WORKER_INDEX is not None:
+    shard_options["shard_count"] = max(SHARD_COUNT, WORKER_PROCESSES)
+    shard_options["shard_ids"] = worker_shard_ids(
+        WORKER_INDEX, WORKER_PROCESSES, shard_options["shard_count"]
+    )
+elif SHARD_COUNT:
+    shard_options["shard_count"] = SHARD_COUNT
+bot = AivisBot(command_prefix="!", intents=intents, **shard_options)
+
+
+# --- 音声合成と再生 ---
+async def synthesize_speech(
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str] = None,
+    kind: str = "message",
+    backends: Optional[list] = None,
+) -> Optional[bytes]:
+    """キャッシュを経由して音声を合成する (実行先は route_backends で選ぶ)"""
+    if backends is None:
+        backends = route_backends(text, model_uuid, kind)
+    return await speech_cache.get_or_fetch(
+        text,
+        model_uuid,
+        speaking_rate,
+        lambda: synthesize_with_backends(
+            backends, text, model_uuid, speaking_rate, guild_id
+        ),
+    )
+
+
+def build_speech_request(
+    endpoint: AivisEndpoint, text: str, model_uuid: str, speaking_rate: float
+) -> dict:
+    headers = {
+        "Authorization": f"Bearer {endpoint.api_key}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "model_uuid": model_uuid,
+        "text": text,
+        "output_format": AIVIS_OUTPUT_FORMAT,
+        "speaking_rate": speaking_rate,
+    }
+    return {"url": endpoint.url, "json": payload, "headers": headers}
+
+
+async def raise_for_speech_status(
+    response: aiohttp.ClientResponse, endpoint: AivisEndpoint, started: float
+):
+    if response.status == 200:
+        endpoint_pool.record_success(endpoint, time.monotonic() - started)
+        return
+    retry_after = None
+    if response.status == 429:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        endpoint_pool.pause(endpoint, retry_after)
+    raise AivisAPIError(response.status, await response.text(), retry_after)
+
+
+@asynccontextmanager
+async def api_slot(guild_id: Optional[str]):
+    """API を1回呼び出す間、スケジューラーの実行枠と接続先を確保する"""
+    async with synthesis_scheduler.slot(guild_id):
+        async with endpoint_pool.lease() as endpoint:
+            yield endpoint
+
+
+def attempt_timeout(deadline: float) -> aiohttp.ClientTimeout:
+    """1回の呼び出しの制限時間 (全体の期限を超えない)"""
+    # total=0 は「制限なし」になるため、期限切れでもごく短い値にする
+    remaining = max(deadline - time.monotonic(), 0.001)
+    return aiohttp.ClientTimeout(total=min(AIVIS_REQUEST_TIMEOUT, remaining))
+
+
+async def request_speech_once(
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str],
+    deadline: float,
+) -> bytes:
+    """API を1回だけ呼び出す (制限時間つき)"""
+    async with api_slot(guild_id) as endpoint:
+        started = time.monotonic()
+        async with bot.http_session.post(
+            **build_speech_request(endpoint, text, model_uuid, speaking_rate),
+            timeout=attempt_timeout(deadline),
+        ) as response:
+            await raise_for_speech_status(response, endpoint, started)
+            data = await response.read()
+        api_latency.record(time.monotonic() - started)
+        metrics.inc("received_bytes_total", len(data))
+        return data
+
+
+async def request_speech_hedged(
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str],
+    deadline: float,
+) -> bytes:
+    """p95 の所要時間を過ぎても応答が無ければ2本目を送り、先に成功した方を使う"""
+    first = asyncio.create_task(
+        request_speech_once(text, model_uuid, speaking_rate, guild_id, deadline)
+    )
+    if not AIVIS_HEDGE:
+        return await first
+    tasks = {first}
+    try:
+        hedge_delay = api_latency.percentile(0.95) or AIVIS_HEDGE_DEFAULT_DELAY
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        # 混雑中はヘッジで他のギルドの枠を奪わない
+        if not done and synthesis_scheduler.waiting == 0:
+            log_debug(guild_id, "Hedging Aivis request after %.2fs.", hedge_delay)
+            tasks.add(
+                asyncio.create_task(
+                    request_speech_once(
+                        text, model_uuid, speaking_rate, guild_id, deadline
+                    )
+                )
+            )
+        error: Optional[BaseException] = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def request_speech(
+    text: str, model_uuid: str, speaking_rate: float, guild_id: Optional[str] = None
+) -> Optional[bytes]:
+    if not api_circuit.allow():
+        log_warning(
+            guild_id, "Aivis API circuit is open, skipping synthesis.", sample=True
+        )
+        return None
+    started = time.monotonic()
+    try:
+        # 実行枠の待ち時間も含めて、再送を含む全体を期限内に収める
+        return await asyncio.wait_for(
+            request_speech_with_retries(
+                text, model_uuid, speaking_rate, guild_id, started
+            ),
+            AIVIS_DEADLINE,
+        )
+    except asyncio.TimeoutError:
+        api_circuit.record_failure()
+        log_error(
+            guild_id, "Aivis request exceeded the %.1fs deadline.", AIVIS_DEADLINE
+        )
+        return None
+
+
+async def request_speech_with_retries(
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str],
+    started: float,
+) -> Optional[bytes]:
+    deadline = started + AIVIS_DEADLINE
+    for attempt in itertools.count():
+        try:
+            data = await request_speech_hedged(
+                text, model_uuid, speaking_rate, guild_id, deadline
+            )
+            api_circuit.record_success()
+            metrics.observe("synthesis_seconds", time.monotonic() - started, model_uuid)
+            return data
+        except Exception as e:
+            if not is_retryable_error(e):
+                # リクエスト内容の問題で、API 自体は動いている
+                api_circuit.record_success()
+                log_error(guild_id, "Aivis API Error: %s", e)
+                return None
+            delay = retry_delay(e, attempt)
+            if attempt >= AIVIS_MAX_RETRIES or time.monotonic() + delay > deadline:
+                api_circuit.record_failure()
+                log_error(guild_id, "Error while contacting Aivis API: %r", e)
+                return None
+            log_info(guild_id, "Retrying Aivis request in %.2fs: %r", delay, e)
+            await asyncio.sleep(delay)
+
+
+async def open_speech_stream(
+    stack: AsyncExitStack,
+    text: str,
+    model_uuid: str,
+    speaking_rate: float,
+    guild_id: Optional[str],
+) -> Tuple[AsyncIterator[bytes], bytes]:
+    """実行枠を確保してリクエストを送り、(残りのチャンク, 最初のチャンク) を返す。
+
+    実行枠とレスポンスは stack に登録し、受信が終わるまで保持する。
+    """
+    endpoint = await stack.enter_async_context(api_slot(guild_id))
+    started = time.monotonic()
+    response = await stack.enter_async_context(
+        bot.http_session.post(
+            **build_speech_request(endpoint, text, model_uuid, speaking_rate),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=AIVIS_REQUEST_TIMEOUT,
+                sock_read=AIVIS_REQUEST_TIMEOUT,
+            ),
+        )
+    )
+    await raise_for_speech_status(response, endpoint, started)
+    chunks = response.content.iter_chunked(STREAM_CHUNK_SIZE)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b""
+    return chunks, first
+
+
+async def stream_speech(
+    text: str, model_uuid: str, speaking_rate: float, guild_id: Optional[str] = None
+) -> AsyncIterator[bytes]:
+    """レスポンス本文を受信したチャンクから順に返す。
+
+    実行枠の確保から最初のチャンクの受信までを AIVIS_DEADLINE 以内に収め、
+    受信を始める前のエラーだけ再送する。その後はチャンクの間隔が制限時間を
+    超えたら中断する。
+    """
+    if not api_circuit.allow():
+        log_warning(
+            guild_id, "Aivis API circuit is open, skipping synthesis.", sample=True
+        )
+        return
+    started = time.monotonic()
+    deadline = started + AIVIS_DEADLINE
+    yielded = False
+    for attempt in itertools.count():
+        try:
+            async with AsyncExitStack() as stack:
+                chunks, first = await asyncio.wait_for(
+                    open_speech_stream(
+                        stack, text, model_uuid, speaking_rate, guild_id
+                    ),
+                    max(deadline - time.monotonic(), 0.001),
+                )
+                if first:
+                    yielded = True
+                    metrics.inc("received_bytes_total", len(first))
+                    yield first
+                async for chunk in chunks:
+                    yielded = True
+                    metrics.inc("received_bytes_total", len(chunk))
+                    yield chunk
+            api_circuit.record_success()
+            metrics.observe("synthesis_seconds", time.monotonic() - started, model_uuid)
+            return
+        except Exception as e:
+            if not is_retryable_error(e):
+                api_circuit.record_success()
+                log_error(guild_id, "Aivis API Error: %s", e)
+                return
+            delay = retry_delay(e, attempt)
+            if (
+                yielded
+                or attempt >= AIVIS_MAX_RETRIES
+                or time.monotonic() + delay > deadline
+            ):
+                api_circuit.record_failure()
+                if not yielded and time.monotonic() >= deadline:
+                    log_error(
+                        guild_id,
+                        "Aivis stream exceeded the %.1fs deadline.",
+                        AIVIS_DEADLINE,
+                    )
+                raise
+            log_info(guild_id, "Retrying Aivis stream in %.2fs: %r", delay, e)
+            await asyncio.sleep(delay)
+
+
+def audio_format(audio_data: bytes) -> str:
+    """実行先によって MP3 と WAV が混ざるため、先頭を見て形式を判定する"""
+    return "wav" if audio_data[:4] == b"RIFF" else "mp3"
+
+
+async def spawn_decoder(
+    input_format: str = AIVIS_OUTPUT_FORMAT,
+) -> asyncio.subprocess.Process:
+    """合成音声を 48kHz/16bit/ステレオの生PCMに変換する ffmpeg を起動する"""
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_EXECUTABLE,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        # 入力形式を固定し、ストリームの解析待ちで出力が遅れないようにする
+        "-f",
+        input_format,
+        "-probesize",
+        "32",
+        "-analyzeduration",
+        "0",
+        "-i",
+        "pipe:0",
+        "-vn",
+        "-f",
+        "s16le",
+        "-ar",
+        str(PCM_SAMPLE_RATE),
+        "-ac",
+        str(PCM_CHANNELS),
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    metrics.observe("ffmpeg_spawn_seconds", time.monotonic() - started)
+    return process
+
+
+async def stop_decoder(process: asyncio.subprocess.Process):
+    """ffmpeg を止めて終了を待つ。
+
+    読まれずに止まった出力パイプは閉じられず wait() が返らないため、残りを読み捨てる。
+    """
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    await process.communicate()
+
+
+async def decode_to_pcm(audio_data: bytes) -> Optional[bytes]:
+    """音声データ全体を一度に生PCMへ変換する"""
+    process = await spawn_decoder(audio_format(audio_data))
+    started = time.monotonic()
+    try:
+        pcm, error = await process.communicate(audio_data)
+        metrics.observe("ffmpeg_decode_seconds", time.monotonic() - started)
+    finally:
+        await stop_decoder(process)
+    if process.returncode != 0:
+        log_error(
+            None, "ffmpeg decode error: %s", error.decode(errors="replace").strip()
+        )
+        return None
+    return pcm
+
+
+async def decode_stream(
+    chunks: AsyncIterator[bytes], clip: PCMClip, first_audio: asyncio.Future
+) -> bytes:
+    """受信中の音声データを逐次デコードしてクリップに書き込む。
+
+    最初のPCMが得られた時点で first_audio を完了させ、受信した元データ全体を返す。
+    """
+    process = await spawn_decoder()
+    started = time.monotonic()
+    received = bytearray()
+
+    async def pump_input():
+        try:
+            async for chunk in chunks:
+                received.extend(chunk)
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        finally:
+            process.stdin.close()
+
+    writer = asyncio.create_task(pump_input())
+    try:
+        while True:
+            pcm = await process.stdout.read(PCM_FRAME_SIZE * 8)
+            if not pcm:
+                break
+            clip.feed(pcm)
+            if not first_audio.done():
+                first_audio.set_result(True)
+        await writer
+        await process.wait()
+        metrics.observe("ffmpeg_decode_seconds", time.monotonic() - started)
+        return bytes(received) if process.returncode == 0 else b""
+    finally:
+        clip.finish()
+        if not first_audio.done():
+            first_audio.set_result(False)
+        if not writer.done():
+            writer.cancel()
+        await stop_decoder(process)
+
+
+def convert_wav(audio_data: bytes, volume: float) -> Optional[bytes]:
+    """WAV 全体をプロセス内で生PCMへ変換する。対応していない形式なら None を返す"""
+    started = time.monotonic()
+    converter = PCMConverter(volume)
+    try:
+        pcm = converter.feed(audio_data)
+    except ValueError as e:
+        log_warning(None, "Falling back to ffmpeg for WAV: %s", e, sample=True)
+        return None
+    if not converter.sample_rate:
+        log_warning(None, "Falling back to ffmpeg for truncated WAV.", sample=True)
+        return None
+    metrics.observe("pcm_convert_seconds", time.monotonic() - started)
+    return pcm
+
+
+async def convert_stream(
+    chunks: AsyncIterator[bytes], clip: PCMClip, first_audio: asyncio.Future
+) -> bytes:
+    """受信中の WAV をプロセス内で逐次変換してクリップに書き込む (decode_stream の代わり)。
+
+    ヘッダーが対応していない形式だった場合は ffmpeg での変換に切り替える。
+    """
+    converter = PCMConverter(clip.applied_volume)
+    received = bytearray()
+    async for chunk in chunks:
+        received.extend(chunk)
+        try:
+            pcm = converter.feed(chunk)
+        except ValueError as e:
+            log_warning(None, "Falling back to ffmpeg for WAV: %s", e, sample=True)
+            clip.applied_volume = 1.0
+            return await decode_stream(
+                resume_stream(bytes(received), chunks), clip, first_audio
+            )
+        if pcm:
+            clip.feed(pcm)
+            if not first_audio.done():
+                first_audio.set_result(True)
+    clip.finish()
+    if not first_audio.done():
+        first_audio.set_result(False)
+    return bytes(received) if converter.sample_rate else b""
+
+
+async def resume_stream(
+    received: bytes, chunks: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    yield received
+    async for chunk in chunks:
+        yield chunk
+
+
+async def audio_to_pcm(audio_data: bytes, volume: float = 1.0) -> Optional[bytes]:
+    """合成音声を生PCMにし、volume を掛けて返す"""
+    if audio_format(audio_data) == "wav":
+        pcm = convert_wav(audio_data, volume)
+        if pcm is not None:
+            return pcm
+    pcm = await decode_to_pcm(audio_data)
+    if pcm and volume != 1.0:
+        pcm = audioop.mul(pcm, 2, volume)
+    return pcm
+
+
+def conversion_volume(guild_id: str, user_volume: float) -> float:
+    """変換時にまとめて掛ける音量。0 を掛けると後から戻せないため、その場合は掛けない"""
+    session = guild_sessions.get(guild_id)
+    server_volume = session.server_volume if session else 1.0
+    volume = server_volume * user_volume
+    return volume if volume > 0 else 1.0
+
+
+async def prepare_clip(
+    guild_id: str,
+    text: str,
+    model_uuid: str,
+    rate: float,
+    user_volume: float,
+    kind: str = "message",
+) -> Optional[PCMClip]:
+    """再生できる状態のクリップを作る。
+
+    キャッシュに無くクラウドで合成する場合はストリーミングで合成し、最初の音声が
+    デコードされた時点で (残りを受信しながら) クリップを返す。
+    長いメッセージは文ごとに分けて合成する。
+    """
+    if SPLIT_MIN_CHARS and len(text) >= SPLIT_MIN_CHARS:
+        segments = split_sentences(text)
+        if len(segments) > 1:
+            return await prepare_segmented_clip(
+                guild_id, segments, model_uuid, rate, user_volume
+            )
+
+    audio_data = None
+    backends = route_backends(text, model_uuid, kind)
+    if STREAMING_SYNTHESIS and backends and backends[0].streaming:
+        audio_data = await speech_cache.lookup(text, model_uuid, rate)
+        if audio_data is None and not speech_cache.is_fetching(text, model_uuid, rate):
+            clip = await prepare_streaming_clip(
+                guild_id, text, model_uuid, rate, user_volume
+            )
+            if clip or len(backends) == 1:
+                return clip
+            # 最初の音声が届く前に失敗した場合は、残りの実行先で合成する
+            backends = backends[1:]
+
+    if audio_data is None:
+        audio_data = await synthesize_speech(
+            text, model_uuid, rate, guild_id, kind, backends
+        )
+    if not audio_data:
+        return None
+    volume = conversion_volume(guild_id, user_volume)
+    pcm = await audio_to_pcm(audio_data, volume)
+    if not pcm:
+        return None
+    clip = PCMClip(user_volume, volume)
+    clip.feed(pcm)
+    clip.finish()
+    return clip
 
-DATA_DIR = "data"
-DICT_FILE = f"{DATA_DIR}/dictionaries.json"
-SETTINGS_FILE = f"{DATA_DIR}/user_settings.json"
 
-# 絵文字 (変更なし)
-EMOJI_SUCCESS = "✅"
-EMOJI_ERROR = "❌"
-EMOJI_INFO = "ℹ️"
-EMOJI_VC = "🔊"
-EMOJI_TTS = "💬"
-EMOJI_DICT = "📖"
-EMOJI_SETTING = "⚙️"
-EMOJI_HELP = "🤖"
-EMOJI_WAVE = "👋"
-EMOJI_QUEUE = "🎵"
-EMOJI_MUTE = "🔇"
-EMOJI_PAUSE = "⏸️"
-EMOJI_RESUME = "▶️"
+def split_sentences(text: str) -> list:
+    """文末で区切る。SEGMENT_MIN_CHARS より短い文は次の文とまとめる"""
+    segments = []
+    current = ""
+    for match in SENTENCE_PATTERN.finditer(text):
+        current += match.group()
+        if len(current.strip()) >= SEGMENT_MIN_CHARS:
+            segments.append(current.strip())
+            current = ""
+    if current.strip():
+        if segments and len(current.strip()) < SEGMENT_MIN_CHARS:
+            segments[-1] += current.rstrip()
+        else:
+            segments.append(current.strip())
+    return segments
 
 
-# --- デバッグログ用ヘルパー ---
-def log_debug(guild_id: Optional[str], message: str):
-    """コンソールにデバッグログを出力する"""
-    guild_tag = f"[{guild_id or 'GLOBAL'}]"
-    print(f"[DEBUG] {guild_tag} {message}")
+async def prepare_segmented_clip(
+    guild_id: str, segments: list, model_uuid: str, rate: float, user_volume: float
+) -> Optional[PCMClip]:
+    """文ごとに並行して合成し、先頭から順にクリップへ書き込む。
 
+    最初の文がデコードできた時点でクリップを返し、残りは再生しながら書き足す。
+    各文は個別にキャッシュされる。
+    """
+    volume = conversion_volume(guild_id, user_volume)
+    clip = PCMClip(user_volume, volume)
+    first_audio = asyncio.get_running_loop().create_future()
+    limit = asyncio.Semaphore(SEGMENT_CONCURRENCY)
 
-# --- データクラス ---
-class GuildSession:
-    def __init__(self, bot_loop: asyncio.AbstractEventLoop, guild_id: str):
-        self.voice_client: Optional[discord.VoiceClient] = None
-        self.text_channel_id: Optional[int] = None
-        self.queue = asyncio.Queue()
-        self.is_muted: bool = False
-        self.server_volume: float = 0.75
-        log_debug(guild_id, "Creating new player task...")
-        self.player_task = bot_loop.create_task(audio_player_task(guild_id))
+    async def synthesize(segment: str) -> Optional[bytes]:
+        async with limit:
+            return await synthesize_speech(segment, model_uuid, rate, guild_id)
 
-    def stop(self):
-        log_debug(
-            self.voice_client.guild.id if self.voice_client else None,
-            "GuildSession.stop() called.",
-        )
-        if self.player_task and not self.player_task.done():
-            self.player_task.cancel()
-            log_debug(
-                self.voice_client.guild.id if self.voice_client else None,
-                "Player task cancelled.",
-            )
-        self.voice_client = None
+    async def produce():
+        # セマフォは待った順に空くので、先頭の文から合成が始まる
+        tasks = [asyncio.create_task(synthesize(segment)) for segment in segments]
+        try:
+            for segment, task in zip(segments, tasks):
+                audio_data = await task
+                pcm = await audio_to_pcm(audio_data, volume) if audio_data else None
+                if not pcm:
+                    log_warning(
+                        guild_id, "Skipping segment that failed: '%.30s...'", segment
+                    )
+                    continue
+                clip.feed(pcm)
+                if not first_audio.done():
+                    first_audio.set_result(True)
+        except Exception as e:
+            log_error(guild_id, "Error while synthesizing segments: %s", e)
+        finally:
+            for task in tasks:
+                task.cancel()
+            clip.finish()
+            if not first_audio.done():
+                first_audio.set_result(False)
 
+    clip.producer = asyncio.create_task(produce())
+    try:
+        has_audio = await asyncio.shield(first_audio)
+    except asyncio.CancelledError:
+        release_clip(clip)
+        raise
+    return clip if has_audio else None
 
-# --- グローバル変数 --- (変更なし)
-guild_sessions: Dict[str, GuildSession] = {}
-dictionaries: Dict[str, Dict[str, str]] = {}
-user_settings: Dict[str, Dict] = {}
 
+async def prepare_streaming_clip(
+    guild_id: str, text: str, model_uuid: str, rate: float, user_volume: float
+) -> Optional[PCMClip]:
+    clip = PCMClip(user_volume)
+    first_audio = asyncio.get_running_loop().create_future()
+    decode = decode_stream
+    if AIVIS_OUTPUT_FORMAT == "wav":
+        clip.applied_volume = conversion_volume(guild_id, user_volume)
+        decode = convert_stream
 
-# --- ヘルパー関数 --- (変更なし)
-def load_data(filepath: str) -> dict:
+    async def produce() -> Optional[bytes]:
+        started = time.perf_counter()
+        try:
+            audio_data = await decode(
+                stream_speech(
+                    text, cloud_backend.voice_for(model_uuid), rate, guild_id
+                ),
+                clip,
+                first_audio,
+            )
+        except Exception as e:
+            log_error(guild_id, "Error while streaming from Aivis API: %s", e)
+            return None
+        finally:
+            clip.finish()
+            if not first_audio.done():
+                first_audio.set_result(False)
+        if not audio_data:
+            return None
+        speech_cache.put(
+            text, model_uuid, rate, audio_data, time.perf_counter() - started
+        )
+        return audio_data
+
+    clip.producer = asyncio.create_task(produce())
+    clip.cache_key = speech_cache.make_key(text, model_uuid, rate)
+    # 受信中に同じ内容を要求した他のギルドは、この受信結果を待つ
+    speech_cache.track_fetch(clip.cache_key, clip.producer)
+    clip.producer.add_done_callback(lambda _: release_waiter(clip))
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        has_audio = await asyncio.shield(first_audio)
+    except asyncio.CancelledError:
+        release_clip(clip)
+        raise
+    return clip if has_audio else None
 
 
-def save_data(filepath: str, data: dict):
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def release_waiter(clip: PCMClip) -> bool:
+    """クリップを受信結果の待ち手から外す (1回だけ)。他に待ち手がいなければ True"""
+    key, clip.cache_key = clip.cache_key, None
+    return speech_cache.release_waiter(key) if key else True
 
 
-def create_embed(
-    title: str, description: str, color: discord.Color = discord.Color.blue()
-) -> discord.Embed:
-    return discord.Embed(title=title, description=description, color=color)
+def release_clip(clip: PCMClip):
+    """再生されなくなったクリップの受信とデコードを中止する。
 
+    同じ内容を他のギルドが待っている場合は、そちらのために受信を続ける。
+    """
+    last_waiter = release_waiter(clip)
+    producer = clip.producer
+    if producer is not None and not producer.done() and last_waiter:
+        producer.cancel()
 
-# --- Botクラスの拡張 --- (変更なし)
-class AivisBot(commands.Bot):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.http_session: Optional[aiohttp.ClientSession] = None
 
-    async def setup_hook(self):
-        self.http_session = aiohttp.ClientSession()
-        self.tree.add_command(vc_commands)
-        self.tree.add_command(tts_commands)
-        self.tree.add_command(dict_commands)
-        self.tree.add_command(setting_commands)
-        await self.tree.sync()
+def discard_prepare(task: asyncio.Task):
+    """合成タスクを中止する。既にクリップができていれば、その受信とデコードも止める"""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None and task.result():
+        release_clip(task.result())
 
-    async def on_close(self):
-        if self.http_session:
-            await self.http_session.close()
 
+def start_prepare(guild_id: str, item: SpeechItem) -> asyncio.Task:
+    return asyncio.create_task(
+        prepare_clip(
+            guild_id,
+            item.text,
+            item.model_uuid,
+            item.speaking_rate,
+            item.volume,
+            item.kind,
+        )
+    )
 
-# --- Botの初期化 --- (変更なし)
-intents = discord.Intents.default()
-intents.message_content = True
-intents.voice_states = True
-bot = AivisBot(command_prefix="!", intents=intents)
 
+def fill_prefetch(guild_id: str, session: GuildSession):
+    """キューの先頭から先読み件数分のアイテムを取り出し、合成を開始しておく"""
+    limit = 1 + get_prefetch_count(guild_id)
+    while len(session.prefetched) < limit and not session.queue.empty():
+        item = session.queue.get_nowait()
+        log_debug(guild_id, "Prefetching: '%.30s...'", item.text, sample=True)
+        session.prefetched.append((item, start_prepare(guild_id, item)))
 
-# --- 音声合成と再生 ---
-async def synthesize_speech(
-    text: str, model_uuid: str, speaking_rate: float
-) -> Optional[bytes]:
-    # (この関数は変更なし)
-    url = "https://api.aivis-project.com/v1/tts/synthesize"
-    headers = {
-        "Authorization": f"Bearer {AIVIS_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model_uuid": model_uuid,
-        "text": text,
-        "output_format": "mp3",
-        "speaking_rate": speaking_rate,
-    }
-    try:
-        async with bot.http_session.post(
-            url, json=payload, headers=headers
-        ) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                print(f"Aivis API Error: {response.status} - {await response.text()}")
-                return None
-    except Exception as e:
-        print(f"An error occurred while contacting Aivis API: {e}")
-        return None
+
+async def wait_until_started(guild_id: str, session: GuildSession, clip: PCMClip):
+    """クリップの再生開始 (またはスキップ) を待つ。
+
+    待っている間にキューへ追加されたメッセージは、その都度先読みを始める。
+    """
+    while True:
+        fill_prefetch(guild_id, session)
+        if clip.started_future.done():
+            return
+        session.queue_event.clear()
+        queue_changed = asyncio.create_task(session.queue_event.wait())
+        try:
+            await asyncio.wait(
+                (clip.started_future, queue_changed),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            queue_changed.cancel()
 
 
 # ★★★★★ ここからが最も重要な変更点です ★★★★★
@@ -162,65 +3728,384 @@ async def audio_player_task(guild_id: str):
                 log_debug(guild_id, "Session not found, stopping player task.")
                 break
 
-            log_debug(guild_id, "Waiting for next item in queue...")
-            text, model_uuid, rate, user_volume = await session.queue.get()
-            log_debug(guild_id, f"Got item from queue: '{text[:30]}...'")
+            if not session.prefetched or session.queue.has_priority():
+                if session.queue.empty():
+                    # 次の発言が追加されたときに enqueue() から起動し直される
+                    log_debug(
+                        guild_id, "Queue drained, stopping player task.", sample=True
+                    )
+                    break
+                # 通知は先読み済みのメッセージより先に再生する
+                item = session.queue.get_nowait()
+                session.prefetched.appendleft((item, start_prepare(guild_id, item)))
+            fill_prefetch(guild_id, session)
+
+            item, prepare_task = session.prefetched.popleft()
+            log_debug(
+                guild_id, "Got item from queue: '%.30s...'", item.text, sample=True
+            )
 
             if not session.voice_client:
                 log_debug(guild_id, "Player task: Voice client is None. Skipping.")
+                discard_prepare(prepare_task)
                 continue
 
             if not session.voice_client.is_connected():
                 log_debug(
                     guild_id, "Player task: Voice client not connected. Skipping."
                 )
+                discard_prepare(prepare_task)
                 continue
 
             log_debug(
                 guild_id,
-                f"VC is connected. Latency: {session.voice_client.latency:.2f}s",
+                "VC is connected. Latency: %.2fs",
+                session.voice_client.latency,
+                sample=True,
             )
 
-            log_debug(guild_id, "Synthesizing speech...")
-            audio_data = await synthesize_speech(text, model_uuid, rate)
-            if not audio_data:
-                log_debug(
-                    guild_id, "Speech synthesis failed (audio_data is None). Skipping."
+            log_debug(guild_id, "Waiting for speech synthesis...", sample=True)
+            generation = session.generation
+            session.current_prepare = prepare_task
+            try:
+                # スキップで合成タスクが中止されても、再生タスク自体は止めない
+                await asyncio.wait((prepare_task,))
+            finally:
+                session.current_prepare = None
+            if prepare_task.cancelled():
+                log_debug(guild_id, "Speech synthesis cancelled. Skipping.")
+                continue
+            clip = prepare_task.result()
+            if clip and generation != session.generation:
+                log_debug(guild_id, "Discarding clip synthesized before skip.")
+                release_clip(clip)
+                continue
+            if not clip:
+                log_warning(
+                    guild_id, "Speech synthesis failed (clip is None). Skipping."
                 )
+                metrics.inc("failed_items_total")
                 continue
-            log_debug(guild_id, "Speech synthesis successful.")
+            log_debug(guild_id, "Speech synthesis successful.", sample=True)
 
-            source = discord.FFmpegPCMAudio(
-                io.BytesIO(audio_data), pipe=True, options="-vn"
+            log_debug(
+                guild_id,
+                "Queueing clip (Final Volume: %.2f)...",
+                session.server_volume * clip.user_volume,
+                sample=True,
             )
-            final_volume = session.server_volume * user_volume
-            volume_source = discord.PCMVolumeTransformer(source, volume=final_volume)
+            session.play_clip(clip)
 
-            log_debug(guild_id, f"Playing audio (Final Volume: {final_volume:.2f})...")
-            session.voice_client.play(volume_source)
-
-            while session.voice_client.is_playing() or session.voice_client.is_paused():
-                await asyncio.sleep(0.5)
-            log_debug(guild_id, "Audio playback finished.")
+            # 再生が始まったら次のクリップを用意する (ソース内の待ちは常に1件まで)
+            await wait_until_started(guild_id, session, clip)
+            log_debug(guild_id, "Audio playback started.", sample=True)
+            if clip.started and item.created_at:
+                metrics.observe("end_to_end_seconds", clip.started_at - item.created_at)
 
         except asyncio.CancelledError:
             log_debug(guild_id, "Player task cancelled.")
             break
         except Exception as e:
-            log_debug(
-                guild_id, f"CRITICAL: Unhandled exception in audio player task: {e}"
+            log_error(
+                guild_id,
+                "Unhandled exception in audio player task: %s",
+                e,
+                exc_info=True,
             )
-            log_debug(guild_id, "Player task restarting after 5s delay...")
+            log_info(guild_id, "Player task restarting after 5s delay...")
             await asyncio.sleep(5)  # タスクが死なないようにループを継続
 
 
+def voice_notice(display_name: str, joined: bool) -> str:
+    return f"{display_name}さんが{'参加' if joined else '退出'}しました"
+
+
+async def warm_up_session(guild_id: str, voice_channel: discord.VoiceChannel):
+    """VC参加直後の読み上げが速くなるよう、使われそうな音声を先に合成しておく。
+
+    VCにいるメンバーの入退室の通知と、メンバーの声・速度での定型文を合成して
+    キャッシュに入れ、ffmpeg も一度起動しておく。
+    """
+    started = time.monotonic()
+    members = [m for m in voice_channel.members if not m.bot][:WARMUP_MAX_MEMBERS]
+    phrases = [
+        (voice_notice(member.display_name, joined), DEFAULT_MODEL_UUID, 1.0, "notice")
+        for member in members
+        for joined in (False, True)
+    ]
+    voices = {(DEFAULT_MODEL_UUID, DEFAULT_SPEAKING_RATE)}
+    for member in members:
+        settings = user_settings.get(str(member.id), {})
+        voices.add(
+            (
+                settings.get("model_uuid", DEFAULT_MODEL_UUID),
+                settings.get("speaking_rate", DEFAULT_SPEAKING_RATE),
+            )
+        )
+    phrases += [
+        (text, model_uuid, rate, "message")
+        for model_uuid, rate in voices
+        for text in WARMUP_PHRASES
+    ]
+
+    limit = asyncio.Semaphore(WARMUP_CONCURRENCY)
+
+    async def warm(
+        text: str, model_uuid: str, rate: float, kind: str
+    ) -> Optional[bytes]:
+        async with limit:
+            return await synthesize_speech(text, model_uuid, rate, guild_id, kind)
+
+    results = await asyncio.gather(*(warm(*phrase) for phrase in phrases))
+    audio_data = next((data for data in results if data), None)
+    if audio_data and audio_format(audio_data) != "wav":
+        # ffmpeg の初回起動 (実行ファイルの読み込み) を済ませておく
+        await decode_to_pcm(audio_data)
+    log_info(
+        guild_id,
+        "Warm-up finished: %d/%d phrases in %.2fs.",
+        sum(1 for data in results if data),
+        len(phrases),
+        time.monotonic() - started,
+    )
+
+
+def start_session(
+    guild_id: str, voice_client: discord.VoiceClient, text_channel_id: int
+) -> GuildSession:
+    """接続済みのVCでセッションを開始する"""
+    session = GuildSession(asyncio.get_running_loop(), guild_id)
+    guild_sessions[guild_id] = session
+    session.voice_client = voice_client
+    session.text_channel_id = text_channel_id
+    # 最初のメッセージが辞書の構築を待たないよう、先に作っておく
+    build_dictionary_matcher(guild_id)
+    if WARMUP_ENABLED:
+        session.warmup_task = asyncio.create_task(
+            warm_up_session(guild_id, voice_client.channel)
+        )
+    return session
+
+
+def remove_session(guild_id: str) -> Optional[GuildSession]:
+    """セッションを止めて一覧から外す (VCからの切断は呼び出し側で行う)"""
+    session = guild_sessions.pop(guild_id, None)
+    if session:
+        session.stop()
+        drop_dictionary_matcher(guild_id)
+    return session
+
+
+def idle_reason(session: GuildSession, now: float) -> Optional[str]:
+    """自動で退出すべきセッションならその理由を返す"""
+    if session.has_pending():
+        session.empty_since = None
+        return None
+    voice_client = session.voice_client
+    if voice_client and voice_client.is_connected():
+        humans = [m for m in voice_client.channel.members if not m.bot]
+    else:
+        humans = []  # 切断されたまま戻っていない
+    if humans:
+        session.empty_since = None
+    elif session.empty_since is None:
+        session.empty_since = now
+    elif SESSION_EMPTY_TIMEOUT and now - session.empty_since >= SESSION_EMPTY_TIMEOUT:
+        return "empty"
+    if SESSION_IDLE_TIMEOUT and now - session.last_activity >= SESSION_IDLE_TIMEOUT:
+        return "inactive"
+    return None
+
+
+async def close_idle_session(guild_id: str, reason: str):
+    session = remove_session(guild_id)
+    if not session:
+        return
+    log_info(guild_id, "Closing idle session (%s).", reason)
+    metrics.inc("idle_disconnects_total", 1, reason)
+    guild = bot.get_guild(int(guild_id))
+    voice_client = guild.voice_client if guild else None
+    if voice_client:
+        await voice_client.disconnect(force=True)
+    channel = bot.get_channel(session.text_channel_id)
+    if channel:
+        message = (
+            "ボイスチャンネルに誰もいなくなったため、退出しました。"
+            if reason == "empty"
+            else "しばらく読み上げが無かったため、退出しました。"
+        )
+        try:
+            await channel.send(embed=create_embed(f"{EMOJI_WAVE} 自動退出", message))
+        except discord.HTTPException as e:
+            log_warning(guild_id, "Failed to send idle notice: %s", e)
+
+
+async def reap_idle_sessions():
+    """一定間隔で、使われていないセッションを探してVCから退出する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        now = loop.time()
+        idle = []
+        for guild_id, session in guild_sessions.items():
+            reason = idle_reason(session, now)
+            if reason:
+                idle.append((guild_id, reason))
+        for guild_id, reason in idle:
+            try:
+                await close_idle_session(guild_id, reason)
+            except Exception as e:
+                log_error(guild_id, "Failed to close idle session: %s", e)
+
+
+def session_snapshot(session: GuildSession) -> Optional[dict]:
+    """再起動後に同じ状態で再開するための情報 (VCに接続していなければ None)"""
+    voice_client = session.voice_client
+    if not voice_client or not voice_client.is_connected():
+        return None
+    state = {
+        "voice_channel_id": voice_client.channel.id,
+        "text_channel_id": session.text_channel_id,
+        "is_muted": session.is_muted,
+        "is_paused": session.is_paused,
+        "server_volume": session.server_volume,
+    }
+    if SESSION_RESTORE_QUEUE:
+        pending = [item for item, _ in session.prefetched] + session.queue.items()
+        if session.burst:
+            pending.append(session.burst)
+        # 通知と「他N件」は再起動後には意味が無いので保存しない
+        state["queue"] = [item._asdict() for item in pending if item.kind == "message"]
+    return state
+
+
+def write_json(filepath: str, data: dict):
+    """書き込み途中で止まっても壊れないよう、一時ファイルに書いてから置き換える"""
+    temp_path = f"{filepath}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, filepath)
+
+
+async def save_sessions():
+    sessions = {}
+    for guild_id, session in guild_sessions.items():
+        state = session_snapshot(session)
+        if state:
+            sessions[guild_id] = state
+    data = {"saved_at": time.time(), "sessions": sessions}
+    await asyncio.get_running_loop().run_in_executor(
+        None, write_json, SESSIONS_FILE, data
+    )
+    log_debug(None, "Saved %d session(s).", len(sessions))
+
+
+def load_session_snapshots() -> Dict[str, dict]:
+    """全ワーカーの保存ファイルからセッションを読む (古すぎるファイルは除く)"""
+    directory, prefix = os.path.split(SESSIONS_FILE_PREFIX)
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return {}
+    sessions = {}
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith(".json")):
+            continue
+        data = load_data(os.path.join(directory, name))
+        if time.time() - data.get("saved_at", 0) > SESSION_RESTORE_MAX_AGE:
+            continue
+        sessions.update(data.get("sessions", {}))
+    return sessions
+
+
+async def restore_session(guild_id: str, state: dict, limit: asyncio.Semaphore) -> str:
+    """保存されたセッションのVCに再接続する。結果を "restored" / "skipped" / "failed" で返す"""
+    guild = bot.get_guild(int(guild_id))
+    channel = guild.get_channel(state["voice_channel_id"])
+    members = getattr(channel, "members", [])
+    if not any(not member.bot for member in members):
+        return "skipped"  # チャンネルが無くなった・誰もいない
+    # 全ギルドが同時に接続しないよう、開始をずらす
+    await asyncio.sleep(random.uniform(0, SESSION_RESTORE_JITTER))
+    async with limit:
+        if guild_id in guild_sessions or guild.voice_client:
+            return "skipped"  # 待っている間に /vc join された
+        try:
+            voice_client = await channel.connect(timeout=SESSION_RESTORE_TIMEOUT)
+            await guild.me.edit(deafen=True)
+        except Exception as e:
+            log_warning(guild_id, "Failed to restore voice connection: %s", e)
+            if guild.voice_client:
+                await guild.voice_client.disconnect(force=True)
+            return "failed"
+    session = start_session(guild_id, voice_client, state["text_channel_id"])
+    session.is_muted = state.get("is_muted", False)
+    session.is_paused = state.get("is_paused", False)
+    session.server_volume = state.get("server_volume", session.server_volume)
+    for fields in state.get("queue", []):
+        fields = {k: v for k, v in fields.items() if k in SpeechItem._fields}
+        # 受信時刻は再起動をまたぐと意味が無いので、遅延の計測から外す
+        session.enqueue(SpeechItem(**dict(fields, created_at=0.0)))
+    log_info(
+        guild_id,
+        "Restored session in %s with %d queued item(s).",
+        channel.name,
+        session.queue.qsize(),
+    )
+    return "restored"
+
+
+async def restore_sessions():
+    started = time.monotonic()
+    snapshots = await asyncio.get_running_loop().run_in_executor(
+        None, load_session_snapshots
+    )
+    # 他のワーカー (シャード) が担当するギルドは除く
+    snapshots = {
+        guild_id: state
+        for guild_id, state in snapshots.items()
+        if bot.get_guild(int(guild_id))
+    }
+    limit = asyncio.Semaphore(SESSION_RESTORE_CONCURRENCY)
+
+    async def restore(guild_id: str, state: dict) -> str:
+        try:
+            return await restore_session(guild_id, state, limit)
+        except Exception as e:
+            log_error(guild_id, "Failed to restore session: %s", e)
+            return "failed"
+
+    results = await asyncio.gather(
+        *(restore(guild_id, state) for guild_id, state in snapshots.items())
+    )
+    for result in results:
+        metrics.inc("sessions_restored_total", 1, result)
+    log_info(
+        None,
+        "Restored %d/%d session(s) in %.2fs.",
+        results.count("restored"),
+        len(results),
+        time.monotonic() - started,
+    )
+
+
+async def persist_sessions():
+    """起動時に保存されたセッションに再接続し、その後は一定間隔で保存する"""
+    with startup_phase("restore"):
+        await restore_sessions()
+    bot.sessions_restored = True
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+        try:
+            await save_sessions()
+        except Exception as e:
+            log_warning(None, "Failed to save sessions: %s", e)
+
+
 def process_text_for_speech(
-    message: discord.Message, dictionary: dict
+    message: discord.Message, matcher: DictionaryMatcher
 ) -> Optional[str]:
-    # (この関数は変更なし)
-    text_to_read = message.clean_content
-    for word, reading in dictionary.items():
-        text_to_read = text_to_read.replace(word, reading)
+    text_to_read = matcher.apply(message.clean_content)
     text_to_read = re.sub(r"https?://\S+", "URL", text_to_read)
     if message.attachments:
         if text_to_read:
@@ -233,36 +4118,52 @@ def process_text_for_speech(
 # --- Botイベント ---
 @bot.event
 async def on_ready():
-    global dictionaries, user_settings
-    os.makedirs(DATA_DIR, exist_ok=True)
-    dictionaries = load_data(DICT_FILE)
-    user_settings = load_data(SETTINGS_FILE)
-    log_debug(None, f"{bot.user} としてログインしました。")
+    # on_ready は再接続のたびに呼ばれる。設定は setup_hook で読み込み済みなので、
+    # ここでは最初の1回だけ起動の完了を記録し、セッションを復元する
+    log_info(None, "%s としてログインしました。", bot.user)
+    if "gateway" in startup_phases:
+        return
+    startup_phases["gateway"] = time.monotonic() - bot.setup_finished
+    log_info(
+        None,
+        "Startup finished in %.2fs (%s).",
+        time.monotonic() - PROCESS_STARTED,
+        ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items()),
+    )
+    if SESSION_RESTORE:
+        bot.session_persister = asyncio.create_task(persist_sessions())
 
 
 @bot.event
 async def on_message(message: discord.Message):
     if message.author.bot or not message.guild:
         return
+    received_at = time.monotonic()
     guild_id = str(message.guild.id)
     session = guild_sessions.get(guild_id)
 
-    # log_debug(guild_id, f"Message received from {message.author}: '{message.content[:30]}...'")
+    log_debug(
+        guild_id,
+        "Message received from %s: '%.30s...'",
+        message.author,
+        message.content,
+        sample=True,
+    )
 
     if not session:
         return
     if session.text_channel_id != message.channel.id:
         return
     if session.is_muted:
-        # log_debug(guild_id, "Session is muted, ignoring message.")
+        log_debug(guild_id, "Session is muted, ignoring message.", sample=True)
         return
 
     if not session.voice_client:
-        log_debug(guild_id, "on_message: Voice client is None!")
+        log_warning(guild_id, "on_message: Voice client is None!", sample=True)
         return
 
     if not session.voice_client.is_connected():
-        log_debug(guild_id, "on_message: VC not connected or connection lost!")
+        log_warning(guild_id, "on_message: VC not connected or connection lost!")
         if session.text_channel_id:
             try:
                 channel = bot.get_channel(session.text_channel_id)
@@ -275,20 +4176,16 @@ async def on_message(message: discord.Message):
                         )
                     )
             except (discord.Forbidden, discord.NotFound) as e:
-                log_debug(guild_id, f"Failed to send connection error message: {e}")
+                log_warning(guild_id, "Failed to send connection error message: %s", e)
         session.is_muted = True
         log_debug(guild_id, "Session muted to prevent error spam.")
         return
 
     if message.content.lower() == "s":
         log_debug(guild_id, "Skip command 's' received.")
-        can_skip = session.voice_client.is_playing() or not session.queue.empty()
-        if can_skip:
+        if session.has_pending():
             log_debug(guild_id, "Skipping... Clearing queue and stopping player.")
-            while not session.queue.empty():
-                session.queue.get_nowait()
-            if session.voice_client.is_playing():
-                session.voice_client.stop()
+            session.cancel_pending()
             await message.add_reaction("⏩")
         else:
             log_debug(guild_id, "Nothing to skip.")
@@ -298,24 +4195,40 @@ async def on_message(message: discord.Message):
     user_id = str(message.author.id)
     settings = user_settings.get(user_id, {})
     model_uuid = settings.get("model_uuid", DEFAULT_MODEL_UUID)
-    speaking_rate = settings.get("speaking_rate", 1.1)
+    speaking_rate = settings.get("speaking_rate", DEFAULT_SPEAKING_RATE)
     user_volume = settings.get("volume", 100) / 100.0
-    dictionary = dictionaries.get(guild_id, {})
+    matcher = await get_dictionary_matcher(guild_id)
 
-    # log_debug(guild_id, "Processing text for speech...")
-    text_to_speak = process_text_for_speech(message, dictionary)
+    text_to_speak = process_text_for_speech(message, matcher)
     if not text_to_speak:
-        log_debug(guild_id, "No text to speak after processing, ignoring.")
+        log_debug(guild_id, "No text to speak after processing, ignoring.", sample=True)
         return
 
-    log_debug(guild_id, f"Adding to queue: '{text_to_speak[:30]}...'")
-    await session.queue.put((text_to_speak, model_uuid, speaking_rate, user_volume))
+    log_debug(guild_id, "Adding to queue: '%.30s...'", text_to_speak, sample=True)
+    session.add_speech(
+        SpeechItem(
+            text_to_speak,
+            model_uuid,
+            speaking_rate,
+            user_volume,
+            created_at=received_at,
+            user_id=str(message.author.id),
+        )
+    )
+    metrics.inc("messages_total")
 
 
 @bot.event
 async def on_voice_state_update(
     member: discord.Member, before: discord.VoiceState, after: discord.VoiceState
 ):
+    if bot.user and member.id == bot.user.id:
+        session = guild_sessions.get(str(member.guild.id))
+        if session and before.channel and before.channel != after.channel:
+            # 移動・切断された場合、元のチャンネル向けの発言は破棄する
+            log_info(session.guild_id, "Bot moved or disconnected, cancelling.")
+            session.cancel_pending()
+        return
     if member.bot:
         return
     guild_id = str(member.guild.id)
@@ -327,15 +4240,25 @@ async def on_voice_state_update(
 
     text = None
     if before.channel != vc_channel and after.channel == vc_channel:
-        log_debug(guild_id, f"User {member.display_name} joined the channel.")
-        text = f"{member.display_name}さんが参加しました"
+        log_debug(guild_id, "User %s joined the channel.", member.display_name)
+        text = voice_notice(member.display_name, joined=True)
     elif before.channel == vc_channel and after.channel != vc_channel:
-        log_debug(guild_id, f"User {member.display_name} left the channel.")
-        text = f"{member.display_name}さんが退出しました"
+        log_debug(guild_id, "User %s left the channel.", member.display_name)
+        text = voice_notice(member.display_name, joined=False)
 
     if text:
-        log_debug(guild_id, f"Adding notification to queue: '{text}'")
-        await session.queue.put((text, DEFAULT_MODEL_UUID, 1.0, 1.0))
+        log_debug(guild_id, "Adding notification to queue: '%s'", text)
+        session.add_speech(
+            SpeechItem(
+                text,
+                DEFAULT_MODEL_UUID,
+                1.0,
+                1.0,
+                kind="notice",
+                created_at=time.monotonic(),
+                user_id=str(member.id),
+            )
+        )
 
 
 # --- スラッシュコマンド ---
@@ -362,7 +4285,10 @@ async def help_command(interaction: discord.Interaction):
     )
     tts_description = (
         "`/tts channel [channel]`: 読み上げ対象のテキストチャンネルを変更します。\n"
-        "`/tts queue`: 再生待ちのメッセージ一覧を表示します。"
+        "`/tts queue`: 再生待ちのメッセージ一覧を表示します。\n"
+        "`/tts prefetch [count]`: 再生中に先読みするメッセージ数を変更します。(0～5)\n"
+        "`/tts limit`: 再生待ちキューの上限 (件数・文字数・秒数) とあふれたときの動作を変更します。\n"
+        "`/tts stats`: 音声キャッシュのヒット数などの統計を表示します。"
     )
     embed.add_field(
         name=f"{EMOJI_TTS} 読み上げ関連コマンド", value=tts_description, inline=False
@@ -410,7 +4336,7 @@ setting_commands = app_commands.Group(
 )
 async def vc_join(interaction: discord.Interaction):
     guild_id = str(interaction.guild.id)
-    log_debug(guild_id, f"/vc join command triggered by {interaction.user}.")
+    log_info(guild_id, "/vc join command triggered by %s.", interaction.user)
 
     if not interaction.user.voice:
         log_debug(guild_id, "User not in a voice channel.")
@@ -430,23 +4356,17 @@ async def vc_join(interaction: discord.Interaction):
         await interaction.guild.voice_client.disconnect(force=True)
         log_debug(guild_id, "Disconnected existing client.")
 
-    if guild_id in guild_sessions:
-        log_debug(guild_id, "Found existing session, stopping and deleting...")
-        guild_sessions[guild_id].stop()
-        del guild_sessions[guild_id]
-        log_debug(guild_id, "Old session deleted.")
+    if remove_session(guild_id):
+        log_debug(guild_id, "Old session stopped and deleted.")
 
     try:
-        log_debug(guild_id, f"Connecting to VC: {voice_channel.name}...")
+        log_debug(guild_id, "Connecting to VC: %s...", voice_channel.name)
         vc = await voice_channel.connect()
         await interaction.guild.me.edit(deafen=True)
         log_debug(guild_id, "Connected successfully and deafened.")
 
         log_debug(guild_id, "Creating new GuildSession...")
-        session = GuildSession(bot.loop, guild_id)
-        guild_sessions[guild_id] = session
-        session.voice_client = vc
-        session.text_channel_id = interaction.channel.id
+        session = start_session(guild_id, vc, interaction.channel.id)
         log_debug(guild_id, "New session created successfully.")
 
         embed = create_embed(
@@ -463,7 +4383,7 @@ async def vc_join(interaction: discord.Interaction):
         embed.add_field(name="読み上げ状態", value="有効", inline=True)
         await interaction.response.send_message(embed=embed)
     except Exception as e:
-        log_debug(guild_id, f"Failed to join VC: {e}")
+        log_error(guild_id, "Failed to join VC: %s", e)
         await interaction.response.send_message(
             embed=create_embed(
                 f"{EMOJI_ERROR} エラー", f"接続に失敗しました: {e}", discord.Color.red()
@@ -475,7 +4395,7 @@ async def vc_join(interaction: discord.Interaction):
 @vc_commands.command(name="leave", description="VCから退出します。")
 async def vc_leave(interaction: discord.Interaction):
     guild_id = str(interaction.guild.id)
-    log_debug(guild_id, f"/vc leave command triggered by {interaction.user}.")
+    log_info(guild_id, "/vc leave command triggered by %s.", interaction.user)
 
     if not interaction.guild.voice_client:
         log_debug(guild_id, "Bot not in any VC.")
@@ -488,11 +4408,8 @@ async def vc_leave(interaction: discord.Interaction):
             ephemeral=True,
         )
 
-    if guild_id in guild_sessions:
-        log_debug(guild_id, "Stopping player task and deleting session...")
-        guild_sessions[guild_id].stop()
-        del guild_sessions[guild_id]
-        log_debug(guild_id, "Session deleted.")
+    if remove_session(guild_id):
+        log_debug(guild_id, "Session stopped and deleted.")
 
     await interaction.guild.voice_client.disconnect()
     log_debug(guild_id, "Disconnected from VC.")
@@ -533,8 +4450,9 @@ async def vc_unmute(interaction: discord.Interaction):
 
 @vc_commands.command(name="pause", description="再生を一時停止します。")
 async def vc_pause(interaction: discord.Interaction):
-    if interaction.guild.voice_client and interaction.guild.voice_client.is_playing():
-        interaction.guild.voice_client.pause()
+    session = guild_sessions.get(str(interaction.guild.id))
+    if session and not session.is_paused:
+        session.pause()
         await interaction.response.send_message(
             embed=create_embed(
                 f"{EMOJI_PAUSE} 一時停止", "読み上げを一時停止しました。"
@@ -544,8 +4462,9 @@ async def vc_pause(interaction: discord.Interaction):
 
 @vc_commands.command(name="resume", description="再生を再開します。")
 async def vc_resume(interaction: discord.Interaction):
-    if interaction.guild.voice_client and interaction.guild.voice_client.is_paused():
-        interaction.guild.voice_client.resume()
+    session = guild_sessions.get(str(interaction.guild.id))
+    if session and session.is_paused:
+        session.resume()
         await interaction.response.send_message(
             embed=create_embed(f"{EMOJI_RESUME} 再開", "読み上げを再開しました。")
         )
@@ -569,11 +4488,8 @@ async def vc_volume(
             ephemeral=True,
         )
 
+    # 再生中のクリップにも GuildAudioSource が次のフレームから反映する
     session.server_volume = level / 100.0
-    if interaction.guild.voice_client and interaction.guild.voice_client.source:
-        interaction.guild.voice_client.source.volume = session.server_volume * (
-            user_settings.get(str(interaction.user.id), {}).get("volume", 100) / 100.0
-        )
     await interaction.response.send_message(
         embed=create_embed(
             f"{EMOJI_VC} 音量変更",
@@ -596,6 +4512,9 @@ async def tts_channel(interaction: discord.Interaction, channel: discord.TextCha
             ),
             ephemeral=True,
         )
+    if session.text_channel_id != channel.id:
+        # 元のチャンネルの発言は読み上げない
+        session.cancel_pending()
     session.text_channel_id = channel.id
     await interaction.response.send_message(
         embed=create_embed(
@@ -610,7 +4529,7 @@ async def tts_channel(interaction: discord.Interaction, channel: discord.TextCha
 )
 async def tts_queue(interaction: discord.Interaction):
     session = guild_sessions.get(str(interaction.guild.id))
-    if not session or session.queue.empty():
+    if not session or (session.queue.empty() and not session.prefetched):
         return await interaction.response.send_message(
             embed=create_embed(
                 f"{EMOJI_QUEUE} 再生待ちリスト",
@@ -619,7 +4538,7 @@ async def tts_queue(interaction: discord.Interaction):
             ephemeral=True,
         )
 
-    queue_list = list(session.queue._queue)
+    queue_list = [item for item, _ in session.prefetched] + session.queue.items()
     embed = create_embed(
         f"{EMOJI_QUEUE} 再生待ちリスト",
         f"現在 {len(queue_list)} 件のメッセージが待機中です。",
@@ -636,13 +4555,149 @@ async def tts_queue(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
+@tts_commands.command(
+    name="prefetch", description="再生中に先読みするメッセージ数を変更します (0-5)。"
+)
+@app_commands.describe(count="先読みする件数 (0で無効)")
+async def tts_prefetch(
+    interaction: discord.Interaction,
+    count: app_commands.Range[int, 0, MAX_PREFETCH_COUNT],
+):
+    guild_id = str(interaction.guild.id)
+    if guild_id not in guild_settings:
+        guild_settings[guild_id] = {}
+    guild_settings[guild_id]["prefetch_count"] = count
+    store.set(NS_GUILD_SETTINGS, guild_id, "prefetch_count", count)
+    await interaction.response.send_message(
+        embed=create_embed(
+            f"{EMOJI_SUCCESS} 先読み設定",
+            f"再生中に先読みするメッセージ数を **{count}件** に設定しました。",
+        )
+    )
+
+
+@tts_commands.command(
+    name="limit", description="再生待ちキューの上限とあふれたときの動作を変更します。"
+)
+@app_commands.describe(
+    items="最大件数",
+    chars="最大文字数",
+    seconds="推定再生時間の上限 (秒)",
+    policy="上限を超えたときの動作",
+)
+@app_commands.choices(
+    policy=[
+        app_commands.Choice(name=label, value=value)
+        for value, label in OVERFLOW_POLICIES.items()
+    ]
+)
+async def tts_limit(
+    interaction: discord.Interaction,
+    items: Optional[app_commands.Range[int, 1, 1000]] = None,
+    chars: Optional[app_commands.Range[int, 10, 100000]] = None,
+    seconds: Optional[app_commands.Range[int, 10, 36000]] = None,
+    policy: Optional[app_commands.Choice[str]] = None,
+):
+    guild_id = str(interaction.guild.id)
+    changes = {
+        "queue_max_items": items,
+        "queue_max_chars": chars,
+        "queue_max_seconds": seconds,
+        "overflow_policy": policy.value if policy else None,
+    }
+    for key, value in changes.items():
+        if value is None:
+            continue
+        guild_settings.setdefault(guild_id, {})[key] = value
+        store.set(NS_GUILD_SETTINGS, guild_id, key, value)
+
+    limits = get_queue_limits(guild_id)
+    embed = create_embed(
+        f"{EMOJI_SUCCESS} キューの上限",
+        "現在の再生待ちキューの上限です。",
+    )
+    embed.add_field(name="最大件数", value=f"{limits.max_items}件", inline=True)
+    embed.add_field(name="最大文字数", value=f"{limits.max_chars}文字", inline=True)
+    embed.add_field(name="推定再生時間", value=f"{limits.max_seconds}秒", inline=True)
+    embed.add_field(
+        name="あふれたとき",
+        value=OVERFLOW_POLICIES.get(limits.overflow_policy, limits.overflow_policy),
+        inline=False,
+    )
+    await interaction.response.send_message(embed=embed)
+
+
+@tts_commands.command(name="stats", description="読み上げの統計情報を表示します。")
+async def tts_stats(interaction: discord.Interaction):
+    cache = speech_cache
+    embed = create_embed(
+        f"{EMOJI_INFO} 読み上げ統計",
+        "合成音声キャッシュと Aivis API 呼び出しの状況です。",
+    )
+    embed.add_field(
+        name="キャッシュヒット",
+        value=(
+            f"メモリ: {cache.memory_hits}回\n"
+            f"ディスク: {cache.disk_hits}回\n"
+            f"同時リクエスト統合: {cache.deduplicated}回"
+        ),
+        inline=True,
+    )
+    embed.add_field(
+        name="キャッシュミス (API呼び出し)", value=f"{cache.misses}回", inline=True
+    )
+    embed.add_field(name="ヒット率", value=f"{cache.hit_rate * 100:.1f}%", inline=True)
+    hits = cache.memory_hits + cache.disk_hits + cache.deduplicated
+    embed.add_field(
+        name="節約できた量",
+        value=(
+            f"API文字数: {cache.saved_chars}文字\n"
+            f"推定待ち時間: {hits * cache.average_fetch_seconds:.1f}秒"
+        ),
+        inline=False,
+    )
+    session = guild_sessions.get(str(interaction.guild.id))
+    if session:
+        embed.add_field(
+            name="まとめて読み上げた発言 (このサーバー)",
+            value=f"{session.coalesced_count}件",
+            inline=True,
+        )
+        embed.add_field(
+            name="キューの上限で破棄 (このサーバー)",
+            value=f"{session.dropped_count}件 ({session.dropped_chars}文字)",
+            inline=True,
+        )
+    scheduler = synthesis_scheduler
+    guild_stats = scheduler.stats.get(str(interaction.guild.id), GuildWaitStats())
+    embed.add_field(
+        name="API呼び出し待ち (このサーバー)",
+        value=(
+            f"回数: {guild_stats.requests}回\n"
+            f"平均: {guild_stats.average_wait * 1000:.0f}ms / "
+            f"最大: {guild_stats.max_wait * 1000:.0f}ms"
+        ),
+        inline=True,
+    )
+    embed.add_field(
+        name="API呼び出し (Bot全体)",
+        value=(
+            f"実行中: {scheduler.in_flight}/{scheduler.max_concurrency}\n"
+            f"待機中: {scheduler.waiting}"
+        ),
+        inline=True,
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
 @dict_commands.command(name="add", description="辞書に単語と読みを登録します。")
 async def dict_add(interaction: discord.Interaction, word: str, reading: str):
     guild_id = str(interaction.guild.id)
     if guild_id not in dictionaries:
         dictionaries[guild_id] = {}
     dictionaries[guild_id][word] = reading
-    save_data(DICT_FILE, dictionaries)
+    invalidate_dictionary_matcher(guild_id)
+    store.set(NS_DICTIONARIES, guild_id, word, reading)
     await interaction.response.send_message(
         embed=create_embed(
             f"{EMOJI_SUCCESS} 辞書登録",
@@ -657,7 +4712,8 @@ async def dict_remove(interaction: discord.Interaction, word: str):
     guild_id = str(interaction.guild.id)
     if guild_id in dictionaries and word in dictionaries[guild_id]:
         del dictionaries[guild_id][word]
-        save_data(DICT_FILE, dictionaries)
+        invalidate_dictionary_matcher(guild_id)
+        store.delete(NS_DICTIONARIES, guild_id, word)
         await interaction.response.send_message(
             embed=create_embed(
                 f"{EMOJI_SUCCESS} 辞書削除", f"「**{word}**」を削除しました。"
@@ -702,7 +4758,7 @@ async def setting_model(interaction: discord.Interaction, model_uuid: str):
     if user_id not in user_settings:
         user_settings[user_id] = {}
     user_settings[user_id]["model_uuid"] = model_uuid
-    save_data(SETTINGS_FILE, user_settings)
+    store.set(NS_USER_SETTINGS, user_id, "model_uuid", model_uuid)
     embed = create_embed(
         f"{EMOJI_SUCCESS} 声のモデルを設定しました",
         f"あなたの読み上げ音声を新しいモデルに変更しました。\nUUID: `{model_uuid}`",
@@ -725,7 +4781,7 @@ async def setting_speed(
     if user_id not in user_settings:
         user_settings[user_id] = {}
     user_settings[user_id]["speaking_rate"] = rate
-    save_data(SETTINGS_FILE, user_settings)
+    store.set(NS_USER_SETTINGS, user_id, "speaking_rate", rate)
     await interaction.response.send_message(
         embed=create_embed(
             f"{EMOJI_SUCCESS} 速度設定",
@@ -746,7 +4802,7 @@ async def setting_volume(
     if user_id not in user_settings:
         user_settings[user_id] = {}
     user_settings[user_id]["volume"] = level
-    save_data(SETTINGS_FILE, user_settings)
+    store.set(NS_USER_SETTINGS, user_id, "volume", level)
     await interaction.response.send_message(
         embed=create_embed(
             f"{EMOJI_SUCCESS} 音量設定",
@@ -761,7 +4817,7 @@ async def setting_view(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     settings = user_settings.get(user_id, {})
     model = settings.get("model_uuid", f"{DEFAULT_MODEL_UUID} (デフォルト)")
-    speed = settings.get("speaking_rate", "1.1 (デフォルト)")
+    speed = settings.get("speaking_rate", f"{DEFAULT_SPEAKING_RATE} (デフォルト)")
     volume = settings.get("volume", "100 (デフォルト)")
     embed = create_embed(
         title=f"{EMOJI_SETTING} {interaction.user.display_name} の設定",
@@ -779,7 +4835,7 @@ async def setting_reset(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     if user_id in user_settings:
         del user_settings[user_id]
-        save_data(SETTINGS_FILE, user_settings)
+        store.delete(NS_USER_SETTINGS, user_id)
         await interaction.response.send_message(
             embed=create_embed(
                 f"{EMOJI_SUCCESS} 設定リセット", "個人設定をデフォルトに戻しました。"
@@ -794,8 +4850,77 @@ async def setting_reset(interaction: discord.Interaction):
 
 
 # --- Bot実行 ---
+async def migrate_legacy_data():
+    """ストアを開き、旧形式のJSONファイルがあれば取り込む"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    await store.open()
+    for namespace, filepath in LEGACY_JSON_FILES.items():
+        await store.migrate_json(namespace, filepath)
+
+
+def spawn_worker(index: int) -> subprocess.Popen:
+    env = dict(os.environ, WORKER_INDEX=str(index))
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+
+def run_workers():
+    """シャードを分担するワーカープロセスを起動し、落ちたものを起動し直す"""
+
+    async def prepare():
+        await migrate_legacy_data()
+        await store.close()
+
+    asyncio.run(prepare())
+    shard_count = max(SHARD_COUNT, WORKER_PROCESSES)
+    workers = {index: spawn_worker(index) for index in range(WORKER_PROCESSES)}
+    for index in workers:
+        shards = worker_shard_ids(index, WORKER_PROCESSES, shard_count)
+        log_info(None, "Worker %d started with shards %s.", index, shards)
+    # SIGTERM / SIGINT で止められたら、ワーカーにも終了を伝えて終わるのを待つ
+    # (各ワーカーは SIGTERM で close() を通り、セッションを保存してから終わる)
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    try:
+        while not stopping.wait(WORKER_RESTART_DELAY):
+            for index, process in workers.items():
+                if process.poll() is not None:
+                    log_warning(
+                        None,
+                        "Worker %d exited with code %s, restarting.",
+                        index,
+                        process.returncode,
+                    )
+                    workers[index] = spawn_worker(index)
+    finally:
+        log_info(None, "Stopping %d worker(s).", len(workers))
+        for process in workers.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in workers.values():
+            process.wait()
+
+
 if __name__ == "__main__":
     if not all([DISCORD_TOKEN, AIVIS_API_KEY]):
         print("エラー: .envファイルにDISCORD_TOKENとAIVIS_API_KEYを設定してください。")
+    elif DEFAULT_OVERFLOW_POLICY not in OVERFLOW_POLICIES:
+        # 打ち間違いが黙って summarize として扱われないよう、起動しない
+        print(
+            "エラー: QUEUE_OVERFLOW_POLICY には "
+            + " / ".join(OVERFLOW_POLICIES)
+            + f" のいずれかを設定してください (現在: {DEFAULT_OVERFLOW_POLICY})。"
+        )
+    elif any(weight <= 0 for weight in AIVIS_GUILD_WEIGHTS.values()):
+        # 重み 0 はスケジューラーで0除算に、負の値は優先順位の逆転になる
+        print(
+            "エラー: AIVIS_GUILD_WEIGHTS の重みは正の数にしてください"
+            f" (現在: {os.getenv('AIVIS_GUILD_WEIGHTS')})。"
+        )
     else:
-        bot.run(DISCORD_TOKEN)
+        setup_logging()
+        if WORKER_PROCESSES > 1 and WORKER_INDEX is None:
+            run_workers()
+        else:
+            # discord.py のログも同じ出力先 (キュー経由) に流す
+            bot.run(DISCORD_TOKEN, log_handler=None)